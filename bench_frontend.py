@@ -0,0 +1,232 @@
+"""
+Dipper front-end benchmark
+
+Generates synthetic .dip programs of increasing size and times each stage of the
+front-end separately: lexing, packrat parsing, the generated ToAST transform,
+building Dipper AST nodes and compiling to a module. Each size runs in its own
+process so the peak memory numbers don't bleed into each other.
+
+Usage:
+    pypy bench_frontend.py [--sizes 1000,10000,100000] [--output results.json]
+
+Prints (or writes) a JSON document with one entry per program size.
+"""
+import sys
+sys.path.insert(0, "./pypy-source")
+
+import os
+import gc
+import json
+import time
+import platform
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_SIZES = [1000, 5000, 10000, 50000, 100000]
+
+# shape of the generated code
+BLOCK_DEPTH = 4
+CALL_DEPTH = 8
+LONG_BLOCK = 12
+
+
+def peak_memory_kb():
+    """
+    Returns the peak resident set size of this process in KB, or -1 if the
+    platform can't tell us.
+    """
+    if resource is None:
+        return -1
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, everything else reports KB
+    if sys.platform == "darwin":
+        peak = peak // 1024
+    return peak
+
+
+def gen_function(i):
+    """
+    Returns the lines for one generated function. Every function has a long
+    straight-line block, deeply nested if blocks, a loop and a deeply nested
+    call expression.
+    """
+    lines = ["fn f%s(a : int, b : int) -> int {" % i]
+    lines.append("    x = a + b")
+    for j in range(LONG_BLOCK):
+        lines.append("    v%s = x * %s" % (j, j + 1))
+        lines.append("    x += v%s" % j)
+
+    indent = "    "
+    for j in range(BLOCK_DEPTH):
+        lines.append("%sif x > %s {" % (indent, j))
+        indent += "    "
+        lines.append("%sx -= %s" % (indent, j + 1))
+    for j in range(BLOCK_DEPTH):
+        indent = indent[4:]
+        lines.append("%s}" % indent)
+        if j == 0:
+            lines.append("%selse {" % indent)
+            lines.append("%s    x += 1" % indent)
+            lines.append("%s}" % indent)
+
+    lines.append("    for k in 0..10 {")
+    lines.append("        x += k")
+    lines.append("    }")
+
+    call = "x"
+    for j in range(CALL_DEPTH):
+        call = "add(%s, %s)" % (call, j)
+    lines.append("    return %s" % call)
+    lines.append("}")
+    lines.append("")
+    return lines
+
+
+def gen_program(numlines):
+    """
+    Returns the source of a synthetic program with roughly numlines lines
+    """
+    lines = [
+        "# synthetic benchmark program",
+        "fn add(x : int, y : int) -> int {",
+        "    return x + y",
+        "}",
+        "",
+    ]
+    i = 0
+    while len(lines) < numlines:
+        lines.extend(gen_function(i))
+        i += 1
+    lines.append("fn main() {")
+    lines.append("    return f0(1, 2)")
+    lines.append("}")
+    lines.append("")
+    return "\n".join(lines), i
+
+
+def timed(stages, name, fn, *args):
+    gc.collect()
+    start = time.time()
+    try:
+        result = fn(*args)
+    except RuntimeError as e:
+        # most likely hitting the Python recursion limit on deep inputs
+        stages.append({"stage": name, "error": "%s: %s" % (e.__class__.__name__, e)})
+        return None
+    stages.append({
+        "stage": name,
+        "seconds": time.time() - start,
+        "peak_memory_kb": peak_memory_kb(),
+    })
+    return result
+
+
+def build_ast(newtree):
+    """
+    Same as the tail end of DipperParser.parse
+    """
+    from dip import parser, ast
+    dip = parser.DipperParser()
+    tree = ast.RootNode()
+    tree.set([ dip._traverse(item) for item in newtree.children ])
+    return tree
+
+
+def run_one(numlines):
+    """
+    Benchmarks a single program size in this process and returns the result dict
+    """
+    from dip import parser, compiler
+    from dip.namespace import Module
+
+    source, numfuncs = gen_program(numlines)
+    result = {
+        "lines": source.count("\n"),
+        "bytes": len(source),
+        "functions": numfuncs + 2,
+        "baseline_memory_kb": peak_memory_kb(),
+        "stages": [],
+    }
+    stages = result["stages"]
+    total = time.time()
+
+    tokens = timed(stages, "tokenize", parser.tokenize, source)
+    if tokens is not None:
+        result["tokens"] = len(tokens)
+        parsetree = timed(stages, "parse", parser.packrat.parse, tokens)
+    else:
+        parsetree = None
+    del tokens
+
+    newtree = None
+    if parsetree is not None:
+        newtree = timed(stages, "transform", parser.ToAST().transform, parsetree)
+    del parsetree
+
+    tree = None
+    if newtree is not None:
+        tree = timed(stages, "traverse", build_ast, newtree)
+    del newtree
+
+    if tree is not None:
+        timed(stages, "from_ast", Module.from_ast, "<bench>", "main", tree)
+
+    result["total_seconds"] = time.time() - total
+    result["peak_memory_kb"] = peak_memory_kb()
+    return result
+
+
+def main(argv):
+    sizes = DEFAULT_SIZES
+    output = None
+
+    i = 1
+    while i < len(argv):
+        if argv[i] == "--one":
+            print json.dumps(run_one(int(argv[i + 1])))
+            return 0
+        elif argv[i] == "--sizes":
+            sizes = [ int(val) for val in argv[i + 1].split(",") ]
+        elif argv[i] == "--output":
+            output = argv[i + 1]
+        else:
+            print __doc__
+            return 1
+        i += 2
+
+    from dip.compiler import COMPILER_VERSION
+
+    results = []
+    for size in sizes:
+        sys.stderr.write("benchmarking %s lines...\n" % size)
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--one", str(size)],
+            stdout=subprocess.PIPE)
+        out, _ = proc.communicate()
+        if proc.returncode != 0:
+            results.append({"lines": size, "error": "exit code %s" % proc.returncode})
+            continue
+        # the parser may print warnings before the result, which is always the last line
+        results.append(json.loads(out.strip().split("\n")[-1]))
+
+    report = json.dumps({
+        "benchmark": "frontend",
+        "python": "%s %s" % (platform.python_implementation(), platform.python_version()),
+        "compiler_version": COMPILER_VERSION,
+        "timestamp": time.time(),
+        "results": results,
+    }, indent=2, sort_keys=True)
+
+    if output is None:
+        print report
+    else:
+        with open(output, "w") as fp:
+            fp.write(report + "\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
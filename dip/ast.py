@@ -12,6 +12,32 @@ from dip.bytecode import INST
 from dip.common import CompileError
 
 
+# Source positions are packed into a single int as (line << POS_COLBITS) | column,
+# with NOPOS standing in for nodes that don't come straight from a token
+POS_COLBITS = 16
+POS_COLMASK = (1 << POS_COLBITS) - 1
+NOPOS = -1
+
+
+def packpos(lineno, colno):
+    if lineno < 0 or colno < 0:
+        return NOPOS
+    if colno > POS_COLMASK:
+        colno = POS_COLMASK
+    return (lineno << POS_COLBITS) | colno
+
+
+def unpackpos(pos):
+    if pos < 0:
+        return (-1, -1)
+    return (pos >> POS_COLBITS, pos & POS_COLMASK)
+
+
+# Shared by every node that has no children, which is most of them. Never modify
+# this list directly: Node.addchild gives a node its own list first.
+NO_CHILDREN = []
+
+
 def infix_to_prefix(tokens):
     ops = set(("+", "-", "*", "/"))
     output = [[]]
@@ -27,28 +53,51 @@ def infix_to_prefix(tokens):
 
 
 class Node(object):
-    name = ""
+    # Every node class lists its instance attributes in __slots__ so that nodes
+    # don't each carry a __dict__. Subclasses must declare __slots__ too, even
+    # if it's empty. Attributes that get used through plain Node references have
+    # to be declared here, or RPython won't allow them.
+    __slots__ = ("children", "data", "pos", "name", "srcline", "srchash")
 
-    def __init__(self, data="", source=(-1, -1)):
+    def __init__(self, data="", pos=NOPOS):
         if not we_are_translated():
             assert type(data) is str
-        self.children = []
-        self.doc = []
+        self.children = NO_CHILDREN
         self.data = data
-        self.source = source # source pos from the file. a 2-tuple of ints represnting (line, column)
+        self.pos = pos # packed source pos from the file, see packpos()
+        self.name = ""
+        # set on top-level Function and Struct nodes by the parser: the line the
+        # node starts on and a hash of its source text
+        self.srcline = -1
+        self.srchash = ""
         self.init()
 
     def init(self):
         pass
 
     def set(self, nodes):
-        for child in nodes:
-            self.children.append(child)
+        if self.children is NO_CHILDREN and len(nodes) > 0:
+            # the list is built just for us, so there's no need to copy it
+            self.children = nodes
+        else:
+            for child in nodes:
+                self.addchild(child)
+
+    def addchild(self, node):
+        if self.children is NO_CHILDREN:
+            self.children = [node]
+        else:
+            self.children.append(node)
 
     @property
     def type(self):
         return self.__class__.__name__
 
+    @property
+    def source(self):
+        """ Source position as a (line, column) tuple """
+        return unpackpos(self.pos)
+
     def mkobj(self):
         raise NotImplementedError
 
@@ -69,16 +118,27 @@ class Node(object):
         """
         return []
 
+    def firstsource(self):
+        """
+        Source position of the first token under this node, for nodes like blocks and
+        expressions that don't have one of their own. Returns (-1, -1) if there's
+        no token to go by.
+        """
+        node = self
+        while node.pos < 0 and len(node.children) > 0:
+            node = node.children[0]
+        return unpackpos(node.pos)
+
     def walk(self):
-        def _iter(node, level):
-            level += 1
-            for child in node:
-                yield (child, level)
-                for n, nextLevel in _iter(child, level):
-                    yield (n, nextLevel)
-        yield (self, 0)
-        for item in _iter(self, 0):
-            yield item
+        """
+        Yields (node, level) for this node and every node below it, depth-first
+        """
+        stack = [(self, 0)]
+        while len(stack) > 0:
+            node, level = stack.pop()
+            yield (node, level)
+            for i in range(len(node.children) - 1, -1, -1):
+                stack.append((node.children[i], level + 1))
 
     def compile(self, ctx):
         ctx.start_node(self)
@@ -120,11 +180,14 @@ class Node(object):
 
 
 class RootNode(Node):
-    pass
+    __slots__ = ()
 
 
 class NullNode(Node):
-    label = "_nullnode_"
+    __slots__ = ("label",)
+
+    def init(self):
+        self.label = "_nullnode_"
 
     def __str__(self):
         return ".%s" % self.label
@@ -134,6 +197,7 @@ class NullNode(Node):
 
 
 class OneChild(Node):
+    __slots__ = ()
     label = "_one_child_"
 
     def __str__(self):
@@ -144,6 +208,8 @@ class OneChild(Node):
 
 
 class Function(Node):
+    __slots__ = ("args", "returnType")
+
     def set(self, nodes):
         self.name = nodes.pop(0).data
         self.args = nodes.pop(0)
@@ -154,7 +220,7 @@ class Function(Node):
         if self.name == "main" and len(self.args.children) == 0:
             argv = TypedName()
             argv.set([Name("argv"), Name("list")])
-            self.args.children.append(argv)
+            self.args.addchild(argv)
 
         if len(nodes) > 0 and nodes[0].type in ("Name", "DottedName"):
             self.returnType = nodes.pop(0)
@@ -163,7 +229,7 @@ class Function(Node):
 
         if len(nodes) > 0 and isinstance(nodes[0], Block):
             for node in nodes[0]:
-                self.children.append(node)
+                self.addchild(node)
 
     def compile(self, ctx):
         Node.compile(self, ctx)
@@ -190,15 +256,18 @@ class Function(Node):
 
 
 class Struct(Node):
+    __slots__ = ()
+
     def set(self, nodes):
         name = nodes.pop(0)
         self.name = name.getName()
         for field in nodes:
-            self.children.append(field)
+            self.addchild(field)
 
     def mkstruct(self):
         st = types.StructDef(self.name, len(self.children))
         for field in self.children:
+            assert isinstance(field, Field)
             fieldinfo = field.typedname
             st.setfield(fieldinfo.getName(), types.AutoType(fieldinfo.getType()))
         return st
@@ -211,6 +280,8 @@ class Struct(Node):
 
 
 class Class(Node):
+    __slots__ = ("parent",)
+
     def set(self, nodes):
         name = nodes.pop(0)
         body = nodes
@@ -224,7 +295,7 @@ class Class(Node):
             self.parent = NullNode()
 
         for node in body:
-            self.children.append(node)
+            self.addchild(node)
 
     def _getRepr(self):
         fields = [self.name, "(%s)" % self.parent.toString()]
@@ -235,6 +306,8 @@ class Class(Node):
 
 
 class Field(Node):
+    __slots__ = ("default", "condition", "typedname")
+
     def init(self):
         self.default = ""
         self.condition = NullNode()
@@ -262,15 +335,19 @@ class Field(Node):
 
 
 class FieldList(Node):
-    pass
+    __slots__ = ()
 
 
 class FuncArgs(Node):
+    __slots__ = ()
+
     def _getRepr(self):
         return [ node.toString() for node in self.children ]
 
 
 class Block(Node):
+    __slots__ = ()
+
     def compile(self, ctx):
         Node.compile(self, ctx)
         for node in self:
@@ -282,6 +359,8 @@ class Block(Node):
 
 
 class If(Block):
+    __slots__ = ("expr",)
+
     def set(self, nodes):
         boolexpr = nodes.pop(0)
         ifblock = nodes.pop(0)
@@ -290,21 +369,19 @@ class If(Block):
         self.expr = boolexpr
 
         ifblock.data = "if"
-        self.children.append(ifblock)
+        self.addchild(ifblock)
 
         for b in blocks:
             assert b.type in ("Block", "Elif", "Else")
-            self.children.append(b)
+            self.addchild(b)
 
     def compile(self, ctx):
         Node.compile(self, ctx)
-        ctx.emit_LABEL("%s %s" % (self.type, self.toString()))
-
-        boolidx = self.expr.compile(ctx)
+        ctx.emit_LABEL(self.type, self.expr.firstsource())
 
         # jump to an intentionally invalid place because we're going to rewrite this
         # with setbranch once we know where to go
-        top_jmp = ctx.emit_BF(boolidx, -1)
+        top_jmp = compile_branch_if_false(ctx, self.expr)
 
         # keep track of all jump-to-end instructions so we can fix them up later
         jumpend = []
@@ -313,11 +390,11 @@ class If(Block):
             assert block.type in ("Block", "Elif", "Else")
 
             if block.type == "Elif":
-                start_ptr = ctx.emit_LABEL("Elif %s" % block.toString())
-                boolidx = block.expr.compile(ctx)
+                assert isinstance(block, Elif)
+                start_ptr = ctx.emit_LABEL("Elif", block.expr.firstsource())
 
                 # jump to an intentionally invalid place because we're going to rewrite it in a bit
-                start_jmp = ctx.emit_BF(boolidx, -1)
+                start_jmp = compile_branch_if_false(ctx, block.expr)
 
                 # rewrite the previous branch instruction to point towards the top of this one
                 ctx.setbranch(top_jmp, start_ptr)
@@ -330,7 +407,7 @@ class If(Block):
                 # rewrite any previous branch to point here
                 ctx.setbranch(top_jmp, start_ptr)
 
-            start = ctx.emit_LABEL("start_block %s %s" % (block.type, block.toString()))
+            start = ctx.emit_LABEL("start_block %s" % block.type)
 
             block.compile(ctx)
 
@@ -358,24 +435,30 @@ class If(Block):
 
 
 class Elif(Block):
+    __slots__ = ("expr",)
+
     def set(self, nodes):
         boolexpr = nodes.pop(0)
         blockbody = nodes
 
         self.expr = boolexpr
         for node in blockbody:
-            self.children.append(node)
+            self.addchild(node)
 
     def _getRepr(self):
         return [ self.expr.toString() ]
 
 
 class Else(Block):
+    __slots__ = ()
+
     def _getRepr(self):
         return []
 
 
 class ForLoop(Block):
+    __slots__ = ("loopvar", "expr")
+
     def set(self, nodes):
         assert len(nodes) == 3
         self.loopvar = nodes.pop(0).data
@@ -386,13 +469,14 @@ class ForLoop(Block):
 
         block = nodes.pop(0)
         for node in block:
-            self.children.append(node)
+            self.addchild(node)
 
     def compile(self, ctx):
-        assert isinstance(self.expr, RangeExpr)
-        self.expr.compile(ctx)
-        startval_idx = self.expr.start_idx
-        endval_idx = self.expr.end_idx
+        rangeexpr = self.expr
+        assert isinstance(rangeexpr, RangeExpr)
+        rangeexpr.compile(ctx)
+        startval_idx = rangeexpr.start_idx
+        endval_idx = rangeexpr.end_idx
         assert startval_idx > -1 and endval_idx > -1
 
         loopval_idx = ctx.pushobj(types.DInteger())
@@ -418,6 +502,8 @@ class ForLoop(Block):
 
 
 class Expression(Node):
+    __slots__ = ()
+
     def compile(self, ctx):
         """
         Generates bytecode to eval an expression, then returns the data index
@@ -440,11 +526,15 @@ class SimpleExpr(Expression):
     """
     Call or dotted name
     """
+    __slots__ = ()
+
     def _getRepr(self):
         return [ self.children[0].toString() ]
 
 
 class IfExpr(Expression):
+    __slots__ = ()
+
     def compile(self, ctx):
         raise NotImplementedError("If expressions")
         Node.compile(self, ctx)
@@ -452,10 +542,12 @@ class IfExpr(Expression):
 
 
 class MatchExpr(Expression):
-    pass
+    __slots__ = ()
 
 
 class RangeExpr(Expression):
+    __slots__ = ("start_idx", "end_idx", "_leftnode", "_rightnode")
+
     def init(self):
         self.start_idx = -1
         self.end_idx = -1
@@ -476,7 +568,47 @@ class RangeExpr(Expression):
         return [self._leftnode.toString(), self._rightnode.toString()]
 
 
+# operators that give the same result with their operands swapped around
+SWAPPED_OPERATORS = {
+    '+': '+',
+    '*': '*',
+    '==': '==',
+    '!=': '!=',
+    '<': '>',
+    '>': '<',
+    '<=': '>=',
+    '>=': '<=',
+}
+
+
+def compile_operands(ctx, a, op, b):
+    """
+    Compiles both sides of a binary operation and returns (a_idx, b_idx, immop).
+
+    If one side is an integer literal and the other ends up in an integer register,
+    the literal doesn't get a register of its own: a_idx is the register, b_idx is
+    the literal's value and immop is the operator to use them with (swapped around
+    if the literal was on the left), for the _IM version of the instruction.
+    Otherwise immop is "".
+    """
+    if isinstance(b, Integer) and not isinstance(a, ConstValue):
+        a_idx = a.compile(ctx)
+        if ctx.is_int(a_idx):
+            return a_idx, b._int, op
+        return a_idx, b.compile(ctx), ""
+    elif isinstance(a, Integer) and not isinstance(b, ConstValue) and op in SWAPPED_OPERATORS:
+        b_idx = b.compile(ctx)
+        if ctx.is_int(b_idx):
+            return b_idx, a._int, SWAPPED_OPERATORS[op]
+        return a.compile(ctx), b_idx, ""
+    a_idx = a.compile(ctx)
+    b_idx = b.compile(ctx)
+    return a_idx, b_idx, ""
+
+
 class ArithExpr(Expression):
+    __slots__ = ()
+
     # all ops listed here must have the same bytecode syntax:
     #     OP  A  B  DEST
     ops = {
@@ -525,8 +657,14 @@ class ArithExpr(Expression):
 
             # otherwise emit bytecode to do this operation at run-time
             else:
-                a_idx = a.compile(ctx)
-                b_idx = b.compile(ctx)
+                a_idx, b_idx, immop = compile_operands(ctx, a, op.data, b)
+                if immop != "":
+                    if immop in ("==", "!=", "<", ">", "<=", ">="):
+                        c_idx = ctx.pushobj(types.DBool())
+                    else:
+                        c_idx = ctx.pushobj(types.DInteger())
+                    ctx.emit("%s_IM" % self.ops[immop], a_idx, b_idx, c_idx)
+                    return c_idx
 
                 a_data = ctx.data[a_idx]
                 b_data = ctx.data[b_idx]
@@ -548,7 +686,11 @@ class ArithExpr(Expression):
                         a_data.__class__.__name__, b_data.__class__.__name__, op.data))
 
                 #c_idx = ctx.pushobj(types.DInteger())
-                ctx.emit(self.ops[op.data], a_idx, b_idx, c_idx)
+                opcode = self.ops[op.data]
+                if opcode in ('ADD', 'SUB', 'MUL', 'DIV'):
+                    ctx.emit_arith(opcode, a_idx, b_idx, c_idx)
+                else:
+                    ctx.emit(opcode, a_idx, b_idx, c_idx)
                 return c_idx
 
         raise NotImplementedError("ArithExpr")
@@ -556,6 +698,8 @@ class ArithExpr(Expression):
 
 
 class BoolExpr(Expression):
+    __slots__ = ()
+
     ops = {
         '==': 'EQ',
         '!=': 'NEQ',
@@ -577,23 +721,72 @@ class BoolExpr(Expression):
                 result = a.mkobj().operator_bool(op.data, b.mkobj())
                 return ctx.pushobj(types.DBool.new_bool(result))
             else:
-                a_idx = a.compile(ctx)
-                b_idx = b.compile(ctx)
-                result_idx = ctx.pushobj(types.DBool())
                 if op.data not in self.ops:
                     raise NotImplementedError("BoolExpr operator '%s'" % op.data)
-                ctx.emit(self.ops[op.data], a_idx, b_idx, result_idx)
+                a_idx, b_idx, immop = compile_operands(ctx, a, op.data, b)
+                result_idx = ctx.pushobj(types.DBool())
+                if immop != "":
+                    ctx.emit("%s_IM" % self.ops[immop], a_idx, b_idx, result_idx)
+                else:
+                    ctx.emit(self.ops[op.data], a_idx, b_idx, result_idx)
                 return result_idx
 
         raise NotImplementedError("BoolExpr")
         return -1
 
 
+# compare-and-branch instructions that jump when a comparison is false
+BRANCH_IF_NOT = {
+    '==': 'BNE',
+    '!=': 'BEQ',
+    '<': 'BGE',
+    '>': 'BLE',
+    '<=': 'BGT',
+    '>=': 'BLT',
+}
+
+# comparisons whose opposite is only their negation for ints: with a NaN, both
+# a < b and a >= b are false
+ORDERED_OPERATORS = ("<", ">", "<=", ">=")
+
+
+def compile_branch_if_false(ctx, node):
+    """
+    Compiles a condition followed by a branch that's taken if the condition is false.
+    The branch target is left invalid to be fixed up with setbranch. Simple
+    comparisons turn into a single compare-and-branch instruction instead of a
+    comparison into a bool register followed by a BF, as long as the opposite
+    comparison gives the right answer for the operands.
+
+    Returns the instruction pointer of the branch.
+    """
+    if (isinstance(node, ArithExpr) or isinstance(node, BoolExpr)) and len(node.children) == 3:
+        a = node.children[0]
+        op = node.children[1]
+        b = node.children[2]
+        # comparing two constants gets done at compile time anyway
+        if op.data in BRANCH_IF_NOT and not (isinstance(a, ConstValue) and isinstance(b, ConstValue)):
+            Node.compile(node, ctx)
+            a_idx, b_idx, immop = compile_operands(ctx, a, op.data, b)
+            if immop != "":
+                return ctx.emit("%s_IM" % BRANCH_IF_NOT[immop], a_idx, b_idx, -1)
+            if op.data not in ORDERED_OPERATORS or (ctx.is_int(a_idx) and ctx.is_int(b_idx)):
+                return ctx.emit(BRANCH_IF_NOT[op.data], a_idx, b_idx, -1)
+            boolidx = ctx.pushobj(types.DBool())
+            ctx.emit(BoolExpr.ops[op.data], a_idx, b_idx, boolidx)
+            return ctx.emit_BF(boolidx, -1)
+
+    boolidx = node.compile(ctx)
+    return ctx.emit_BF(boolidx, -1)
+
+
 class Statement(Node):
-    pass
+    __slots__ = ()
 
 
 class CallStatement(Statement):
+    __slots__ = ()
+
     def compile(self, ctx):
         Node.compile(self, ctx)
         assert len(self.children) == 1
@@ -603,6 +796,8 @@ class CallStatement(Statement):
 
 
 class Assignment(Statement):
+    __slots__ = ("typedName",)
+
     def set(self, nodes):
         assert len(nodes) == 3
         self.typedName = nodes.pop(0)
@@ -616,7 +811,7 @@ class Assignment(Statement):
         if not op.data == "=":
             raise ValueError("Assignments expect a '=' operator (got %s)" % op.data)
 
-        self.children.append(expr)
+        self.addchild(expr)
 
     def compile(self, ctx):
         Node.compile(self, ctx)
@@ -631,6 +826,8 @@ class Assignment(Statement):
 
 
 class Inplace(Statement):
+    __slots__ = ("op",)
+
     ops = {
         '+=': 'ADD',
         '-=': 'SUB',
@@ -638,6 +835,14 @@ class Inplace(Statement):
         '/=': 'DIV',
     }
 
+    # in-place instructions for an integer variable and an integer literal
+    immediate_ops = {
+        '+=': 'ADDI',
+        '-=': 'SUBI',
+        '*=': 'MULI',
+        '/=': 'DIVI',
+    }
+
     def set(self, nodes):
         assert len(nodes) == 3
         name = nodes.pop(0)
@@ -649,9 +854,9 @@ class Inplace(Statement):
 
         self.op = op.data
         if len(expr) == 1:
-            self.children.append(expr.children[0])
+            self.addchild(expr.children[0])
         else:
-            self.children.append(expr)
+            self.addchild(expr)
 
     def compile(self, ctx):
         Node.compile(self, ctx)
@@ -659,8 +864,11 @@ class Inplace(Statement):
 
         if len(self) == 1:
             node = self.children[0]
+            if isinstance(node, Integer) and ctx.is_int(varidx):
+                ctx.emit(self.immediate_ops[self.op], varidx, node._int)
+                return -1
             resultidx = node.compile(ctx)
-            ctx.emit(self.ops[self.op], varidx, resultidx, varidx)
+            ctx.emit_arith(self.ops[self.op], varidx, resultidx, varidx)
             return -1
 
         raise NotImplementedError
@@ -671,6 +879,8 @@ class Inplace(Statement):
 
 
 class Print(Statement):
+    __slots__ = ("add_newline",)
+
     def init(self):
         self.add_newline = True
 
@@ -682,10 +892,10 @@ class Print(Statement):
         if nodes[-1].type == "Operator" and nodes[-1].data == ",":
             self.add_newline = False
             for node in nodes[:-1]:
-                self.children.append(node)
+                self.addchild(node)
         else:
             for node in nodes:
-                self.children.append(node)
+                self.addchild(node)
 
     def compile(self, ctx):
         Node.compile(self, ctx)
@@ -710,15 +920,28 @@ class Print(Statement):
 
 
 class Return(Statement):
+    __slots__ = ()
+
     def compile(self, ctx):
         Node.compile(self, ctx)
         assert len(self.children) == 1
+        child = self.children[0]
+        # a lone value comes wrapped in an ArithExpr
+        while isinstance(child, ArithExpr) and len(child.children) == 1:
+            child = child.children[0]
+        if isinstance(child, Call) and child.is_tailcall(ctx):
+            # the called function's frame takes over this one, and returns
+            # straight to whoever called this function
+            child.compile_tailcall(ctx)
+            return -1
         idx = self.children[0].compile(ctx)
         ctx.emit_RET(idx)
         return -1
 
 
 class ConstValue(Node):
+    __slots__ = ()
+
     def mkobj(self):
         """
         Subclasses should implement this and return a new typesystem object based on their type
@@ -727,6 +950,8 @@ class ConstValue(Node):
 
 
 class Integer(ConstValue):
+    __slots__ = ("_int",)
+
     def init(self):
         self._int = int(self.data.rstrip("i"))
 
@@ -742,6 +967,8 @@ class Integer(ConstValue):
 
 
 class Float(ConstValue):
+    __slots__ = ("_float",)
+
     def init(self):
         self._float = float(self.data.rstrip("f"))
 
@@ -757,6 +984,8 @@ class Float(ConstValue):
 
 
 class String(ConstValue):
+    __slots__ = ("_str",)
+
     def init(self):
         # need to strip doublequotes from data
         self._str = ""
@@ -780,6 +1009,8 @@ class String(ConstValue):
 
 
 class Call(Node):
+    __slots__ = ("target",)
+
     def set(self, nodes):
         assert len(nodes) >= 1
         self.target = nodes.pop(0)
@@ -787,7 +1018,7 @@ class Call(Node):
         if len(nodes) > 0:
             args = nodes.pop(0)
             for node in args:
-                self.children.append(node)
+                self.addchild(node)
 
     def compile(self, ctx):
         Node.compile(self, ctx)
@@ -800,15 +1031,7 @@ class Call(Node):
                 args.append(arg)
             return FuncCls(args).compile(ctx)
 
-        arglist = types.DList()
-        args = []
-        for arg in self.children:
-            args.append(arg.compile(ctx))
-        assert len(args) == len(self.children)
-
-        arglistidx = ctx.pushobj(types.DList())
-        for argvalidx in args:
-            ctx.emit_LIST_ADD(arglistidx, argvalidx)
+        arglistidx = self._compile_args(ctx)
 
         # get return value type
         if ctx.namespace.contains_func(name):
@@ -836,16 +1059,49 @@ class Call(Node):
             # no function found
             raise ValueError("No function found named '%s'" % name)
 
+    def _compile_args(self, ctx):
+        """
+        Compiles the arguments and packs them into a list, returns the list's data
+        register
+        """
+        args = []
+        for arg in self.children:
+            args.append(arg.compile(ctx))
+        assert len(args) == len(self.children)
+
+        arglistidx = ctx.pushobj(types.DList())
+        for argvalidx in args:
+            ctx.emit_LIST_ADD(arglistidx, argvalidx)
+        return arglistidx
+
+    def is_tailcall(self, ctx):
+        """
+        Returns True if returning the result of this call can be compiled into a
+        TAILCALL: it has to call a function that returns a value
+        """
+        name = self.target.getName()
+        if has_builtin(name) or not ctx.namespace.contains_func(name):
+            return False
+        return ctx.namespace.get_func(name).get_return_type_name() != "auto"
+
+    def compile_tailcall(self, ctx):
+        Node.compile(self, ctx)
+        arglistidx = self._compile_args(ctx)
+        funcnameidx = ctx.pushobj(types.DString.new_str(self.target.getName()))
+        ctx.emit_TAILCALL(funcnameidx, arglistidx)
+
 
     def _getRepr(self):
         return [self.target.getDottedName()]
 
 
 class CallArgs(Node):
-    pass
+    __slots__ = ()
 
 
 class Operator(Node):
+    __slots__ = ()
+
     def _getRepr(self):
         return ["'%s'" % self.data]
 
@@ -854,6 +1110,8 @@ class VarName(Node):
     """
     Abstract parent class of Name and DottedName to provide the same interface for both
     """
+    __slots__ = ()
+
     def getName(self):
         """
         Return the name of the item (the last part of a dotted name or the only part of a regular name)
@@ -880,6 +1138,8 @@ class VarName(Node):
 
 
 class Name(VarName):
+    __slots__ = ("_name",)
+
     def init(self):
         self._name = self.data
 
@@ -904,10 +1164,12 @@ class Name(VarName):
 
 
 class DottedName(VarName):
+    __slots__ = ()
+
     def set(self, names):
         for name in names:
             if name.type == "Name":
-                self.children.append(name)
+                self.addchild(name)
             else:
                 raise TypeError(name.type)
 
@@ -932,6 +1194,8 @@ class DottedName(VarName):
 
 
 class TypedName(VarName):
+    __slots__ = ("_name", "_type")
+
     def set(self, nodes):
         assert len(nodes) == 1 or len(nodes) == 2
         self._name = nodes.pop(0)
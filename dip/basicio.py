@@ -17,6 +17,11 @@ if we_are_translated():
         except WindowsError as e:
             return ""
 
+    def writeall(filename, data):
+        fp = open_file_as_stream(filename, "w")
+        fp.write(data)
+        fp.close()
+
 else:
     def readall(filename):
         if not file_exists(filename):
@@ -26,6 +31,11 @@ else:
         fp.close()
         return data
 
+    def writeall(filename, data):
+        fp = open(filename, 'wb')
+        fp.write(data)
+        fp.close()
+
 
 def file_exists(path):
     try:
@@ -1,19 +1,29 @@
 
+from errors import find_line_index
+
 # VM instructions
 INSTRUCTION_SET = [
     'PASS',
     'LABEL',
     'CALL',
+    'TAILCALL',
     'BT',
     'BF',
     'BEQ',
     'BNE',
+    'BLT', 'BGT', 'BLE', 'BGE',
+    'BEQ_IM', 'BNE_IM', 'BLT_IM', 'BGT_IM', 'BLE_IM', 'BGE_IM',
     'JMP',
     'RET',
     'SET',
     'ADDI', 'SUBI', 'MULI', 'DIVI',
     'ADD', 'SUB', 'MUL', 'DIV',
+    'ADD_II', 'SUB_II', 'MUL_II', 'DIV_II',
+    'ADD_FF', 'SUB_FF', 'MUL_FF', 'DIV_FF',
+    'ADD_IM', 'SUB_IM', 'MUL_IM', 'DIV_IM',
+    'CONCAT_SS',
     'EQ', 'NEQ', 'GT', 'LT', 'GTE', 'LTE',
+    'EQ_IM', 'NEQ_IM', 'GT_IM', 'LT_IM', 'GTE_IM', 'LTE_IM',
     'SQRT',
     'LEN',
     'EXIT',
@@ -38,6 +48,146 @@ for i, inst in enumerate(INSTRUCTION_SET):
     INST_STRS[i] = inst
 
 
+# What each instruction does with its operands, one character each for a, b and c:
+#   r: reads the data register
+#   w: overwrites the value of the data register in place
+#   m: reads the data register and modifies it in place
+#   e: reads the data register and stores the object itself somewhere else
+#   x: replaces the data register with a different object
+#   j: bytecode instruction pointer to branch to
+#   i: immediate integer value (or stream index)
+#   -: unused
+OPERANDS = {
+    'PASS':     "---",
+    'LABEL':    "---",
+    'CALL':     "rrx",
+    'TAILCALL': "rr-",
+    'BT':       "rj-",
+    'BF':       "rj-",
+    'BEQ':      "rrj",
+    'BNE':      "rrj",
+    'BLT':      "rrj",
+    'BGT':      "rrj",
+    'BLE':      "rrj",
+    'BGE':      "rrj",
+    'BEQ_IM':   "rij",
+    'BNE_IM':   "rij",
+    'BLT_IM':   "rij",
+    'BGT_IM':   "rij",
+    'BLE_IM':   "rij",
+    'BGE_IM':   "rij",
+    'JMP':      "j--",
+    'RET':      "r--",
+    'SET':      "rw-",
+    'ADDI':     "mi-",
+    'SUBI':     "mi-",
+    'MULI':     "mi-",
+    'DIVI':     "mi-",
+    'ADD':      "rrw",
+    'SUB':      "rrw",
+    'MUL':      "rrw",
+    'DIV':      "rrw",
+    'ADD_II':   "rrw",
+    'SUB_II':   "rrw",
+    'MUL_II':   "rrw",
+    'DIV_II':   "rrw",
+    'ADD_FF':   "rrw",
+    'SUB_FF':   "rrw",
+    'MUL_FF':   "rrw",
+    'DIV_FF':   "rrw",
+    'ADD_IM':   "riw",
+    'SUB_IM':   "riw",
+    'MUL_IM':   "riw",
+    'DIV_IM':   "riw",
+    'CONCAT_SS': "rrw",
+    'EQ':       "rrw",
+    'NEQ':      "rrw",
+    'GT':       "rrw",
+    'LT':       "rrw",
+    'GTE':      "rrw",
+    'LTE':      "rrw",
+    'EQ_IM':    "riw",
+    'NEQ_IM':   "riw",
+    'GT_IM':    "riw",
+    'LT_IM':    "riw",
+    'GTE_IM':   "riw",
+    'LTE_IM':   "riw",
+    'SQRT':     "rw-",
+    'LEN':      "rw-",
+    'EXIT':     "r--",
+    'WRITEI':   "ir-",
+    'WRITEO':   "ir-",
+    'WRITENL':  "i--",
+    'LIST_NEW': "x--",
+    'LIST_ADD': "me-",
+    'LIST_REM': "mr-",
+    'LIST_POP': "mrx",
+}
+
+# operand kinds by int instruction code
+INST_OPERANDS = {}
+for inst in INSTRUCTION_SET:
+    INST_OPERANDS[INST[inst]] = OPERANDS[inst]
+
+
+# "r" and "e" operands at or below CONST_BASE refer to the module's constant pool
+# instead of a data register (-1 is used for "no register")
+CONST_BASE = -2
+
+
+def const_operand(idx):
+    """ Returns the operand value that refers to constant pool entry idx """
+    return CONST_BASE - idx
+
+
+def const_index(operand):
+    """ Returns the constant pool index a constant operand refers to """
+    return CONST_BASE - operand
+
+
+def is_const(operand):
+    return operand <= CONST_BASE
+
+
+def owned_registers(bytecode, numregs):
+    """
+    Returns a list of flags, one per data register, that are True for the registers
+    the bytecode may modify, replace or hand out to other code (including returning
+    them). Every frame needs its own copy of those; the rest can safely be shared
+    with the function's template registers.
+    """
+    owned = [False] * numregs
+    for inst, a, b, c in bytecode:
+        kinds = INST_OPERANDS[inst]
+        operands = [a, b, c]
+        for i in range(3):
+            kind = kinds[i]
+            if operands[i] < 0:
+                continue
+            if kind == "w" or kind == "m" or kind == "e" or kind == "x":
+                owned[operands[i]] = True
+            elif kind == "r" and inst == RET:
+                # the caller is free to modify whatever it gets back
+                owned[operands[i]] = True
+    return owned
+
+
+def format_operands(inst, a, b, c, consts):
+    """
+    Returns a list of strings describing an instruction's operands, for debug output
+    """
+    kinds = INST_OPERANDS[inst]
+    operands = [a, b, c]
+    args = []
+    for i in range(3):
+        val = operands[i]
+        if (kinds[i] == "r" or kinds[i] == "e") and is_const(val):
+            args.append("const %s" % consts[const_index(val)].repr_py())
+        elif val != -1 or kinds[i] == "i":
+            args.append(str(val))
+    return args
+
+
 OPERATOR_MAP = {
     ADD: "+",
     SUB: "-",
@@ -49,11 +199,194 @@ OPERATOR_MAP = {
     LT: "<",
     GTE: ">=",
     LTE: "<=",
+    BEQ: "==",
+    BNE: "!=",
+    BLT: "<",
+    BGT: ">",
+    BLE: "<=",
+    BGE: ">=",
+    ADD_IM: "+",
+    SUB_IM: "-",
+    MUL_IM: "*",
+    DIV_IM: "/",
+    EQ_IM: "==",
+    NEQ_IM: "!=",
+    GT_IM: ">",
+    LT_IM: "<",
+    GTE_IM: ">=",
+    LTE_IM: "<=",
+    BEQ_IM: "==",
+    BNE_IM: "!=",
+    BLT_IM: "<",
+    BGT_IM: ">",
+    BLE_IM: "<=",
+    BGE_IM: ">=",
 }
 
 
+# Stands in for a piece of source text in an instruction's comment, like the
+# condition of an if statement. Only its (line, column) is kept; the text itself is
+# read from the source when the bytecode gets disassembled.
+SOURCE_MARKER = "\x00"
+
+
+def _source_text(filename, ref):
+    """
+    Returns the source from ref to the end of its line, without the brace that
+    opens a block, or an empty string if the source isn't available
+    """
+    lineno, colno = ref
+    index = find_line_index(filename)
+    if index is None or lineno < 0 or colno < 0:
+        return ""
+    line = index.getline(lineno)
+    if colno > len(line):
+        return ""
+    text = line[colno:].strip()
+    if text.endswith("{"):
+        end = len(text) - 1
+        assert end >= 0
+        text = text[:end].strip()
+    return text
+
+
 class BytecodeAnnotation(object):
-    def __init__(self, filename, source, comment=""):
+    def __init__(self, filename, source, comment="", refs=None):
         self.filename = filename
         self.source = source
         self.comment = comment
+        # the (line, column) of the source that goes in place of each SOURCE_MARKER
+        # in the comment, in order
+        if refs is None:
+            refs = []
+        self.refs = refs
+
+    def prefixed(self, label):
+        """
+        Returns this annotation with the comment from label put in front of its own
+        """
+        if label is None or len(label.comment) == 0:
+            return self
+        comment = label.comment
+        if len(self.comment) > 0:
+            comment = "%s; %s" % (label.comment, self.comment)
+        return BytecodeAnnotation(self.filename, self.source, comment=comment,
+            refs=label.refs + self.refs)
+
+    def describe(self):
+        """
+        Returns the comment as it should be shown, with the source it refers to
+        filled in
+        """
+        if SOURCE_MARKER not in self.comment:
+            return self.comment
+        parts = self.comment.split(SOURCE_MARKER)
+        text = [parts[0]]
+        for i in range(1, len(parts)):
+            if i - 1 < len(self.refs):
+                text.append(_source_text(self.filename, self.refs[i - 1]))
+            text.append(parts[i])
+        return "".join(text)
+
+
+class LineTable(object):
+    """
+    Where each instruction of a compiled function came from, stored compactly along
+    the lines of CPython's lnotab. Consecutive instructions from the same place in
+    the source share one entry, the filename is kept once for the whole function,
+    and only the instructions that have a comment hold on to their annotation.
+    """
+    def __init__(self, filename, runs, comments):
+        self.filename = filename
+        # (first instruction, line, column) for each run of instructions that came
+        # from the same place, flattened into a single list
+        self.runs = runs
+        # instruction pointer -> annotation, for the instructions with a comment
+        self.comments = comments
+
+    @staticmethod
+    def encode(filename, bytecode_info):
+        """
+        Builds the table for a function from the compiler's per-instruction
+        annotations
+        """
+        runs = []
+        comments = {}
+        lastline = -2
+        lastcol = -2
+        for ptr in range(len(bytecode_info)):
+            info = bytecode_info[ptr]
+            lineno, colno = info.source
+            if lineno != lastline or colno != lastcol:
+                runs.append(ptr)
+                runs.append(lineno)
+                runs.append(colno)
+                lastline = lineno
+                lastcol = colno
+            if len(info.comment) > 0:
+                comments[ptr] = info
+        return LineTable(filename, runs, comments)
+
+    def _find_run(self, ptr):
+        """
+        Returns the index in runs of the entry covering ptr, or -1 if there isn't one
+        """
+        lo = 0
+        hi = len(self.runs) / 3
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self.runs[mid * 3] <= ptr:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return -1
+        return (lo - 1) * 3
+
+    def getsource(self, ptr):
+        """
+        Returns the (line, column) the instruction at ptr was compiled from
+        """
+        idx = self._find_run(ptr)
+        if idx == -1:
+            return (-1, -1)
+        return (self.runs[idx + 1], self.runs[idx + 2])
+
+    def describe(self, ptr):
+        """
+        Returns the comment for the instruction at ptr as it should be shown
+        """
+        if ptr not in self.comments:
+            return ""
+        return self.comments[ptr].describe()
+
+    def annotation(self, ptr):
+        """
+        Returns a BytecodeAnnotation for the instruction at ptr, for the passes that
+        rework a function's bytecode after it's been compiled
+        """
+        if ptr in self.comments:
+            return self.comments[ptr]
+        return BytecodeAnnotation(self.filename, self.getsource(ptr))
+
+    def shifted(self, delta):
+        """
+        Returns a copy of the table with every known line moved by delta
+        """
+        runs = [ val for val in self.runs ]
+        for idx in range(0, len(runs), 3):
+            if runs[idx + 1] > -1:
+                runs[idx + 1] += delta
+        comments = {}
+        for ptr, info in self.comments.items():
+            refs = [ _shift_source(ref, delta) for ref in info.refs ]
+            comments[ptr] = BytecodeAnnotation(info.filename, _shift_source(info.source, delta),
+                comment=info.comment, refs=refs)
+        return LineTable(self.filename, runs, comments)
+
+
+def _shift_source(source, delta):
+    lineno, colno = source
+    if lineno > -1:
+        lineno += delta
+    return (lineno, colno)
@@ -0,0 +1,341 @@
+"""
+Compiled module cache (.dipc files)
+
+A .dipc file holds everything Module.from_ast produces for a source file, so that
+running the same script again can skip parsing and compiling entirely. The file is
+keyed by the compiler version, the optimization level and a hash of the source
+text; if any of them don't match, the cache is ignored and rebuilt.
+
+Format:
+    A flat stream of fields. Integers are written as "<int>\\n" and strings are
+    length-prefixed as "<len>:<bytes>\\n" so they can contain any character.
+"""
+from rpython.rlib.objectmodel import we_are_translated
+from rpython.rlib.rfloat import formatd, string_to_float
+from rpython.rlib.rmd5 import RMD5
+
+import basicio
+import typesystem as types
+from bytecode import BytecodeAnnotation, LineTable
+from compiler import COMPILER_VERSION
+from passes import DEFAULT_OPT_LEVEL
+from namespace import Module
+
+MAGIC = "DIPC"
+
+# data register type tags
+TAG_NULL = 0
+TAG_BOOL = 1
+TAG_INT = 2
+TAG_FLOAT = 3
+TAG_STR = 4
+TAG_LIST = 5
+TAG_STRUCT = 6
+TAG_UNKNOWN = 7
+
+
+class CacheError(Exception):
+    pass
+
+
+def cache_path(filename):
+    """
+    Returns the .dipc path for the given source file
+    """
+    if filename.endswith(".dip"):
+        return filename + "c"
+    return filename + ".dipc"
+
+
+def source_key(source, opt_level=DEFAULT_OPT_LEVEL):
+    """
+    Returns the cache key for the given source text, compiled at the given
+    optimization level
+    """
+    return "%s-O%s-%s" % (COMPILER_VERSION, opt_level, RMD5(source).hexdigest())
+
+
+class Writer(object):
+    def __init__(self):
+        self.parts = []
+
+    def write_int(self, val):
+        self.parts.append("%d\n" % val)
+
+    def write_str(self, val):
+        self.parts.append("%d:%s\n" % (len(val), val))
+
+    def write_strlist(self, vals):
+        self.write_int(len(vals))
+        for val in vals:
+            self.write_str(val)
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def _readto(self, sep):
+        end = self.data.find(sep, self.pos)
+        if end < 0:
+            raise CacheError("Truncated cache file")
+        start = self.pos
+        assert start >= 0
+        self.pos = end + 1
+        return self.data[start:end]
+
+    def read_int(self):
+        try:
+            return int(self._readto("\n"))
+        except ValueError:
+            raise CacheError("Malformed integer in cache file")
+
+    def read_str(self):
+        try:
+            length = int(self._readto(":"))
+        except ValueError:
+            raise CacheError("Malformed string length in cache file")
+        start = self.pos
+        end = start + length
+        if length < 0 or end >= len(self.data) or self.data[end] != "\n":
+            raise CacheError("Malformed string in cache file")
+        assert start >= 0 and end >= 0
+        self.pos = end + 1
+        return self.data[start:end]
+
+    def read_strlist(self):
+        vals = []
+        for _ in range(self.read_int()):
+            vals.append(self.read_str())
+        return vals
+
+
+def _write_value(w, val):
+    if isinstance(val, types.DNull):
+        w.write_int(TAG_NULL)
+    elif isinstance(val, types.DBool):
+        w.write_int(TAG_BOOL)
+        w.write_int(val.int_py())
+    elif isinstance(val, types.DInteger):
+        w.write_int(TAG_INT)
+        w.write_int(val.int_py())
+    elif isinstance(val, types.DFloat):
+        w.write_int(TAG_FLOAT)
+        w.write_str(formatd(val.float_py(), 'r', 0))
+    elif isinstance(val, types.DString):
+        w.write_int(TAG_STR)
+        w.write_str(val.str_py())
+    elif isinstance(val, types.DList):
+        w.write_int(TAG_LIST)
+        w.write_int(val.len_py())
+        for i in range(val.len_py()):
+            _write_value(w, val.getitem_pyidx(i))
+    elif isinstance(val, types.DStructInstance):
+        w.write_int(TAG_STRUCT)
+        w.write_str(val.structdef.name)
+    elif isinstance(val, types.DUnknown):
+        w.write_int(TAG_UNKNOWN)
+    else:
+        raise CacheError("Cannot cache data register of type %s" % val.basetype)
+
+
+def _read_value(r, module):
+    tag = r.read_int()
+    if tag == TAG_NULL:
+        return types.DNull()
+    elif tag == TAG_BOOL:
+        return types.DBool.new_bool(r.read_int() != 0)
+    elif tag == TAG_INT:
+        return types.DInteger.new_int(r.read_int())
+    elif tag == TAG_FLOAT:
+        return types.DFloat.new_float(string_to_float(r.read_str()))
+    elif tag == TAG_STR:
+        return types.DString.new_str(r.read_str())
+    elif tag == TAG_LIST:
+        lst = types.DList()
+        for _ in range(r.read_int()):
+            lst.append(_read_value(r, module))
+        return lst
+    elif tag == TAG_STRUCT:
+        name = r.read_str()
+        if not module.contains_struct(name):
+            raise CacheError("Unknown struct '%s' in cache file" % name)
+        return types.DStructInstance.new_struct(module.get_struct(name))
+    elif tag == TAG_UNKNOWN:
+        return types.DUnknown()
+    else:
+        raise CacheError("Unknown data register tag %s in cache file" % tag)
+
+
+def dump_module(module, filename, key):
+    """
+    Serializes a compiled module to a string
+    """
+    w = Writer()
+    w.write_str(MAGIC)
+    w.write_str(key)
+    w.write_str(module.name)
+    w.write_str(filename)
+
+    w.write_int(len(module.structs))
+    for name, struct in module.structs.items():
+        w.write_str(name)
+        w.write_int(struct.numfields)
+        w.write_int(len(struct.fielddefs))
+        for fieldname, FieldCls in struct.fielddefs.items():
+            w.write_str(fieldname)
+            w.write_str(FieldCls.typename)
+
+    w.write_int(len(module.constpool.values))
+    for val in module.constpool.values:
+        _write_value(w, val)
+
+    w.write_int(len(module.funcs))
+    for name, func in module.funcs.items():
+        w.write_str(name)
+        w.write_int(len(func.args))
+        for argname, fulltype in func.args:
+            w.write_str(argname)
+            w.write_strlist(fulltype)
+        w.write_strlist(func.rettype)
+
+        w.write_int(len(func.bytecode))
+        for inst, a, b, c in func.bytecode:
+            w.write_int(inst)
+            w.write_int(a)
+            w.write_int(b)
+            w.write_int(c)
+
+        # the line table, and the comments of the instructions that have one
+        w.write_int(len(func.lines.runs))
+        for val in func.lines.runs:
+            w.write_int(val)
+        w.write_int(len(func.lines.comments))
+        for ptr, info in func.lines.comments.items():
+            w.write_int(ptr)
+            w.write_int(info.source[0])
+            w.write_int(info.source[1])
+            w.write_str(info.comment)
+            w.write_int(len(info.refs))
+            for lineno, colno in info.refs:
+                w.write_int(lineno)
+                w.write_int(colno)
+
+        w.write_int(len(func.data))
+        for val in func.data:
+            _write_value(w, val)
+
+        w.write_int(len(func.vars))
+        for varname, idx in func.vars.items():
+            w.write_str(varname)
+            w.write_int(idx)
+
+    return w.getvalue()
+
+
+def load_module(data, key):
+    """
+    Rebuilds a compiled module from a string created by dump_module. Returns None
+    if the data was written for a different source file or compiler version.
+    """
+    r = Reader(data)
+    if r.read_str() != MAGIC:
+        raise CacheError("Not a dipc file")
+    if r.read_str() != key:
+        return None
+
+    module = Module(r.read_str())
+    filename = r.read_str()
+
+    for _ in range(r.read_int()):
+        name = r.read_str()
+        struct = types.StructDef(name, r.read_int())
+        for _ in range(r.read_int()):
+            fieldname = r.read_str()
+            struct.setfield(fieldname, types.AutoType(r.read_str()))
+        module.set_struct(name, struct)
+
+    for _ in range(r.read_int()):
+        module.constpool.add(_read_value(r, module))
+
+    for _ in range(r.read_int()):
+        name = r.read_str()
+        funcargs = []
+        for _ in range(r.read_int()):
+            argname = r.read_str()
+            funcargs.append((argname, r.read_strlist()))
+        func = types.DFunc.new_func(name, funcargs, r.read_strlist())
+
+        bytecode = []
+        for _ in range(r.read_int()):
+            inst = r.read_int()
+            a = r.read_int()
+            b = r.read_int()
+            c = r.read_int()
+            bytecode.append((inst, a, b, c))
+
+        runs = []
+        for _ in range(r.read_int()):
+            runs.append(r.read_int())
+        comments = {}
+        for _ in range(r.read_int()):
+            ptr = r.read_int()
+            lineno = r.read_int()
+            colno = r.read_int()
+            comment = r.read_str()
+            refs = []
+            for _ in range(r.read_int()):
+                reflineno = r.read_int()
+                refs.append((reflineno, r.read_int()))
+            comments[ptr] = BytecodeAnnotation(filename, (lineno, colno), comment=comment,
+                refs=refs)
+
+        data = []
+        for _ in range(r.read_int()):
+            data.append(_read_value(r, module))
+
+        funcvars = {}
+        for _ in range(r.read_int()):
+            varname = r.read_str()
+            funcvars[varname] = r.read_int()
+
+        func.set_code(bytecode, LineTable(filename, runs, comments), data, funcvars,
+            module.constpool.values)
+        module.set_func(name, func)
+
+    return module
+
+
+def read_cache(filename, key):
+    """
+    Returns the cached module for the given source file, or None if there is no
+    up-to-date cache for it.
+    """
+    path = cache_path(filename)
+    if not basicio.file_exists(path):
+        return None
+    try:
+        return load_module(basicio.readall(path), key)
+    except CacheError:
+        return None
+    except IOError:
+        return None
+
+
+def write_cache(filename, key, module):
+    """
+    Writes out the cache file for a freshly compiled module. Failing to write the
+    cache (read-only directory, etc) is not an error.
+    """
+    try:
+        basicio.writeall(cache_path(filename), dump_module(module, filename, key))
+    except CacheError:
+        pass
+    except IOError:
+        pass
+    except OSError:
+        pass
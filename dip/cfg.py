@@ -0,0 +1,515 @@
+"""
+Control-flow graph for compiled bytecode
+
+The AST compiles straight to a flat list of instructions, with branches patched in
+by instruction pointer. That's the format the interpreter wants, but not a good
+one for working out how control can flow through a function. A ControlFlowGraph
+is built from that bytecode after the fact (the AST isn't lowered into blocks
+directly, so the jump patching it does stays as it is): it splits it into basic
+blocks (runs of instructions that always execute together) with explicit edges
+between them, and works out dominators, natural loops and def-use chains over them.
+linearize() lays the blocks back out as bytecode, in an order that lets control
+fall through from one block to the next wherever it can.
+
+Inside a block, the branch operand of the last instruction holds the index of the
+block it branches to rather than an instruction pointer.
+"""
+from bytecode import INST, INST_OPERANDS, BytecodeAnnotation
+from peephole import branch_operand, _set_operand
+
+# conditional branches, and the branch that jumps in exactly the other cases. the
+# ordered comparisons of two registers aren't here: not every type that has '<'
+# has a '>=' that's its opposite. integers do.
+INVERTED_BRANCHES = {
+    INST['BT']: INST['BF'],
+    INST['BF']: INST['BT'],
+    INST['BEQ']: INST['BNE'],
+    INST['BNE']: INST['BEQ'],
+    INST['BEQ_IM']: INST['BNE_IM'],
+    INST['BNE_IM']: INST['BEQ_IM'],
+    INST['BLT_IM']: INST['BGE_IM'],
+    INST['BGE_IM']: INST['BLT_IM'],
+    INST['BGT_IM']: INST['BLE_IM'],
+    INST['BLE_IM']: INST['BGT_IM'],
+}
+
+# def-use id of the value a register starts out with (its template or argument)
+ENTRY_DEF = -1
+
+
+def falls_through(inst):
+    return inst != INST['JMP'] and inst != INST['RET'] and inst != INST['TAILCALL'] and \
+        inst != INST['EXIT']
+
+
+class BasicBlock(object):
+    def __init__(self, index, start):
+        self.index = index
+        # where the block started in the bytecode it was built from
+        self.start = start
+        self.insts = []
+        self.info = []
+        # the block control falls into at the end of this one, and the one the last
+        # instruction branches to. -1 if there isn't one.
+        self.fallthrough = -1
+        self.target = -1
+        # indices of the blocks that can run right before this one
+        self.preds = []
+
+    def succs(self):
+        result = []
+        if self.fallthrough != -1:
+            result.append(self.fallthrough)
+        if self.target != -1 and self.target != self.fallthrough:
+            result.append(self.target)
+        return result
+
+    def last(self):
+        """ Returns the last instruction in the block """
+        return self.insts[len(self.insts) - 1]
+
+    def exits(self):
+        """ Returns True if the block ends by leaving the function """
+        if len(self.insts) == 0:
+            return False
+        inst = self.last()[0]
+        return inst == INST['RET'] or inst == INST['TAILCALL'] or inst == INST['EXIT']
+
+
+class ControlFlowGraph(object):
+    def __init__(self, bytecode, bytecode_info=None):
+        numinsts = len(bytecode)
+        self.blocks = []
+
+        # blocks start at the beginning, at every branch target and right after
+        # every branch
+        leader = [False] * (numinsts + 1)
+        leader[0] = True
+        for ptr in range(numinsts):
+            inst, a, b, c = bytecode[ptr]
+            idx = branch_operand(inst)
+            if idx != -1:
+                operands = [a, b, c]
+                leader[operands[idx]] = True
+            if idx != -1 or not falls_through(inst):
+                leader[ptr + 1] = True
+
+        blockof = [0] * (numinsts + 1)
+        for ptr in range(numinsts + 1):
+            if leader[ptr] and (ptr < numinsts or len(self.blocks) == 0 or
+                    self._branches_to_end(bytecode)):
+                self.blocks.append(BasicBlock(len(self.blocks), ptr))
+            blockof[ptr] = len(self.blocks) - 1
+
+        for ptr in range(numinsts):
+            block = self.blocks[blockof[ptr]]
+            instruction = bytecode[ptr]
+            idx = branch_operand(instruction[0])
+            if idx != -1:
+                inst, a, b, c = instruction
+                operands = [a, b, c]
+                block.target = blockof[operands[idx]]
+                instruction = _set_operand(instruction, idx, block.target)
+            block.insts.append(instruction)
+            if bytecode_info is not None:
+                block.info.append(bytecode_info[ptr])
+
+        for block in self.blocks:
+            if len(block.insts) == 0 or falls_through(block.last()[0]):
+                if block.index + 1 < len(self.blocks):
+                    block.fallthrough = block.index + 1
+        for block in self.blocks:
+            for succ in block.succs():
+                self.blocks[succ].preds.append(block.index)
+
+    def _branches_to_end(self, bytecode):
+        for inst, a, b, c in bytecode:
+            idx = branch_operand(inst)
+            if idx != -1:
+                operands = [a, b, c]
+                if operands[idx] == len(bytecode):
+                    return True
+        return False
+
+    def reachable(self):
+        """
+        Returns a list of flags that are True for the blocks that can be reached from
+        the entry block
+        """
+        reachable = [False] * len(self.blocks)
+        if len(self.blocks) == 0:
+            return reachable
+        reachable[0] = True
+        todo = [0]
+        while len(todo) > 0:
+            block = self.blocks[todo.pop()]
+            for succ in block.succs():
+                if not reachable[succ]:
+                    reachable[succ] = True
+                    todo.append(succ)
+        return reachable
+
+    def postorder(self):
+        """
+        Returns the indices of the reachable blocks in depth-first postorder
+        """
+        order = []
+        if len(self.blocks) == 0:
+            return order
+        visited = [False] * len(self.blocks)
+        visited[0] = True
+        # stack of (block index, index of the next successor to visit)
+        stack = [(0, 0)]
+        while len(stack) > 0:
+            index, nextsucc = stack.pop()
+            succs = self.blocks[index].succs()
+            if nextsucc < len(succs):
+                stack.append((index, nextsucc + 1))
+                succ = succs[nextsucc]
+                if not visited[succ]:
+                    visited[succ] = True
+                    stack.append((succ, 0))
+            else:
+                order.append(index)
+        return order
+
+    def dominators(self):
+        """
+        Returns the immediate dominator of every block: the closest block that every
+        path from the entry to it goes through. The entry block is its own immediate
+        dominator, and unreachable blocks get -1.
+
+        Uses the iterative algorithm from Cooper, Harvey and Kennedy, "A Simple, Fast
+        Dominance Algorithm".
+        """
+        postorder = self.postorder()
+        ponum = [-1] * len(self.blocks)
+        for i in range(len(postorder)):
+            ponum[postorder[i]] = i
+
+        idom = [-1] * len(self.blocks)
+        if len(self.blocks) == 0:
+            return idom
+        idom[0] = 0
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(postorder) - 1, -1, -1):
+                index = postorder[i]
+                if index == 0:
+                    continue
+                newidom = -1
+                for pred in self.blocks[index].preds:
+                    if idom[pred] == -1:
+                        continue
+                    if newidom == -1:
+                        newidom = pred
+                        continue
+                    # walk both up the dominator tree until they meet
+                    finger1 = pred
+                    finger2 = newidom
+                    while finger1 != finger2:
+                        while ponum[finger1] < ponum[finger2]:
+                            finger1 = idom[finger1]
+                        while ponum[finger2] < ponum[finger1]:
+                            finger2 = idom[finger2]
+                    newidom = finger1
+                if newidom != idom[index]:
+                    idom[index] = newidom
+                    changed = True
+        return idom
+
+    def natural_loops(self):
+        """
+        Returns a list of (header, blocks) pairs, one for every back edge: an edge to a
+        block that dominates the block it comes from. blocks is a list of flags that
+        are True for every block in the loop.
+        """
+        idom = self.dominators()
+        loops = []
+        for block in self.blocks:
+            if idom[block.index] == -1:
+                continue
+            for succ in block.succs():
+                if not dominates(idom, succ, block.index):
+                    continue
+                # everything that can get to the back edge without going through the
+                # header is part of the loop
+                inloop = [False] * len(self.blocks)
+                inloop[succ] = True
+                inloop[block.index] = True
+                todo = [block.index]
+                while len(todo) > 0:
+                    index = todo.pop()
+                    if index == succ:
+                        continue
+                    for pred in self.blocks[index].preds:
+                        if not inloop[pred] and idom[pred] != -1:
+                            inloop[pred] = True
+                            todo.append(pred)
+                loops.append((succ, inloop))
+        return loops
+
+    def def_use(self):
+        return DefUseChains(self)
+
+    def linearize(self, filename=""):
+        """
+        Lays the reachable blocks out as bytecode. A block is followed by the block it
+        falls through to wherever possible. If that one's already been placed, or
+        it's an early return off to the side of the code around it, a conditional
+        branch gets inverted so its target can follow instead.
+
+        Returns (bytecode, bytecode_info).
+        """
+        reachable = self.reachable()
+
+        # work out the order of the blocks
+        order = []
+        placed = [False] * len(self.blocks)
+        fallthroughs = [0] * len(self.blocks) # how many blocks fall into each one
+        for block in self.blocks:
+            if reachable[block.index] and block.fallthrough != -1:
+                fallthroughs[block.fallthrough] += 1
+        current = 0 if len(self.blocks) > 0 else -1
+        while current != -1:
+            block = self.blocks[current]
+            placed[current] = True
+            order.append(current)
+
+            current = -1
+            invertible = block.target != -1 and block.fallthrough != -1 and \
+                not placed[block.target] and block.last()[0] in INVERTED_BRANCHES
+            if block.fallthrough != -1 and not placed[block.fallthrough] and \
+                    not (invertible and self.blocks[block.fallthrough].exits()):
+                current = block.fallthrough
+            elif invertible:
+                # flip the branch around so the target becomes the fall through
+                inst, a, b, c = block.last()
+                block.insts[len(block.insts) - 1] = _set_operand(
+                    (INVERTED_BRANCHES[inst], a, b, c), branch_operand(inst),
+                    block.fallthrough)
+                block.target, block.fallthrough = block.fallthrough, block.target
+                current = block.fallthrough
+            elif block.target != -1 and not placed[block.target] and \
+                    block.last()[0] == INST['JMP'] and fallthroughs[block.target] == 0:
+                # nothing else falls into the target, so it can go right here
+                current = block.target
+            if current == -1:
+                for index in range(len(self.blocks)):
+                    if reachable[index] and not placed[index]:
+                        current = index
+                        break
+
+        # the final instructions of every block, still with block index targets
+        insts = []
+        infos = []
+        for i in range(len(order)):
+            block = self.blocks[order[i]]
+            nextblock = -1
+            if i + 1 < len(order):
+                nextblock = order[i + 1]
+            blockinsts = [ instruction for instruction in block.insts ]
+            blockinfo = [ annotation for annotation in block.info ]
+            if len(blockinsts) > 0 and blockinsts[len(blockinsts) - 1][0] == INST['JMP'] and \
+                    block.target == nextblock:
+                # a jump to the next block isn't needed
+                blockinsts.pop()
+                blockinfo.pop()
+            if block.fallthrough != -1 and block.fallthrough != nextblock:
+                blockinsts.append((INST['JMP'], block.fallthrough, -1, -1))
+                if len(blockinfo) > 0:
+                    annotation = blockinfo[len(blockinfo) - 1]
+                    blockinfo.append(BytecodeAnnotation(annotation.filename, annotation.source))
+                else:
+                    blockinfo.append(BytecodeAnnotation(filename, (-1, -1)))
+            insts.append(blockinsts)
+            infos.append(blockinfo)
+
+        start = [0] * len(self.blocks)
+        pos = 0
+        for i in range(len(order)):
+            start[order[i]] = pos
+            pos += len(insts[i])
+
+        bytecode = []
+        bytecode_info = []
+        for i in range(len(order)):
+            for instruction in insts[i]:
+                idx = branch_operand(instruction[0])
+                if idx != -1:
+                    inst, a, b, c = instruction
+                    operands = [a, b, c]
+                    instruction = _set_operand(instruction, idx, start[operands[idx]])
+                bytecode.append(instruction)
+            for annotation in infos[i]:
+                bytecode_info.append(annotation)
+        return bytecode, bytecode_info
+
+
+def dominates(idom, a, b):
+    """
+    Returns True if block a dominates block b, given the immediate dominators from
+    ControlFlowGraph.dominators()
+    """
+    while True:
+        if a == b:
+            return True
+        if b == 0 or idom[b] == -1:
+            return False
+        b = idom[b]
+
+
+class DefUseChains(object):
+    """
+    Links every register read in a control-flow graph to the instructions whose
+    value it may be reading, and the other way around.
+
+    Definitions are numbered in the order they appear in the blocks; defs[id] is
+    the (block, instruction, register) of definition id. ENTRY_DEF stands for the
+    value a register has when the function starts.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.defs = []
+        # (block, instruction, register) of a read -> list of definition ids
+        self.reaching = {}
+        # definition id -> list of the (block, instruction, register) reads of it
+        self.uses = {}
+        # id of the first definition in each block
+        self.first_def = [0] * len(cfg.blocks)
+        # instruction pointer in the bytecode the graph was built from -> (block,
+        # instruction)
+        self.location = {}
+
+        for block in cfg.blocks:
+            self.first_def[block.index] = len(self.defs)
+            for i in range(len(block.insts)):
+                self.location[block.start + i] = (block.index, i)
+                for reg in self._defined(block.insts[i]):
+                    self.uses[len(self.defs)] = []
+                    self.defs.append((block.index, i, reg))
+        self.uses[ENTRY_DEF] = []
+        self._compute()
+
+    def position(self, id):
+        """
+        Returns the instruction pointer of definition id in the bytecode the graph
+        was built from, or -1 for ENTRY_DEF
+        """
+        if id == ENTRY_DEF:
+            return -1
+        block, i, reg = self.defs[id]
+        return self.cfg.blocks[block].start + i
+
+    def reaching_at(self, ptr, reg):
+        """
+        Returns the ids of the definitions the instruction at ptr may see when it
+        reads reg, or None if it can't be reached
+        """
+        if ptr not in self.location:
+            return None
+        block, i = self.location[ptr]
+        key = (block, i, reg)
+        if key not in self.reaching:
+            return None
+        return self.reaching[key]
+
+    def _read(self, instruction):
+        inst, a, b, c = instruction
+        kinds = INST_OPERANDS[inst]
+        operands = [a, b, c]
+        result = []
+        for i in range(3):
+            if (kinds[i] == "r" or kinds[i] == "m" or kinds[i] == "e") and operands[i] >= 0:
+                result.append(operands[i])
+        return result
+
+    def _defined(self, instruction):
+        inst, a, b, c = instruction
+        kinds = INST_OPERANDS[inst]
+        operands = [a, b, c]
+        result = []
+        for i in range(3):
+            if (kinds[i] == "w" or kinds[i] == "m" or kinds[i] == "x") and operands[i] >= 0:
+                result.append(operands[i])
+        return result
+
+    def _transfer(self, block, state, record):
+        """
+        Runs the reaching definitions (register -> list of definition ids) through a
+        block. If record is set, the reads are linked up along the way.
+        """
+        defid = self.first_def[block.index]
+        for i in range(len(block.insts)):
+            instruction = block.insts[i]
+            if record:
+                for reg in self._read(instruction):
+                    ids = state[reg] if reg in state else [ENTRY_DEF]
+                    self.reaching[(block.index, i, reg)] = ids
+                    for id in ids:
+                        self.uses[id].append((block.index, i, reg))
+            for reg in self._defined(instruction):
+                state[reg] = [defid]
+                defid += 1
+        return state
+
+    def _compute(self):
+        blocks = self.cfg.blocks
+        reachable = self.cfg.reachable()
+        # registers that haven't been written on any path yet still have their
+        # starting value, so only the written ones are tracked
+        states_in = [ {} for _ in blocks ]
+        states_out = [ None for _ in blocks ]
+        changed = True
+        while changed:
+            changed = False
+            for block in blocks:
+                if not reachable[block.index]:
+                    continue
+                state = {}
+                for pred in block.preds:
+                    if states_out[pred] is None:
+                        continue
+                    for reg, ids in states_out[pred].items():
+                        merged = state[reg] if reg in state else []
+                        for id in ids:
+                            if id not in merged:
+                                merged.append(id)
+                        state[reg] = merged
+                # a register that isn't written on every path in may still have its
+                # starting value
+                for reg in state:
+                    for pred in block.preds:
+                        if states_out[pred] is not None and reg not in states_out[pred] and \
+                                ENTRY_DEF not in state[reg]:
+                            state[reg].append(ENTRY_DEF)
+                if block.index == 0:
+                    for reg in state:
+                        if ENTRY_DEF not in state[reg]:
+                            state[reg].append(ENTRY_DEF)
+                states_in[block.index] = state
+
+                copy = {}
+                for reg, ids in state.items():
+                    copy[reg] = [ id for id in ids ]
+                out = self._transfer(block, copy, False)
+                if states_out[block.index] is None or \
+                        not self._same_state(out, states_out[block.index]):
+                    states_out[block.index] = out
+                    changed = True
+
+        for block in blocks:
+            if reachable[block.index]:
+                self._transfer(block, states_in[block.index], True)
+
+    def _same_state(self, x, y):
+        if len(x) != len(y):
+            return False
+        for reg, ids in x.items():
+            if reg not in y or len(y[reg]) != len(ids):
+                return False
+            for id in ids:
+                if id not in y[reg]:
+                    return False
+        return True
@@ -4,11 +4,23 @@ Dipper bytecode compilers
 from rpython.rlib.objectmodel import we_are_translated
 
 from interpreter import Frame
-from bytecode import BytecodeAnnotation, INSTRUCTION_SET, INST, INST_STRS
+from bytecode import BytecodeAnnotation, LineTable, SOURCE_MARKER, INSTRUCTION_SET, INST, INST_STRS, INST_OPERANDS
 from basicio import Stream
 from namespace import Namespace
 import typesystem as types
 from common import CompileError
+import ast
+from regalloc import allocate_registers
+from constpool import pool_constants
+from constfold import fold_constants
+from loops import optimize_loops
+from cfg import ControlFlowGraph
+from passes import PassManager, FunctionStats, DEFAULT_OPT_LEVEL
+import peephole
+
+# Bump this whenever the compiler output changes, so that any .dipc cache files
+# written by an older compiler get thrown away
+COMPILER_VERSION = 17
 
 
 class Compiler(object):
@@ -62,7 +74,7 @@ class BytecodeCompiler(Compiler):
         """
         fn = types.DFunc.new_func(self.name, [], "int")
         funcargs = []
-        fn.set_code(self.bytecode, [], self.data, self.vars)
+        fn.set_code(self.bytecode, LineTable.encode("", []), self.data, self.vars, [])
         return fn
 
     def _parse(self, code):
@@ -108,7 +120,8 @@ class FrameCompiler(Compiler):
     STDIN = Stream.STDIN
     STDERR = Stream.STDERR
 
-    def __init__(self, filename, astnode, namespace=None):
+    def __init__(self, filename, astnode, namespace=None, opt_level=DEFAULT_OPT_LEVEL,
+            stats=None):
         Compiler.__init__(self, namespace=namespace)
 
         if not we_are_translated():
@@ -144,7 +157,7 @@ class FrameCompiler(Compiler):
         # hold on to the argument data indices for ease of plugging in argument values
         self.argIdx = []
 
-        if astnode.type == "Function":
+        if isinstance(astnode, ast.Function):
             for arg in astnode.args:
                 self.data.append(types.AutoType(arg.getType())())
                 idx = len(self.data) - 1
@@ -153,13 +166,87 @@ class FrameCompiler(Compiler):
 
         self.astnode.compile(self)
 
+        # optimization passes, see FRAME_PASSES below
+        funcstats = None
+        if stats is not None:
+            funcstats = FunctionStats(self.name)
+        FRAME_PASSES.run(self, opt_level, funcstats)
+        if funcstats is not None:
+            funcstats.instructions = len(self.bytecode)
+            funcstats.registers = len(self.data)
+            stats.add(funcstats)
+
+    def _pinned_registers(self):
+        """
+        Returns the registers that have to stay where they are: arguments and
+        anything bound to a name
+        """
+        pinned = []
+        for idx in self.argIdx:
+            pinned.append(idx)
+        for idx in self.vars.values():
+            pinned.append(idx)
+        return pinned
+
+    def _remap_vars(self, regmap):
+        for name, idx in self.vars.items():
+            self.vars[name] = regmap[idx]
+        self.argIdx = [ regmap[idx] for idx in self.argIdx ]
+
+    def linearize(self):
+        """
+        Splits the compiled code into basic blocks and lays them back out so control
+        falls through from block to block where it can
+        """
+        cfg = ControlFlowGraph(self.bytecode, self.bytecode_info)
+        self.bytecode, self.bytecode_info = cfg.linearize(self.filename)
+
+    def fold_constants(self):
+        """
+        Folds operations on values known at compile-time, and branches that depend
+        on them
+        """
+        self.bytecode, self.data = fold_constants(self.bytecode, self.data,
+            len(self.argIdx), self.vars.values(), self.namespace.constpool.values)
+
+    def peephole(self):
+        """
+        Removes labels and dead code, and threads jumps
+        """
+        self.bytecode, self.bytecode_info = peephole.optimize(self.bytecode, self.bytecode_info)
+
+    def optimize_loops(self):
+        """
+        Moves loop-invariant code out of loops and reduces multiplications of loop
+        counters to additions
+        """
+        self.bytecode, self.bytecode_info, self.data = optimize_loops(self.bytecode,
+            self.bytecode_info, self.data, len(self.argIdx))
+
+    def pool_constants(self):
+        """
+        Moves registers that are only ever read into the module's constant pool
+        """
+        self.bytecode, self.data, regmap = pool_constants(self.bytecode, self.data,
+            self._pinned_registers(), self.namespace.constpool)
+        self._remap_vars(regmap)
+
+    def allocate_registers(self):
+        """
+        Packs temporaries with non-overlapping lifetimes into shared data registers
+        """
+        self.bytecode, self.data, regmap = allocate_registers(self.bytecode, self.data,
+            self._pinned_registers())
+        self._remap_vars(regmap)
+
     def mkfunc(self):
         """
         Returns a DFunc object representing the compiled function
         """
         assert self.astnode.type == "Function"
         fn = self.astnode.mkprototype()
-        fn.set_code(self.bytecode, self.bytecode_info, self.data, self.vars)
+        fn.set_code(self.bytecode, LineTable.encode(self.filename, self.bytecode_info),
+            self.data, self.vars, self.namespace.constpool.values)
         return fn
 
     def pushobj(self, val):
@@ -178,12 +265,11 @@ class FrameCompiler(Compiler):
     def setbranch(self, instptr, newptr):
         vals = list(self.bytecode[instptr])
         inst = vals[0]
-        if inst in (INST['BT'], INST['BF']):
-            vals[2] = newptr
-        elif inst in (INST['BNE'], INST['BEQ']):
-            vals[3] = newptr
-        elif inst == INST['JMP']:
-            vals[1] = newptr
+        kinds = INST_OPERANDS[inst]
+        for i in range(3):
+            if kinds[i] == "j":
+                vals[i + 1] = newptr
+                break
         else:
             raise ValueError("Unsupported instruction for setbranch (%s)" % INST_STRS[inst])
         self.bytecode[instptr] = (vals[0], vals[1], vals[2], vals[3])
@@ -216,6 +302,10 @@ class FrameCompiler(Compiler):
         """ Simple helper for typechecking data registers """
         return isinstance(self.data[dataidx], types.DString)
 
+    def is_numeric(self, dataidx):
+        """ Simple helper for typechecking data registers """
+        return self.is_int(dataidx) or self.is_float(dataidx)
+
     def is_type(self, dataidx, datatype):
         """ Simple helper for typechecking data registers """
         return isinstance(self.data[dataidx], datatype)
@@ -223,17 +313,23 @@ class FrameCompiler(Compiler):
     def start_node(self, node):
         self._current_node = node
 
-    def emit(self, opcode, a=-1, b=-1, c=-1, comment=""):
+    def emit(self, opcode, a=-1, b=-1, c=-1, comment="", ref=(-1, -1)):
         self.bytecode.append( (INST[opcode], a, b, c) )
-        self.bytecode_info.append(BytecodeAnnotation(self.filename, self._current_node.source, comment=comment))
+        refs = None
+        if ref[0] > -1:
+            # the source at ref is only read in if the bytecode is disassembled
+            comment = "%s %s" % (comment, SOURCE_MARKER)
+            refs = [ref]
+        self.bytecode_info.append(BytecodeAnnotation(self.filename, self._current_node.source,
+            comment=comment, refs=refs))
         # return the instruction pointer location for the emitted inst
         return self.currentptr()
 
     def emit_PASS(self):
         return self.emit('PASS')
 
-    def emit_LABEL(self, label):
-        return self.emit('LABEL', comment=label)
+    def emit_LABEL(self, label, ref=(-1, -1)):
+        return self.emit('LABEL', comment=label, ref=ref)
 
     def emit_BT(self, idx, ptr):
         return self.emit('BT', idx, ptr)
@@ -247,6 +343,36 @@ class FrameCompiler(Compiler):
     def emit_BNE(self, a, b, ptr):
         return self.emit('BNE', a, b, ptr)
 
+    def emit_BLT(self, a, b, ptr):
+        return self.emit('BLT', a, b, ptr)
+
+    def emit_BGT(self, a, b, ptr):
+        return self.emit('BGT', a, b, ptr)
+
+    def emit_BLE(self, a, b, ptr):
+        return self.emit('BLE', a, b, ptr)
+
+    def emit_BGE(self, a, b, ptr):
+        return self.emit('BGE', a, b, ptr)
+
+    def emit_BEQ_IM(self, a, val, ptr):
+        return self.emit('BEQ_IM', a, val, ptr)
+
+    def emit_BNE_IM(self, a, val, ptr):
+        return self.emit('BNE_IM', a, val, ptr)
+
+    def emit_BLT_IM(self, a, val, ptr):
+        return self.emit('BLT_IM', a, val, ptr)
+
+    def emit_BGT_IM(self, a, val, ptr):
+        return self.emit('BGT_IM', a, val, ptr)
+
+    def emit_BLE_IM(self, a, val, ptr):
+        return self.emit('BLE_IM', a, val, ptr)
+
+    def emit_BGE_IM(self, a, val, ptr):
+        return self.emit('BGE_IM', a, val, ptr)
+
     def emit_JMP(self, ptr):
         return self.emit('JMP', ptr)
 
@@ -280,6 +406,59 @@ class FrameCompiler(Compiler):
     def emit_DIV(self, a, b, dest):
         return self.emit('DIV', a, b, dest)
 
+    def emit_ADD_II(self, a, b, dest):
+        return self.emit('ADD_II', a, b, dest)
+
+    def emit_SUB_II(self, a, b, dest):
+        return self.emit('SUB_II', a, b, dest)
+
+    def emit_MUL_II(self, a, b, dest):
+        return self.emit('MUL_II', a, b, dest)
+
+    def emit_DIV_II(self, a, b, dest):
+        return self.emit('DIV_II', a, b, dest)
+
+    def emit_ADD_FF(self, a, b, dest):
+        return self.emit('ADD_FF', a, b, dest)
+
+    def emit_SUB_FF(self, a, b, dest):
+        return self.emit('SUB_FF', a, b, dest)
+
+    def emit_MUL_FF(self, a, b, dest):
+        return self.emit('MUL_FF', a, b, dest)
+
+    def emit_DIV_FF(self, a, b, dest):
+        return self.emit('DIV_FF', a, b, dest)
+
+    def emit_ADD_IM(self, a, val, dest):
+        return self.emit('ADD_IM', a, val, dest)
+
+    def emit_SUB_IM(self, a, val, dest):
+        return self.emit('SUB_IM', a, val, dest)
+
+    def emit_MUL_IM(self, a, val, dest):
+        return self.emit('MUL_IM', a, val, dest)
+
+    def emit_DIV_IM(self, a, val, dest):
+        return self.emit('DIV_IM', a, val, dest)
+
+    def emit_CONCAT_SS(self, a, b, dest):
+        return self.emit('CONCAT_SS', a, b, dest)
+
+    def emit_arith(self, opcode, a, b, dest):
+        """
+        Emits an ADD, SUB, MUL or DIV, using the version of the instruction that's
+        specialized for the operand and result types when there is one
+        """
+        if self.is_int(dest) and self.is_int(a) and self.is_int(b):
+            return self.emit("%s_II" % opcode, a, b, dest)
+        elif self.is_float(dest) and self.is_numeric(a) and self.is_numeric(b):
+            # ints get converted, so this covers mixed int and float operands too
+            return self.emit("%s_FF" % opcode, a, b, dest)
+        elif opcode == 'ADD' and self.is_str(dest) and self.is_str(a) and self.is_str(b):
+            return self.emit_CONCAT_SS(a, b, dest)
+        return self.emit(opcode, a, b, dest)
+
     def emit_SQRT(self, val, dest):
         return self.emit('SQRT', val, dest)
 
@@ -301,6 +480,24 @@ class FrameCompiler(Compiler):
     def emit_LTE(self, a, b, dest):
         return self.emit('LTE', a, b, dest)
 
+    def emit_EQ_IM(self, a, val, dest):
+        return self.emit('EQ_IM', a, val, dest)
+
+    def emit_NEQ_IM(self, a, val, dest):
+        return self.emit('NEQ_IM', a, val, dest)
+
+    def emit_GT_IM(self, a, val, dest):
+        return self.emit('GT_IM', a, val, dest)
+
+    def emit_LT_IM(self, a, val, dest):
+        return self.emit('LT_IM', a, val, dest)
+
+    def emit_GTE_IM(self, a, val, dest):
+        return self.emit('GTE_IM', a, val, dest)
+
+    def emit_LTE_IM(self, a, val, dest):
+        return self.emit('LTE_IM', a, val, dest)
+
     def emit_LEN(self, itemidx, destidx):
         return self.emit('LEN', itemidx, destidx)
 
@@ -321,6 +518,11 @@ class FrameCompiler(Compiler):
             assert type(name) is int
         return self.emit('CALL', name, argsidx, retidx)
 
+    def emit_TAILCALL(self, name, argsidx):
+        if not we_are_translated():
+            assert type(name) is int
+        return self.emit('TAILCALL', name, argsidx)
+
     def emit_LIST_NEW(self, idx):
         return self.emit('LIST_NEW', idx)
 
@@ -343,3 +545,41 @@ class FrameCompiler(Compiler):
 
     def __str__(self):
         return self.toString()
+
+
+def _count_instructions(ctx):
+    return len(ctx.bytecode)
+
+
+def _linearize(ctx):
+    ctx.linearize()
+
+
+def _fold_constants(ctx):
+    ctx.fold_constants()
+
+
+def _peephole(ctx):
+    ctx.peephole()
+
+
+def _optimize_loops(ctx):
+    ctx.optimize_loops()
+
+
+def _pool_constants(ctx):
+    ctx.pool_constants()
+
+
+def _allocate_registers(ctx):
+    ctx.allocate_registers()
+
+# the passes every FrameCompiler runs over its function once the AST is compiled,
+# in order, and the lowest optimization level each one runs at
+FRAME_PASSES = PassManager(_count_instructions)
+FRAME_PASSES.register("linearize", 1, _linearize)
+FRAME_PASSES.register("fold_constants", 1, _fold_constants)
+FRAME_PASSES.register("peephole", 1, _peephole)
+FRAME_PASSES.register("optimize_loops", 2, _optimize_loops)
+FRAME_PASSES.register("pool_constants", 1, _pool_constants)
+FRAME_PASSES.register("allocate_registers", 1, _allocate_registers)
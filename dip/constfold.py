@@ -0,0 +1,445 @@
+"""
+Constant folding and propagation on compiled bytecode
+
+The AST compiler only folds an operation when both of its operands are literals.
+This works on the bytecode instead, so it catches everything else that's known at
+compile time: values that come from variables assigned from constants, results of
+operations that have already been folded, and so on. Reads of registers with a
+known value are turned into reads of a register that only holds that value (which
+pool_constants then moves into the constant pool), branches on known
+conditions become unconditional (or go away), and instructions whose results are
+no longer needed are replaced with PASS for the peephole pass to clean up.
+"""
+import typesystem as types
+from bytecode import INST, INST_OPERANDS, OPERATOR_MAP, const_index, is_const
+from constpool import ConstPool
+from regalloc import Liveness, successors
+
+
+def same_value(x, y):
+    if type(x) is not type(y):
+        return False
+    if type(x) is types.DInteger:
+        return x.int_py() == y.int_py()
+    elif type(x) is types.DFloat:
+        return x.float_py() == y.float_py()
+    elif type(x) is types.DString:
+        return x.str_py() == y.str_py()
+    elif type(x) is types.DBool:
+        return x.bool_py() == y.bool_py()
+    return False
+
+
+# The type system raises NotImplementedError for conversions a type doesn't have,
+# and RPython doesn't allow catching that, so evaluate() checks its operands with
+# these first and gives up on anything they rule out.
+
+def _is_number(val):
+    return isinstance(val, types.DInteger) or isinstance(val, types.DFloat)
+
+
+def _is_scalar(val):
+    return _is_number(val) or isinstance(val, types.DBool) or isinstance(val, types.DString)
+
+
+def _has_int(val):
+    return _is_number(val) or isinstance(val, types.DBool) or isinstance(val, types.DNull)
+
+
+def _has_str(val):
+    return _is_scalar(val) or isinstance(val, types.DNull)
+
+
+def convert(val, dest):
+    """
+    Returns val converted to the type of dest, the same way the SET instruction does,
+    or None if val doesn't convert to it
+    """
+    if isinstance(dest, types.DInteger) and _has_int(val):
+        return types.DInteger.new_int(val.int_py())
+    elif isinstance(dest, types.DBool) and _has_str(val):
+        return types.DBool.new_bool(val.bool_py())
+    elif isinstance(dest, types.DFloat) and _is_number(val):
+        return types.DFloat.new_float(val.float_py())
+    elif isinstance(dest, types.DString) and _has_str(val):
+        return types.DString.new_str(val.str_py())
+    return None
+
+
+def evaluate(inst, lhs, rhs, imm, dest):
+    """
+    Works out the value an instruction writes, given its known operand values (lhs
+    and rhs, or None if not used), its immediate value and the register it writes
+    to. Returns None if it can't be done at compile time.
+    """
+    if inst == INST['SET']:
+        return convert(lhs, dest)
+
+    # everything else only gets folded for the plain value types
+    if lhs is None or not _is_scalar(lhs) or (rhs is not None and not _is_scalar(rhs)):
+        return None
+
+    if inst in (INST['ADDI'], INST['SUBI'], INST['MULI'], INST['DIVI'], INST['ADD_II'],
+            INST['SUB_II'], INST['MUL_II'], INST['DIV_II'], INST['ADD_IM'], INST['SUB_IM'],
+            INST['MUL_IM'], INST['DIV_IM']):
+        if not _has_int(lhs) or (rhs is not None and not _has_int(rhs)):
+            return None
+    elif inst in (INST['ADD_FF'], INST['SUB_FF'], INST['MUL_FF'], INST['DIV_FF'],
+            INST['SQRT']):
+        if not _is_number(lhs) or (rhs is not None and not _is_number(rhs)):
+            return None
+    elif inst == INST['LEN']:
+        if not isinstance(lhs, types.DString):
+            return None
+
+    if inst == INST['ADDI']:
+        return types.DInteger.new_int(lhs.int_py() + imm)
+    elif inst == INST['SUBI']:
+        return types.DInteger.new_int(lhs.int_py() - imm)
+    elif inst == INST['MULI']:
+        return types.DInteger.new_int(lhs.int_py() * imm)
+    elif inst == INST['DIVI']:
+        return types.DInteger.new_int(lhs.int_py() // imm)
+
+    elif inst == INST['ADD_II']:
+        return types.DInteger.new_int(lhs.int_py() + rhs.int_py())
+    elif inst == INST['SUB_II']:
+        return types.DInteger.new_int(lhs.int_py() - rhs.int_py())
+    elif inst == INST['MUL_II']:
+        return types.DInteger.new_int(lhs.int_py() * rhs.int_py())
+    elif inst == INST['DIV_II']:
+        return types.DInteger.new_int(lhs.int_py() // rhs.int_py())
+
+    elif inst == INST['ADD_FF']:
+        return types.DFloat.new_float(lhs.float_py() + rhs.float_py())
+    elif inst == INST['SUB_FF']:
+        return types.DFloat.new_float(lhs.float_py() - rhs.float_py())
+    elif inst == INST['MUL_FF']:
+        return types.DFloat.new_float(lhs.float_py() * rhs.float_py())
+    elif inst == INST['DIV_FF']:
+        return types.DFloat.new_float(lhs.float_py() / rhs.float_py())
+
+    elif inst == INST['CONCAT_SS']:
+        return types.DString.new_str(lhs.str_py() + rhs.str_py())
+
+    elif inst == INST['ADD_IM']:
+        return types.DInteger.new_int(lhs.int_py() + imm)
+    elif inst == INST['SUB_IM']:
+        return types.DInteger.new_int(lhs.int_py() - imm)
+    elif inst == INST['MUL_IM']:
+        return types.DInteger.new_int(lhs.int_py() * imm)
+    elif inst == INST['DIV_IM']:
+        return types.DInteger.new_int(lhs.int_py() // imm)
+
+    elif inst in (INST['ADD'], INST['SUB'], INST['MUL'], INST['DIV']):
+        op = OPERATOR_MAP[inst]
+        if isinstance(dest, types.DInteger):
+            return types.DInteger.new_int(lhs.operator_int(op, rhs))
+        elif isinstance(dest, types.DFloat):
+            return types.DFloat.new_float(lhs.operator_float(op, rhs))
+        elif isinstance(dest, types.DString):
+            return types.DString.new_str(lhs.operator_str(op, rhs))
+
+    elif inst in (INST['EQ'], INST['NEQ'], INST['GT'], INST['LT'], INST['GTE'], INST['LTE']):
+        return types.DBool.new_bool(lhs.operator_bool(OPERATOR_MAP[inst], rhs))
+    elif inst in (INST['EQ_IM'], INST['NEQ_IM'], INST['GT_IM'], INST['LT_IM'],
+            INST['GTE_IM'], INST['LTE_IM']):
+        return types.DBool.new_bool(lhs.operator_bool(OPERATOR_MAP[inst],
+            types.DInteger.new_int(imm)))
+
+    elif inst == INST['SQRT']:
+        return types.DFloat.new_float(lhs.sqrt_py())
+
+    elif inst == INST['LEN']:
+        return types.DInteger.new_int(lhs.len_py())
+
+    return None
+
+
+def branch_taken(inst, lhs, rhs):
+    """
+    Returns whether a conditional branch with known operands jumps
+    """
+    if inst == INST['BT']:
+        return lhs.bool_py()
+    elif inst == INST['BF']:
+        return not lhs.bool_py()
+    return lhs.operator_bool(OPERATOR_MAP[inst], rhs)
+
+
+def is_cond_branch(inst):
+    return inst in (INST['BT'], INST['BF'], INST['BEQ'], INST['BNE'], INST['BLT'],
+        INST['BGT'], INST['BLE'], INST['BGE'], INST['BEQ_IM'], INST['BNE_IM'],
+        INST['BLT_IM'], INST['BGT_IM'], INST['BLE_IM'], INST['BGE_IM'])
+
+
+def is_pure_def(inst):
+    """
+    Returns True for instructions that do nothing but write one register
+    """
+    kinds = INST_OPERANDS[inst]
+    return kinds.count("w") == 1 and kinds.count("m") == 0 and kinds.count("e") == 0 and \
+        kinds.count("x") == 0 and kinds.count("j") == 0
+
+
+class ConstantFolder(object):
+    def __init__(self, bytecode, data, argcount, named, consts):
+        self.bytecode = bytecode
+        self.data = data
+        self.consts = consts
+
+        # registers added to hold the values that got worked out, so each one is
+        # only added once
+        self.values = ConstPool()
+        self.valueregs = []
+
+        # named registers keep their values around for debugging, so their
+        # instructions don't get removed just because nothing reads them. arguments
+        # are shared with the caller, so writes to them always have to happen.
+        self.named = [False] * len(data)
+        for reg in named:
+            self.named[reg] = True
+        for reg in range(argcount):
+            self.named[reg] = True
+
+        # only registers holding simple values that never get replaced or handed
+        # out to other code are tracked
+        self.tracked = [ self._is_simple(val) for val in data ]
+        for reg in range(argcount):
+            self.tracked[reg] = False
+        for inst, a, b, c in bytecode:
+            kinds = INST_OPERANDS[inst]
+            operands = [a, b, c]
+            for i in range(3):
+                if (kinds[i] == "e" or kinds[i] == "x") and operands[i] >= 0:
+                    self.tracked[operands[i]] = False
+
+    def _is_simple(self, val):
+        t = type(val)
+        return t is types.DInteger or t is types.DFloat or t is types.DString or \
+            t is types.DBool
+
+    def operand_value(self, state, operand):
+        if is_const(operand):
+            return self.consts[const_index(operand)]
+        elif operand >= 0 and operand in state:
+            return state[operand]
+        return None
+
+    def branch_decided(self, ptr, state):
+        """
+        Returns 1 if the conditional branch at ptr is always taken with the given
+        register values, 0 if it never is and -1 if that isn't known
+        """
+        inst, a, b, c = self.bytecode[ptr]
+        lhs = self.operand_value(state, a)
+        rhs = None
+        if INST_OPERANDS[inst][1] == "r":
+            rhs = self.operand_value(state, b)
+            if rhs is None:
+                return -1
+        elif INST_OPERANDS[inst][1] == "i":
+            rhs = types.DInteger.new_int(b)
+        if lhs is None or not _is_scalar(lhs) or (rhs is not None and not _is_scalar(rhs)):
+            return -1
+        try:
+            if branch_taken(inst, lhs, rhs):
+                return 1
+        except ValueError:
+            # leave it for the interpreter to complain about at run-time
+            return -1
+        return 0
+
+    def successors(self, ptr, state):
+        """
+        Same as regalloc.successors, but leaves out the way a branch with a known
+        outcome doesn't go
+        """
+        inst = self.bytecode[ptr][0]
+        succ = successors(self.bytecode, ptr)
+        if not is_cond_branch(inst) or len(succ) != 2:
+            return succ
+        decided = self.branch_decided(ptr, state)
+        if decided == 1:
+            return [succ[1]]
+        elif decided == 0:
+            return [succ[0]]
+        return succ
+
+    def value_register(self, data, val):
+        """
+        Returns a register that holds val and is never written to
+        """
+        idx = self.values.add(val)
+        if idx == len(self.valueregs):
+            data.append(val.copy())
+            self.valueregs.append(len(data) - 1)
+        return self.valueregs[idx]
+
+    def step(self, ptr, state):
+        """
+        Returns the known register values after the instruction at ptr runs, given
+        the ones before it. Also returns the value the instruction writes, if known.
+        """
+        inst, a, b, c = self.bytecode[ptr]
+        kinds = INST_OPERANDS[inst]
+        operands = [a, b, c]
+
+        after = {}
+        for reg, val in state.items():
+            after[reg] = val
+
+        dest = -1
+        for i in range(3):
+            if (kinds[i] == "w" or kinds[i] == "m" or kinds[i] == "x") and operands[i] >= 0:
+                dest = operands[i]
+                if dest in after:
+                    del after[dest]
+        if dest == -1 or not self.tracked[dest]:
+            return after, None
+
+        # work out what gets written, if everything it depends on is known
+        lhs = None
+        rhs = None
+        imm = 0
+        for i in range(3):
+            kind = kinds[i]
+            if kind == "r" or kind == "m":
+                val = self.operand_value(state, operands[i])
+                if val is None:
+                    return after, None
+                if lhs is None:
+                    lhs = val
+                else:
+                    rhs = val
+            elif kind == "i":
+                imm = operands[i]
+
+        destval = state[dest] if dest in state else self.data[dest]
+        try:
+            result = evaluate(inst, lhs, rhs, imm, destval)
+        except (ValueError, ZeroDivisionError):
+            # leave it for the interpreter to complain about at run-time
+            result = None
+        if result is not None:
+            after[dest] = result
+        return after, result
+
+    def run(self):
+        """
+        Returns the new (bytecode, data). The bytecode has the same length as before,
+        with removed instructions replaced by PASS.
+        """
+        numinsts = len(self.bytecode)
+        if numinsts == 0:
+            return self.bytecode, self.data
+
+        # forward dataflow: which registers have a known value going into each
+        # instruction. None means we haven't found a way to get there (yet).
+        entry = {}
+        for reg in range(len(self.data)):
+            if self.tracked[reg]:
+                entry[reg] = self.data[reg]
+        states = [None] * numinsts
+        states[0] = entry
+        todo = [0]
+        while len(todo) > 0:
+            ptr = todo.pop()
+            after, result = self.step(ptr, states[ptr])
+            for succ in self.successors(ptr, states[ptr]):
+                if succ < 0 or succ >= numinsts:
+                    continue
+                old = states[succ]
+                if old is None:
+                    states[succ] = after
+                    todo.append(succ)
+                    continue
+                # only keep the values that are the same on every way in
+                merged = {}
+                for reg, val in old.items():
+                    if reg in after and same_value(val, after[reg]):
+                        merged[reg] = val
+                if len(merged) != len(old):
+                    states[succ] = merged
+                    todo.append(succ)
+
+        # read known values from registers that hold nothing else, and settle known
+        # branches
+        data = [ val for val in self.data ]
+        code = []
+        results = [None] * numinsts
+        for ptr in range(numinsts):
+            inst, a, b, c = self.bytecode[ptr]
+            state = states[ptr]
+            if state is None:
+                # unreachable, peephole will get rid of it
+                code.append((inst, a, b, c))
+                continue
+
+            after, results[ptr] = self.step(ptr, state)
+
+            kinds = INST_OPERANDS[inst]
+            operands = [a, b, c]
+            for i in range(3):
+                if kinds[i] == "r" and operands[i] >= 0 and operands[i] in state:
+                    operands[i] = self.value_register(data, state[operands[i]])
+
+            if is_cond_branch(inst):
+                decided = self.branch_decided(ptr, state)
+                target = operands[1] if kinds[1] == "j" else operands[2]
+                if decided == 1:
+                    code.append((INST['JMP'], target, -1, -1))
+                    continue
+                elif decided == 0:
+                    code.append((INST['PASS'], -1, -1, -1))
+                    continue
+
+            code.append((inst, operands[0], operands[1], operands[2]))
+
+        # registers that are written exactly once with a known value and aren't read
+        # before that can just start out with that value
+        live = Liveness(code)
+        defs = [0] * len(data)
+        defptr = [-1] * len(data)
+        for ptr in range(numinsts):
+            inst, a, b, c = code[ptr]
+            kinds = INST_OPERANDS[inst]
+            operands = [a, b, c]
+            for i in range(3):
+                if (kinds[i] == "w" or kinds[i] == "m" or kinds[i] == "x") and operands[i] >= 0:
+                    defs[operands[i]] += 1
+                    defptr[operands[i]] = ptr
+        for reg in range(len(data)):
+            ptr = defptr[reg]
+            if defs[reg] != 1 or results[ptr] is None or reg in live.live_in[0]:
+                continue
+            if not is_pure_def(code[ptr][0]):
+                continue
+            data[reg] = results[ptr].copy()
+            code[ptr] = (INST['PASS'], -1, -1, -1)
+
+        # and temporaries that are written but never read again aren't needed
+        live = Liveness(code)
+        for ptr in range(numinsts):
+            inst, a, b, c = code[ptr]
+            if states[ptr] is None or not is_pure_def(inst):
+                continue
+            kinds = INST_OPERANDS[inst]
+            operands = [a, b, c]
+            for i in range(3):
+                if kinds[i] == "w":
+                    dest = operands[i]
+                    if dest >= 0 and not self.named[dest] and dest not in live.live_out[ptr]:
+                        code[ptr] = (INST['PASS'], -1, -1, -1)
+
+        return code, data
+
+
+def fold_constants(bytecode, data, argcount, named, consts):
+    """
+    Runs constant folding and propagation over a function's bytecode. argcount is
+    the number of argument registers at the start of data, named is the list of
+    registers bound to variable names and consts is the constant pool the bytecode
+    refers to. Returns the new (bytecode, data).
+    """
+    return ConstantFolder(bytecode, data, argcount, named, consts).run()
@@ -0,0 +1,133 @@
+"""
+Module-wide pool of constant values
+
+Literals and anything else the compiler works out ahead of time used to get a data
+register of their own in every function, which meant a fresh copy of each one on
+every call. Registers that are only ever read are moved into a ConstPool shared
+by all of the functions in a module instead, and the instructions that read them
+refer to the pool directly (see bytecode.const_operand).
+
+Pooled values are shared by every frame, so they must never be modified. The
+interpreter copies them when they're handed out (passed as an argument or
+returned).
+"""
+import typesystem as types
+from bytecode import INST_OPERANDS, const_operand, const_index, is_const
+from regalloc import remap_registers
+
+
+class ConstPool(object):
+    def __init__(self):
+        # the pooled values, indexed by constant operands
+        self.values = []
+
+        # index lookups for deduplicating values, by type
+        self._bools = {}
+        self._ints = {}
+        self._floats = {}
+        self._strs = {}
+
+    @staticmethod
+    def can_pool(val):
+        t = type(val)
+        return t is types.DBool or t is types.DInteger or t is types.DFloat or \
+            t is types.DString
+
+    def add(self, val):
+        """
+        Returns the pool index for the value, adding it if there isn't an equal
+        value in the pool already
+        """
+        t = type(val)
+        if t is types.DBool:
+            boolval = val.bool_py()
+            if boolval not in self._bools:
+                self._bools[boolval] = self._append(val)
+            return self._bools[boolval]
+        elif t is types.DInteger:
+            intval = val.int_py()
+            if intval not in self._ints:
+                self._ints[intval] = self._append(val)
+            return self._ints[intval]
+        elif t is types.DFloat:
+            floatval = val.float_py()
+            if floatval not in self._floats:
+                self._floats[floatval] = self._append(val)
+            return self._floats[floatval]
+        elif t is types.DString:
+            strval = val.str_py()
+            if strval not in self._strs:
+                self._strs[strval] = self._append(val)
+            return self._strs[strval]
+        else:
+            raise TypeError("Can't add %s to the constant pool" % val.basetype)
+
+    def _append(self, val):
+        # the pool keeps its own copy so nobody else can modify it
+        self.values.append(val.copy())
+        return len(self.values) - 1
+
+    def adopt(self, func):
+        """
+        Points a compiled function that was built against a different pool (in
+        another process, or for a previous build of the module) at this one
+        """
+        if func.consts is self.values:
+            return
+        bytecode = []
+        for inst, a, b, c in func.bytecode:
+            kinds = INST_OPERANDS[inst]
+            operands = [a, b, c]
+            for i in range(3):
+                if (kinds[i] == "r" or kinds[i] == "e") and is_const(operands[i]):
+                    val = func.consts[const_index(operands[i])]
+                    operands[i] = const_operand(self.add(val))
+            bytecode.append((inst, operands[0], operands[1], operands[2]))
+        func.bytecode = bytecode
+        func.consts = self.values
+
+
+def pool_constants(bytecode, data, pinned, pool):
+    """
+    Moves the data registers that are never written to (and aren't in pinned) into
+    the constant pool, and rewrites the bytecode to read them from there.
+
+    Returns (bytecode, data, regmap), where regmap maps old register indices to new
+    register indices or constant operands.
+    """
+    numregs = len(data)
+    poolable = [ ConstPool.can_pool(val) for val in data ]
+    for reg in pinned:
+        poolable[reg] = False
+
+    # registers in the order they're first read
+    used = []
+    is_used = [False] * numregs
+    for inst, a, b, c in bytecode:
+        kinds = INST_OPERANDS[inst]
+        operands = [a, b, c]
+        for i in range(3):
+            kind = kinds[i]
+            if operands[i] < 0:
+                continue
+            if kind == "r" or kind == "e":
+                if not is_used[operands[i]]:
+                    is_used[operands[i]] = True
+                    used.append(operands[i])
+            elif kind == "w" or kind == "m" or kind == "x":
+                poolable[operands[i]] = False
+
+    # constants go into the pool in the order they're read, the same order adopt()
+    # adds them in, so a function ends up with the same operands either way.
+    # constants that nothing reads are simply dropped.
+    regmap = [-1] * numregs
+    for reg in used:
+        if poolable[reg]:
+            regmap[reg] = const_operand(pool.add(data[reg]))
+    newdata = []
+    for reg in range(numregs):
+        if not poolable[reg]:
+            regmap[reg] = len(newdata)
+            newdata.append(data[reg])
+
+    return remap_registers(bytecode, regmap), newdata, regmap
@@ -1,25 +1,80 @@
 import basicio
 
 
+class LineIndex(object):
+    """
+    The start offset of every line in a source file, so that error messages can
+    show any line without splitting (or re-reading) the whole file
+    """
+    def __init__(self, source):
+        self.source = source
+        starts = [0]
+        i = source.find("\n")
+        while i >= 0:
+            starts.append(i + 1)
+            i = source.find("\n", i + 1)
+        self.starts = starts
+
+    def numlines(self):
+        return len(self.starts)
+
+    def getline(self, lineno):
+        """
+        Returns line number lineno (counting from 0) without its line ending, or
+        an empty string if there's no such line
+        """
+        if lineno < 0 or lineno >= len(self.starts):
+            return ""
+        start = self.starts[lineno]
+        if lineno + 1 < len(self.starts):
+            end = self.starts[lineno + 1] - 1
+        else:
+            end = len(self.source)
+        assert end >= start
+        return self.source[start:end]
+
+
+# line indexes for the source files we've seen, by filename
+_line_indexes = {}
+
+
+def register_source(filename, source):
+    """
+    Builds the line index for a file's source. The parser calls this, so errors
+    found later on don't need to touch the file again.
+    """
+    index = LineIndex(source)
+    _line_indexes[filename] = index
+    return index
+
+
+def get_line_index(filename):
+    index = _line_indexes.get(filename, None)
+    if index is None:
+        # the parser hasn't seen this file, so read it in (just the once)
+        index = register_source(filename, basicio.readall(filename))
+    return index
+
+
+def find_line_index(filename):
+    """
+    Like get_line_index, but returns None if the file's source isn't available
+    """
+    if filename not in _line_indexes and not basicio.file_exists(filename):
+        return None
+    return get_line_index(filename)
+
+
 def _error_sourceview(filename, lineno, colno, prefix="    "):
     sourceview = ["", "", "", ""]
 
     if filename != "":
-        lines = basicio.readall(filename).split("\n")
-
-        i = 0
-        for line in lines:
-            if i == lineno - 1:
-                sourceview[0] = "%s%s: %s" % (prefix, i + 1, line.rstrip("\n"))
-            elif i == lineno:
-                sourceview[1] = "%s%s: %s" % (prefix, i + 1, line.rstrip("\n"))
-            elif i == lineno + 1:
-                # skip sourceview[2]
-                sourceview[3] = "%s%s: %s" % (prefix, i + 1, line.rstrip("\n"))
-            i += 1
-            # break if we're past the important bits:
-            if i > lineno + 1:
-                break
+        index = get_line_index(filename)
+
+        # skip sourceview[2], that's where the arrow goes
+        for i, viewline in [(lineno - 1, 0), (lineno, 1), (lineno + 1, 3)]:
+            if i >= 0 and i < index.numlines():
+                sourceview[viewline] = "%s%s: %s" % (prefix, i + 1, index.getline(i))
 
     if colno > -1:
         # make sourceview[2] an arrow pointing to the right column
@@ -0,0 +1,372 @@
+"""
+Inlining of small functions
+
+Calling a function means packing its arguments into a list, looking it up by name
+and setting up a whole new frame for it, which costs far more than the body of a
+small helper. Once every function in a module has been compiled, calls to small
+functions that don't call anything themselves are replaced with a copy of the
+function's bytecode.
+
+Arguments are passed by reference, so the inlined code works directly on the
+caller's registers for them. Everything else the callee uses gets a register of its
+own in the caller, and registers that each call would have started out with a
+fresh copy of are reset at the start of every inlined copy.
+"""
+import typesystem as types
+from bytecode import INST, INST_OPERANDS, BytecodeAnnotation, LineTable, const_operand, is_const
+from constpool import ConstPool, pool_constants
+from constfold import fold_constants
+from regalloc import Liveness, allocate_registers, remap_registers
+import peephole
+
+# functions with more instructions than this are never inlined
+INLINE_BUDGET = 16
+
+
+def _written_registers(bytecode, numregs):
+    """
+    Returns a list of flags that are True for the registers the bytecode writes to
+    """
+    written = [False] * numregs
+    for inst, a, b, c in bytecode:
+        kinds = INST_OPERANDS[inst]
+        operands = [a, b, c]
+        for i in range(3):
+            if (kinds[i] == "w" or kinds[i] == "m" or kinds[i] == "x") and operands[i] >= 0:
+                written[operands[i]] = True
+    return written
+
+
+def _drop_unused_registers(bytecode, data, pinned):
+    """
+    Removes the data registers the bytecode no longer refers to. Returns (bytecode,
+    data, regmap).
+    """
+    used = [False] * len(data)
+    for reg in pinned:
+        used[reg] = True
+    for inst, a, b, c in bytecode:
+        kinds = INST_OPERANDS[inst]
+        operands = [a, b, c]
+        for i in range(3):
+            if kinds[i] in "rwmex" and operands[i] >= 0:
+                used[operands[i]] = True
+
+    regmap = [-1] * len(data)
+    newdata = []
+    for reg in range(len(data)):
+        if used[reg]:
+            regmap[reg] = len(newdata)
+            newdata.append(data[reg])
+    return remap_registers(bytecode, regmap), newdata, regmap
+
+
+class InlineCandidate(object):
+    """
+    What the inliner needs to know about a function it can inline
+    """
+    def __init__(self, func):
+        self.func = func
+        self.written = _written_registers(func.bytecode, len(func.data))
+        self.live = Liveness(func.bytecode).live_in[0]
+
+
+class Inliner(object):
+    def __init__(self, module, budget):
+        self.module = module
+        self.budget = budget
+        self.pool = module.constpool
+
+        # names of functions that are done, and the ones being worked on
+        self.done = {}
+        self.visiting = {}
+        # name -> InlineCandidate, or None if it can't be inlined
+        self.candidates = {}
+
+    def run(self):
+        for name in self.module.funcs.keys():
+            self.process(name)
+
+    def process(self, name):
+        if name in self.done or name in self.visiting:
+            return
+        func = self.module.get_func(name)
+        if not func.is_complete:
+            self.done[name] = True
+            return
+
+        # anything it calls gets done first, so it's as small as it's going to get
+        self.visiting[name] = True
+        for callee in self.called_names(func):
+            if self.module.contains_func(callee):
+                self.process(callee)
+        del self.visiting[name]
+
+        newfunc = self.inline_calls(func)
+        if newfunc is not None:
+            self.module.set_func(name, newfunc)
+        self.done[name] = True
+
+    def called_names(self, func):
+        names = []
+        for inst, a, b, c in func.bytecode:
+            if (inst == INST['CALL'] or inst == INST['TAILCALL']) and is_const(a):
+                names.append(func.getoperand(a).str_py())
+        return names
+
+    def candidate(self, name):
+        """
+        Returns the InlineCandidate for the named function, or None if calls to it
+        can't be inlined
+        """
+        if name in self.candidates:
+            return self.candidates[name]
+        cand = None
+        if self.module.contains_func(name):
+            func = self.module.get_func(name)
+            if self._can_inline(func):
+                cand = InlineCandidate(func)
+                # registers that each call gets a fresh copy of have to be reset
+                # for every inlined copy, which only works for simple values
+                for reg in cand.live:
+                    if reg >= len(func.args) and cand.written[reg] and \
+                            not ConstPool.can_pool(func.data[reg]):
+                        cand = None
+                        break
+        self.candidates[name] = cand
+        return cand
+
+    def _can_inline(self, func):
+        if not func.is_complete or len(func.bytecode) > self.budget:
+            return False
+        if func.consts is not self.pool.values:
+            return False
+        for inst, a, b, c in func.bytecode:
+            kinds = INST_OPERANDS[inst]
+            # nothing that calls something else or hands out references
+            if inst == INST['TAILCALL'] or "x" in kinds or "e" in kinds:
+                return False
+        return True
+
+    def _call_site(self, func, ptr, refs, targets):
+        """
+        Returns the InlineCandidate for the function called by the CALL at ptr, if
+        the call can be inlined
+        """
+        inst, a, b, c = func.bytecode[ptr]
+        if not is_const(a) or b < 0:
+            return None
+        cand = self.candidate(func.getoperand(a).str_py())
+        if cand is None:
+            return None
+        callee = cand.func
+
+        # the arguments have to be added to the argument list right before the
+        # call, and the list can't be used for anything else
+        numargs = len(callee.args)
+        start = ptr - numargs
+        if start < 0 or refs[b] != numargs + 1:
+            return None
+        arglist = func.data[b]
+        if not isinstance(arglist, types.DList) or arglist.len_py() != 0:
+            return None
+        for i in range(start, ptr):
+            if func.bytecode[i][0] != INST['LIST_ADD'] or func.bytecode[i][1] != b:
+                return None
+            if i > start and i in targets:
+                return None
+        if ptr > start and ptr in targets:
+            return None
+
+        # the return value gets copied into the register the call would have
+        # replaced, so it has to be the same type. A real call hands back the
+        # returned object itself, and arguments are passed by reference, so a
+        # callee that returns one of its arguments can't be turned into a copy
+        if c >= 0:
+            rettype = type(func.data[c])
+            if not ConstPool.can_pool(func.data[c]):
+                return None
+            for inst, a, b, c2 in callee.bytecode:
+                if inst == INST['RET']:
+                    if a == -1 or type(callee.getoperand(a)) is not rettype:
+                        return None
+                    if not is_const(a) and a < numargs:
+                        return None
+        return cand
+
+    def inline_calls(self, func):
+        """
+        Returns a copy of func with the calls that can be inlined replaced by the
+        called function's code, or None if there weren't any
+        """
+        bytecode = func.bytecode
+        numinsts = len(bytecode)
+
+        refs = [0] * len(func.data)
+        targets = {}
+        for inst, a, b, c in bytecode:
+            kinds = INST_OPERANDS[inst]
+            operands = [a, b, c]
+            for i in range(3):
+                if kinds[i] in "rwmex" and operands[i] >= 0:
+                    refs[operands[i]] += 1
+                elif kinds[i] == "j":
+                    targets[operands[i]] = True
+
+        # start of the call sequence -> (CALL ptr, InlineCandidate)
+        sites = {}
+        for ptr in range(numinsts):
+            if bytecode[ptr][0] == INST['CALL']:
+                cand = self._call_site(func, ptr, refs, targets)
+                if cand is not None:
+                    sites[ptr - len(cand.func.args)] = (ptr, cand)
+        if len(sites) == 0:
+            return None
+
+        data = [ val for val in func.data ]
+        code = []
+        info = []
+        # whether the branch target of each new instruction still needs remapping
+        remap = []
+        newpos = [0] * (numinsts + 1)
+        ptr = 0
+        while ptr < numinsts:
+            newpos[ptr] = len(code)
+            if ptr in sites:
+                callptr, cand = sites[ptr]
+                for i in range(ptr + 1, callptr + 1):
+                    newpos[i] = len(code)
+                self._splice(func, data, ptr, callptr, cand, code, info, remap)
+                ptr = callptr + 1
+                continue
+            code.append(bytecode[ptr])
+            info.append(func.lines.annotation(ptr))
+            remap.append(True)
+            ptr += 1
+        newpos[numinsts] = len(code)
+
+        for i in range(len(code)):
+            idx = peephole.branch_operand(code[i][0])
+            if idx != -1 and remap[i]:
+                inst, a, b, c = code[i]
+                operands = [a, b, c]
+                code[i] = peephole._set_operand(code[i], idx, newpos[operands[idx]])
+
+        # the inlined code usually has constant arguments to fold, and the rest of
+        # the compiler's passes have to run over it again
+        vars = func.vars.copy()
+        code, data = fold_constants(code, data, len(func.args), vars.values(), func.consts)
+        code, info = peephole.optimize(code, info)
+        code, data, regmap = _drop_unused_registers(code, data, self._pinned(func, vars))
+        self._remap_vars(vars, regmap)
+        code, data, regmap = pool_constants(code, data, self._pinned(func, vars), self.pool)
+        self._remap_vars(vars, regmap)
+        code, data, regmap = allocate_registers(code, data, self._pinned(func, vars))
+        self._remap_vars(vars, regmap)
+
+        newfunc = types.DFunc.new_func(func.name, func.args, func.rettype)
+        newfunc.set_code(code, LineTable.encode(func.lines.filename, info), data, vars,
+            func.consts)
+        return newfunc
+
+    def _pinned(self, func, vars):
+        pinned = [ i for i in range(len(func.args)) ]
+        for idx in vars.values():
+            pinned.append(idx)
+        return pinned
+
+    def _remap_vars(self, vars, regmap):
+        for name, idx in vars.items():
+            vars[name] = regmap[idx]
+
+    def _splice(self, func, data, start, callptr, cand, code, info, remap):
+        """
+        Appends a copy of the called function's code that works on the caller's
+        registers, in place of the call sequence from start to callptr
+        """
+        callee = cand.func
+        numargs = len(callee.args)
+        ret = func.bytecode[callptr][3]
+        callinfo = func.lines.annotation(callptr)
+
+        regmap = [-1] * len(callee.data)
+        setup = []
+        for i in range(numargs):
+            arg = func.bytecode[start + i][2]
+            if is_const(arg) and cand.written[i]:
+                # constants get copied when they're passed
+                reg = len(data)
+                data.append(func.getoperand(arg).copy())
+                setup.append((INST['SET'], arg, reg, -1))
+                regmap[i] = reg
+            else:
+                regmap[i] = arg
+        for reg in range(numargs, len(callee.data)):
+            val = callee.data[reg]
+            if not cand.written[reg] and ConstPool.can_pool(val):
+                regmap[reg] = const_operand(self.pool.add(val))
+            elif not cand.written[reg]:
+                # never modified, so it can be shared
+                regmap[reg] = len(data)
+                data.append(val)
+            else:
+                regmap[reg] = len(data)
+                data.append(val.copy())
+                if reg in cand.live:
+                    setup.append((INST['SET'], const_operand(self.pool.add(val)),
+                        regmap[reg], -1))
+
+        # where each of the callee's instructions ends up
+        base = len(code) + len(setup)
+        newpos = [0] * (len(callee.bytecode) + 1)
+        pos = base
+        for i in range(len(callee.bytecode)):
+            newpos[i] = pos
+            if callee.bytecode[i][0] == INST['RET'] and ret >= 0:
+                pos += 2
+            else:
+                pos += 1
+        end = pos
+        newpos[len(callee.bytecode)] = end
+
+        label = BytecodeAnnotation(callinfo.filename, callinfo.source,
+            comment="inlined %s" % callee.name)
+        for instruction in setup:
+            code.append(instruction)
+            info.append(label)
+            remap.append(False)
+            label = None
+
+        for i in range(len(callee.bytecode)):
+            inst, a, b, c = callee.bytecode[i]
+            kinds = INST_OPERANDS[inst]
+            operands = [a, b, c]
+            for j in range(3):
+                if kinds[j] in "rwm" and operands[j] >= 0:
+                    operands[j] = regmap[operands[j]]
+                elif kinds[j] == "j":
+                    operands[j] = newpos[operands[j]]
+
+            calleeinfo = callee.lines.annotation(i).prefixed(label)
+            label = None
+
+            if inst == INST['RET']:
+                if ret >= 0:
+                    code.append((INST['SET'], operands[0], ret, -1))
+                    info.append(calleeinfo)
+                    remap.append(False)
+                    calleeinfo = BytecodeAnnotation(calleeinfo.filename, calleeinfo.source)
+                code.append((INST['JMP'], end, -1, -1))
+            else:
+                code.append((inst, operands[0], operands[1], operands[2]))
+            info.append(calleeinfo)
+            remap.append(False)
+
+
+def inline_functions(module, budget=INLINE_BUDGET):
+    """
+    Inlines calls to the module's functions that are no more than budget
+    instructions long and don't call anything themselves. Functions that have
+    calls inlined into them are replaced with new function objects.
+    """
+    Inliner(module, budget).run()
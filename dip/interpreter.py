@@ -9,7 +9,7 @@ jitdriver = jit.JitDriver(greens=['ptr', 'bytecode'], reds="auto")
 
 # make all the bytecode instructions constants in this module's namespace
 import bytecode
-from bytecode import INST_STRS
+from bytecode import INST_STRS, format_operands, is_const, const_index
 for inst in bytecode.INSTRUCTION_SET:
     globals()[inst] = bytecode.INST[inst]
 
@@ -21,7 +21,7 @@ class InterpreterError(Exception):
         self.message = message
 
     def getsource(self):
-        return self.frame.func.bytecode_info[self.frame.ptr].source
+        return self.frame.func.lines.getsource(self.frame.ptr)
 
     def getmessage(self):
         bytecode = self.frame.bytecode[self.frame.ptr]
@@ -52,6 +52,8 @@ class Frame(object):
         self.bytecode = func.bytecode
         # data registers
         self.data = dataregs
+        # the module's constant pool
+        self.consts = func.consts
         # variable names
         self.vars = func.vars.copy()
 
@@ -82,14 +84,9 @@ class Frame(object):
     def toString(self):
         bc = []
         for i, (inst, a, b, c) in enumerate(self.bytecode):
-            args = []
-            for val in [a, b, c]:
-                if val != -1:
-                    args.append(str(val))
-
             instname = INST_STRS[inst]
-            argnames = ", ".join(args)
-            comment = self.func.bytecode_info[i].comment
+            argnames = ", ".join(format_operands(inst, a, b, c, self.consts))
+            comment = self.func.lines.describe(i)
             if len(comment) > 0:
                 comment = " # %s" % comment
             bc.append("    %s : %s (%s)%s" % (i, instname, argnames, comment))
@@ -106,6 +103,24 @@ class Frame(object):
     def __str__(self):
         return self.toString()
 
+    def getreg(self, idx):
+        """
+        Returns the value of a read-only operand, which is either a data register
+        or a constant from the pool. Constants must not be modified.
+        """
+        if is_const(idx):
+            return self.consts[const_index(idx)]
+        return self.data[idx]
+
+    def getreg_owned(self, idx):
+        """
+        Same as getreg, but copies constants, for values that get handed out to
+        other code that may modify them
+        """
+        if is_const(idx):
+            return self.consts[const_index(idx)].copy()
+        return self.data[idx]
+
 
 class VirtualMachine(object):
     def __init__(self, args, cb=None, debug=False):
@@ -118,10 +133,23 @@ class VirtualMachine(object):
     def setglobals(self, namespace):
         self.globals = namespace
 
-    def callstack_push(self, funcname, args):
+    def mkframe(self, funcname, args):
         assert isinstance(args, DList)
         func = self.globals.get_func(funcname)
-        self.callstack.append(Frame(func, func.mkdatareg(args)))
+        if not func.is_complete:
+            # lazily built modules only compile a function the first time it's called
+            func = self.globals.compile_func(funcname)
+        return Frame(func, func.mkdatareg(args))
+
+    def callstack_push(self, funcname, args):
+        self.callstack.append(self.mkframe(funcname, args))
+
+    def callstack_replace(self, funcname, args):
+        """
+        Replaces the frame on top of the callstack with one for the given function,
+        which returns to wherever the replaced one would have
+        """
+        self.callstack[-1] = self.mkframe(funcname, args)
 
     def run(self, pass_argv=True):
         debug = self.debug
@@ -164,7 +192,10 @@ class VirtualMachine(object):
 
                 inst, a, b, c = frame.bytecode[frame.ptr]
 
-                if inst == PASS or inst == LABEL:
+                # step over labels and no-ops without a trip through the dispatch
+                # below. the peephole pass removes them, but -O0 code and
+                # hand-written bytecode still have them.
+                while inst == PASS or inst == LABEL:
                     if debug:
                         print frame.ptr, INST_STRS[inst], a, b, c
                     frame.ptr += 1
@@ -180,9 +211,9 @@ class VirtualMachine(object):
 
                 if inst == JMP:
                     assert a >= 0 and a < len(frame.bytecode)
-                    # give the JIT engine a hint that we're about to step backwards
-                    if a < frame.ptr:
-                        jitdriver.can_enter_jit(ptr=frame.ptr, bytecode=frame.bytecode)
+                    # no can_enter_jit hint for backward jumps: the driver uses
+                    # reds="auto", which finds loops from jit_merge_point alone and
+                    # doesn't allow the hint at all
                     frame.ptr = a
                     continue
 
@@ -193,14 +224,15 @@ class VirtualMachine(object):
                 #   a = dataidx of source value
                 #   b = dataidx of dest value
                 elif inst == SET:
+                    src = frame.getreg(a)
                     if isinstance(data[b], types.DInteger):
-                        data[b].assign_int(data[a].int_py())
+                        data[b].assign_int(src.int_py())
                     elif isinstance(data[b], types.DBool):
-                        data[b].assign_bool(data[a].bool_py())
+                        data[b].assign_bool(src.bool_py())
                     elif isinstance(data[b], types.DFloat):
-                        data[b].assign_float(data[a].float_py())
+                        data[b].assign_float(src.float_py())
                     elif isinstance(data[b], types.DString):
-                        data[b].assign_str(data[a].str_py())
+                        data[b].assign_str(src.str_py())
                     else:
                         raise TypeError(INST_STRS[inst])
 
@@ -220,26 +252,84 @@ class VirtualMachine(object):
                     data[a].assign_int(data[a].int_py() // b)
 
                 elif inst in (ADD, SUB, MUL, DIV):
+                    lhs = frame.getreg(a)
+                    rhs = frame.getreg(b)
                     if isinstance(data[c], types.DInteger):
-                        data[c].assign_int(data[a].operator_int(bytecode.OPERATOR_MAP[inst], data[b]))
+                        data[c].assign_int(lhs.operator_int(bytecode.OPERATOR_MAP[inst], rhs))
                     elif isinstance(data[c], types.DFloat):
-                        data[c].assign_float(data[a].operator_float(bytecode.OPERATOR_MAP[inst], data[b]))
+                        data[c].assign_float(lhs.operator_float(bytecode.OPERATOR_MAP[inst], rhs))
                     elif isinstance(data[c], types.DString):
-                        data[c].assign_str(data[a].operator_str(bytecode.OPERATOR_MAP[inst], data[b]))
+                        data[c].assign_str(lhs.operator_str(bytecode.OPERATOR_MAP[inst], rhs))
                     else:
                         raise TypeError(INST_STRS[inst])
 
+                # type-specialized arithmetic:
+                #   Same as ADD/SUB/MUL/DIV, but the compiler has already checked the
+                #   types. _II: ints in, int out. _FF: ints or floats in, float out.
+                #   CONCAT_SS: strings in, string out.
+                elif inst == ADD_II:
+                    data[c].assign_int(frame.getreg(a).int_py() + frame.getreg(b).int_py())
+                elif inst == SUB_II:
+                    data[c].assign_int(frame.getreg(a).int_py() - frame.getreg(b).int_py())
+                elif inst == MUL_II:
+                    data[c].assign_int(frame.getreg(a).int_py() * frame.getreg(b).int_py())
+                elif inst == DIV_II:
+                    data[c].assign_int(frame.getreg(a).int_py() // frame.getreg(b).int_py())
+
+                elif inst == ADD_FF:
+                    data[c].assign_float(frame.getreg(a).float_py() + frame.getreg(b).float_py())
+                elif inst == SUB_FF:
+                    data[c].assign_float(frame.getreg(a).float_py() - frame.getreg(b).float_py())
+                elif inst == MUL_FF:
+                    data[c].assign_float(frame.getreg(a).float_py() * frame.getreg(b).float_py())
+                elif inst == DIV_FF:
+                    data[c].assign_float(frame.getreg(a).float_py() / frame.getreg(b).float_py())
+
+                elif inst == CONCAT_SS:
+                    data[c].assign_str(frame.getreg(a).str_py() + frame.getreg(b).str_py())
+
+                # _IM instructions:
+                #   Same as the _II ones, but the right-hand value is an integer
+                #   literal instead of a data register
+                #
+                #   Arguments:
+                #   a = dataidx of the left-hand value
+                #   b = integer value
+                #   c = dataidx of dest value
+                elif inst == ADD_IM:
+                    data[c].assign_int(frame.getreg(a).int_py() + b)
+                elif inst == SUB_IM:
+                    data[c].assign_int(frame.getreg(a).int_py() - b)
+                elif inst == MUL_IM:
+                    data[c].assign_int(frame.getreg(a).int_py() * b)
+                elif inst == DIV_IM:
+                    data[c].assign_int(frame.getreg(a).int_py() // b)
+
+                elif inst == EQ_IM:
+                    data[c].assign_bool(frame.getreg(a).int_py() == b)
+                elif inst == NEQ_IM:
+                    data[c].assign_bool(frame.getreg(a).int_py() != b)
+                elif inst == GT_IM:
+                    data[c].assign_bool(frame.getreg(a).int_py() > b)
+                elif inst == LT_IM:
+                    data[c].assign_bool(frame.getreg(a).int_py() < b)
+                elif inst == GTE_IM:
+                    data[c].assign_bool(frame.getreg(a).int_py() >= b)
+                elif inst == LTE_IM:
+                    data[c].assign_bool(frame.getreg(a).int_py() <= b)
+
                 elif inst == SQRT:
-                    data[b].assign_float(data[a].sqrt_py())
+                    data[b].assign_float(frame.getreg(a).sqrt_py())
 
                 elif inst == LEN:
-                    data[b].assign_int(data[a].len_py())
+                    data[b].assign_int(frame.getreg(a).len_py())
 
                 elif inst in (EQ, NEQ, GT, LT, GTE, LTE):
-                    data[c].assign_bool(data[a].operator_bool(bytecode.OPERATOR_MAP[inst], data[b]))
+                    data[c].assign_bool(frame.getreg(a).operator_bool(bytecode.OPERATOR_MAP[inst],
+                        frame.getreg(b)))
 
                 elif inst == CALL:
-                    callable_name = data[a]
+                    callable_name = frame.getreg(a)
                     assert type(callable_name) is DString # func name
                     assert callable_name.len_py() > 0
                     assert isinstance(data[b], DList) # args
@@ -270,66 +360,132 @@ class VirtualMachine(object):
                         print "Error calling '%s': item cannot be found." % name
                         break
 
+                # TAILCALL:
+                #   Calls a function and returns whatever it returns. The called
+                #   function's frame replaces the current one.
+                #
+                #   Arguments:
+                #   a = dataidx of the function name
+                #   b = dataidx of the argument list
+                elif inst == TAILCALL:
+                    callable_name = frame.getreg(a)
+                    assert type(callable_name) is DString # func name
+                    assert isinstance(data[b], DList) # args
+                    name = callable_name.str_py()
+
+                    if not self.globals.contains_func(name):
+                        print "Error calling '%s': item cannot be found." % name
+                        break
+
+                    self.callstack_replace(name, data[b])
+
+                    if debug:
+                        print "------- tail call %s ------- (stacksize: %s)" % (a, len(self.callstack))
+                    continue
+
                 elif inst == BT:
                     assert b >= 0 and b < len(frame.bytecode)
-                    assert isinstance(data[a], DBase)
-                    if data[a].bool_py() == True:
+                    if frame.getreg(a).bool_py() == True:
                         frame.ptr = b
                         continue
 
                 elif inst == BF:
                     assert b >= 0 and b < len(frame.bytecode)
-                    assert isinstance(data[a], DBase)
-                    if data[a].bool_py() == False:
+                    if frame.getreg(a).bool_py() == False:
                         frame.ptr = b
                         continue
 
                 elif inst == BNE:
                     assert c >= 0 and c < len(frame.bytecode)
-                    assert isinstance(data[a], DBase)
-                    if data[a].operator_bool('!=', data[b]):
+                    if frame.getreg(a).operator_bool('!=', frame.getreg(b)):
                         frame.ptr = c
                         continue
 
                 elif inst == BEQ:
                     assert c >= 0 and c < len(frame.bytecode)
-                    assert isinstance(data[a], DBase)
-                    if data[a].operator_bool('==', data[b]):
+                    if frame.getreg(a).operator_bool('==', frame.getreg(b)):
+                        frame.ptr = c
+                        continue
+
+                # fused compare-and-branch instructions:
+                #   Compares two values and jumps if the comparison is true
+                #
+                #   Arguments:
+                #   a = dataidx of the left-hand value
+                #   b = dataidx of the right-hand value
+                #   c = instruction pointer to jump to
+                elif inst in (BLT, BGT, BLE, BGE):
+                    assert c >= 0 and c < len(frame.bytecode)
+                    if frame.getreg(a).operator_bool(bytecode.OPERATOR_MAP[inst], frame.getreg(b)):
+                        frame.ptr = c
+                        continue
+
+                # compare-and-branch with an integer literal:
+                #   Same as above, for an integer register and b an integer value
+                elif inst == BEQ_IM:
+                    assert c >= 0 and c < len(frame.bytecode)
+                    if frame.getreg(a).int_py() == b:
+                        frame.ptr = c
+                        continue
+                elif inst == BNE_IM:
+                    assert c >= 0 and c < len(frame.bytecode)
+                    if frame.getreg(a).int_py() != b:
+                        frame.ptr = c
+                        continue
+                elif inst == BLT_IM:
+                    assert c >= 0 and c < len(frame.bytecode)
+                    if frame.getreg(a).int_py() < b:
+                        frame.ptr = c
+                        continue
+                elif inst == BGT_IM:
+                    assert c >= 0 and c < len(frame.bytecode)
+                    if frame.getreg(a).int_py() > b:
+                        frame.ptr = c
+                        continue
+                elif inst == BLE_IM:
+                    assert c >= 0 and c < len(frame.bytecode)
+                    if frame.getreg(a).int_py() <= b:
+                        frame.ptr = c
+                        continue
+                elif inst == BGE_IM:
+                    assert c >= 0 and c < len(frame.bytecode)
+                    if frame.getreg(a).int_py() >= b:
                         frame.ptr = c
                         continue
 
                 elif inst == WRITEI:
-                    assert type(data[b]) is DInteger
-                    intval = data[b].int_py()
+                    charval = frame.getreg(b)
+                    assert type(charval) is DInteger
+                    intval = charval.int_py()
                     if not we_are_translated():
                         assert type(intval) is int
                     frame.streams[a].write(chr(intval))
 
                 elif inst == WRITEO:
-                    frame.streams[a].write(data[b].str_py())
+                    frame.streams[a].write(frame.getreg(b).str_py())
 
                 elif inst == WRITENL:
                     frame.streams[a].write("\n")
 
                 elif inst == RET:
+                    # the caller may modify the return value, so constants get copied
+                    if a != -1:
+                        retval = frame.getreg_owned(a)
+                    else:
+                        retval = null
+
                     self.callstack.pop(-1)
                     if len(self.callstack) == 0:
                         if debug:
                             print "Exit: return called from main"
                         if self.cb is not None:
-                            self.cb(data[a])
+                            self.cb(retval)
                         break
                     nextframe = self.callstack[-1]
 
-                    assert isinstance(data[a], DBase)
-
-                    # if we have a return value, let the next frame know about it
-                    if a >= 0:
-                        nextframe.data[nextframe.ret] = data[a]
-
-                    # otherwise return null
-                    else:
-                        nextframe.data[nextframe.ret] = null
+                    # let the next frame know about the return value, if it wants it
+                    if nextframe.ret >= 0:
+                        nextframe.data[nextframe.ret] = retval
 
                     if debug:
                         print "------- return ------- (stacksize: %s)" % len(self.callstack)
@@ -337,7 +493,7 @@ class VirtualMachine(object):
 
                 elif inst == EXIT:
                     print "Exit: syscall"
-                    assert type(data[a]) is DInteger
+                    assert type(frame.getreg(a)) is DInteger
                     break
                     #sys.exit(data[a].val)
 
@@ -346,18 +502,16 @@ class VirtualMachine(object):
 
                 elif inst == LIST_ADD:
                     assert type(data[a]) is DList
-                    assert isinstance(data[b], DBase)
-                    data[a].append(data[b])
+                    # the list holds on to the object itself, so constants get copied
+                    data[a].append(frame.getreg_owned(b))
 
                 elif inst == LIST_REM:
                     assert type(data[a]) is DList
-                    assert isinstance(data[b], DBase)
-                    data[a].pop(data[b])
+                    data[a].pop(frame.getreg(b))
 
                 elif inst == LIST_POP:
                     assert type(data[a]) is DList
-                    assert isinstance(data[b], DBase)
-                    data[c] = data[a].pop(data[b])
+                    data[c] = data[a].pop(frame.getreg(b))
 
                 frame.ptr += 1
 
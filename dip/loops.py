@@ -0,0 +1,389 @@
+"""
+Loop optimizations on compiled bytecode
+
+Loop bodies get compiled as-is, so anything in them that works out the same value
+on every pass (the length of a list that doesn't change, arithmetic on values set
+before the loop, ...) gets recomputed on every pass. This finds the loops in a
+function's bytecode and moves those instructions into a preheader that runs once
+before the loop starts. Multiplications of the loop counter by a value that doesn't
+change are also replaced by a running total that's updated whenever the counter
+is.
+"""
+import typesystem as types
+from bytecode import INST, INST_OPERANDS, BytecodeAnnotation
+from constfold import is_pure_def
+from regalloc import Liveness, successors
+from cfg import ControlFlowGraph, dominates, ENTRY_DEF
+import peephole
+
+# instructions that can't fail at run-time, so they can be moved out of the loop
+# even when they're not run on every pass
+SAFE_INSTS = {
+    INST['ADD_II']: True, INST['SUB_II']: True, INST['MUL_II']: True,
+    INST['ADD_FF']: True, INST['SUB_FF']: True, INST['MUL_FF']: True,
+    INST['CONCAT_SS']: True,
+    INST['ADD_IM']: True, INST['SUB_IM']: True, INST['MUL_IM']: True,
+    INST['EQ_IM']: True, INST['NEQ_IM']: True, INST['GT_IM']: True,
+    INST['LT_IM']: True, INST['GTE_IM']: True, INST['LTE_IM']: True,
+}
+
+
+def find_loops(bytecode):
+    """
+    Returns a list of (header, latch) pairs, one for every loop in the bytecode,
+    innermost first. The loop is every instruction from header to latch, latch
+    being the branch back to the header. Only loops that can't be entered anywhere
+    other than at the header are returned.
+    """
+    cfg = ControlFlowGraph(bytecode)
+    idom = cfg.dominators()
+
+    # the natural loops with the same header are all one loop here, which has to
+    # start at the header
+    headers = []
+    ends = {}
+    broken = {}
+    for header, inloop in cfg.natural_loops():
+        for block in cfg.blocks:
+            if inloop[block.index] and len(block.insts) > 0:
+                if block.start < cfg.blocks[header].start:
+                    broken[header] = True
+                end = block.start + len(block.insts) - 1
+                if header not in ends:
+                    headers.append(header)
+                    ends[header] = end
+                elif end > ends[header]:
+                    ends[header] = end
+
+    found = []
+    for header in headers:
+        if header in broken:
+            continue
+        start = cfg.blocks[header].start
+        latch = ends[header]
+        # everything laid out between the header and the latch has to be inside the
+        # loop, only reachable through the header
+        inside = True
+        for block in cfg.blocks:
+            if block.start >= start and block.start <= latch and \
+                    not dominates(idom, header, block.index):
+                inside = False
+        if inside:
+            found.append((start, latch))
+
+    # smallest first, so inner loops come before the loops around them
+    result = []
+    while len(found) > 0:
+        best = 0
+        for i in range(1, len(found)):
+            header, latch = found[i]
+            if latch - header < found[best][1] - found[best][0]:
+                best = i
+        result.append(found.pop(best))
+    return result
+
+
+def _dest(instruction):
+    """ Returns the register a pure instruction writes to """
+    inst, a, b, c = instruction
+    kinds = INST_OPERANDS[inst]
+    operands = [a, b, c]
+    for i in range(3):
+        if kinds[i] == "w":
+            return operands[i]
+    return -1
+
+
+class LoopOptimizer(object):
+    def __init__(self, bytecode, bytecode_info, data, argcount):
+        self.bytecode = bytecode
+        self.bytecode_info = bytecode_info
+        self.data = data
+
+        # registers that something else may hold a reference to, so their value
+        # can change behind the loop's back
+        self.shared = [False] * len(data)
+        for inst, a, b, c in bytecode:
+            kinds = INST_OPERANDS[inst]
+            operands = [a, b, c]
+            for i in range(3):
+                if (kinds[i] == "e" or kinds[i] == "x") and operands[i] >= 0:
+                    self.shared[operands[i]] = True
+
+        # writes to arguments are seen by the caller, so they have to stay put
+        self.fixed = [ reg < argcount or self.shared[reg] for reg in range(len(data)) ]
+
+        # number of instructions anywhere in the function that write each register
+        self.defs = [0] * len(data)
+        for ptr in range(len(bytecode)):
+            self._count_defs(self.defs, bytecode[ptr], 1)
+
+    def _count_defs(self, defs, instruction, delta):
+        inst, a, b, c = instruction
+        kinds = INST_OPERANDS[inst]
+        operands = [a, b, c]
+        for i in range(3):
+            if (kinds[i] == "w" or kinds[i] == "m" or kinds[i] == "x") and operands[i] >= 0:
+                defs[operands[i]] += delta
+
+    def run(self):
+        """
+        Returns the new (bytecode, bytecode_info, data)
+        """
+        changed = True
+        while changed:
+            changed = False
+            for header, latch in find_loops(self.bytecode):
+                if self.optimize_loop(header, latch):
+                    # everything moved around, so find the loops again
+                    changed = True
+                    break
+        return self.bytecode, self.bytecode_info, self.data
+
+    def _new_register(self, val):
+        self.data.append(val)
+        self.shared.append(False)
+        self.fixed.append(False)
+        self.defs.append(0)
+        return len(self.data) - 1
+
+    def optimize_loop(self, header, latch):
+        """
+        Hoists invariant instructions out of the loop and reduces multiplications of
+        its counter. Returns True if anything changed.
+        """
+        bytecode = self.bytecode
+        live = Liveness(bytecode)
+        live_in = live.live_in[header]
+
+        loopdefs = [0] * len(self.data)
+        for ptr in range(header, latch + 1):
+            self._count_defs(loopdefs, bytecode[ptr], 1)
+
+        # a value read in the loop is the same on every pass if none of the writes it
+        # may come from are made in the loop. writes that get hoisted stop counting.
+        chains = ControlFlowGraph(bytecode).def_use()
+        inside = [ False ] * len(chains.defs)
+        for id in range(len(chains.defs)):
+            pos = chains.position(id)
+            inside[id] = pos >= header and pos <= latch
+
+        # registers whose value might still be needed once the loop is done
+        exitlive = {}
+        for ptr in range(header, latch + 1):
+            for target in successors(bytecode, ptr):
+                if target < header or target > latch:
+                    for reg in live.live_in[target]:
+                        exitlive[reg] = True
+        if latch + 1 < len(bytecode):
+            for reg in live.live_in[latch + 1]:
+                exitlive[reg] = True
+
+        preheader = []
+        removed = {}
+        # ptr -> instructions to add right after it
+        added = {}
+
+        # invariant code motion
+        straight = True # still in the part of the body that runs on every pass
+        for ptr in range(header, latch + 1):
+            instruction = bytecode[ptr]
+            inst = instruction[0]
+            if not is_pure_def(inst):
+                straight = False
+                continue
+            dest = _dest(instruction)
+            if self._can_hoist(ptr, dest, loopdefs, chains, inside, live_in, exitlive,
+                    straight):
+                preheader.append(ptr)
+                removed[ptr] = True
+                self._count_defs(loopdefs, instruction, -1)
+                for id in range(len(chains.defs)):
+                    if chains.position(id) == ptr:
+                        inside[id] = False
+
+        # strength reduction
+        inductions = {}
+        for ptr in range(header, latch + 1):
+            inst, a, b, c = bytecode[ptr]
+            if (inst == INST['ADDI'] or inst == INST['SUBI']) and loopdefs[a] == 1 and \
+                    not self.fixed[a]:
+                step = b
+                if inst == INST['SUBI']:
+                    step = -b
+                inductions[a] = (ptr, step)
+
+        # (ptr, induction register, multiplier register or -1 for an immediate)
+        reduced = []
+        for ptr in range(header, latch + 1):
+            if ptr in removed:
+                continue
+            inst, a, b, c = bytecode[ptr]
+            if inst == INST['MUL_IM']:
+                if a not in inductions or c == a or loopdefs[c] != 1 or self.fixed[c] or \
+                        c in live_in or c in exitlive:
+                    continue
+                reduced.append((ptr, a, -1))
+                continue
+            if inst != INST['MUL_II']:
+                continue
+            if a in inductions and a != b and self._invariant(ptr, b, chains, inside):
+                counter, factor = a, b
+            elif b in inductions and a != b and self._invariant(ptr, a, chains, inside):
+                counter, factor = b, a
+            else:
+                continue
+            if c == counter or c == factor or loopdefs[c] != 1 or self.fixed[c] or \
+                    c in live_in or c in exitlive:
+                continue
+            reduced.append((ptr, counter, factor))
+
+        if len(preheader) == 0 and len(reduced) == 0:
+            return False
+
+        preinsts = []
+        preinfo = []
+        for ptr in preheader:
+            preinsts.append(bytecode[ptr])
+            preinfo.append(self.bytecode_info[ptr])
+
+        for ptr, counter, factor in reduced:
+            inst, a, b, total = bytecode[ptr]
+            info = self.bytecode_info[ptr]
+            removed[ptr] = True
+            countptr, step = inductions[counter]
+
+            # start the total at counter * factor, and keep it that way by adding
+            # step * factor whenever the counter changes
+            preinsts.append(bytecode[ptr])
+            preinfo.append(info)
+            if factor == -1:
+                update = (INST['ADDI'], total, step * b, -1)
+            elif self.defs[factor] == 0 and not self.fixed[factor] and \
+                    isinstance(self.data[factor], types.DInteger):
+                update = (INST['ADDI'], total, step * self.data[factor].int_py(), -1)
+            else:
+                stepreg = self._new_register(types.DInteger.new_int(step))
+                increment = self._new_register(types.DInteger())
+                preinsts.append((INST['MUL_II'], factor, stepreg, increment))
+                preinfo.append(info)
+                update = (INST['ADD_II'], total, increment, total)
+            if countptr not in added:
+                added[countptr] = []
+            added[countptr].append((update, BytecodeAnnotation(info.filename, info.source)))
+
+        self._rebuild(header, latch, preinsts, preinfo, removed, added)
+        return True
+
+    def _invariant(self, ptr, reg, chains, inside):
+        """
+        Returns True if the value the instruction at ptr reads from reg is the same
+        on every pass through the loop
+        """
+        if reg < 0 or self.shared[reg]:
+            return False
+        ids = chains.reaching_at(ptr, reg)
+        if ids is None:
+            return False
+        for id in ids:
+            if id != ENTRY_DEF and inside[id]:
+                return False
+        return True
+
+    def _can_hoist(self, ptr, dest, loopdefs, chains, inside, live_in, exitlive, straight):
+        instruction = self.bytecode[ptr]
+        inst, a, b, c = instruction
+        if dest < 0 or self.fixed[dest] or loopdefs[dest] != 1:
+            return False
+        # the value from before the loop (or the last pass) is still needed
+        if dest in live_in:
+            return False
+        kinds = INST_OPERANDS[inst]
+        operands = [a, b, c]
+        for i in range(3):
+            if kinds[i] == "r" and not self._invariant(ptr, operands[i], chains, inside):
+                return False
+        if straight:
+            return True
+        # instructions that only run on some passes can only be moved if that can't
+        # make a difference: they can't fail, and the value isn't used afterwards
+        return inst in SAFE_INSTS and dest not in exitlive
+
+    def _rebuild(self, header, latch, preinsts, preinfo, removed, added):
+        bytecode = self.bytecode
+        numinsts = len(bytecode)
+        code = []
+        info = []
+        newpos = [0] * (numinsts + 1)
+        for ptr in range(header):
+            newpos[ptr] = len(code)
+            code.append(bytecode[ptr])
+            info.append(self.bytecode_info[ptr])
+        preheader = len(code)
+        for i in range(len(preinsts)):
+            code.append(preinsts[i])
+            info.append(preinfo[i])
+
+        # whatever the first instruction of the loop was labeled with stays at the
+        # top of the loop
+        label = None
+        if header in removed:
+            annotation = self.bytecode_info[header]
+            label = annotation
+            for i in range(len(preinsts)):
+                if preinfo[i] is annotation:
+                    info[preheader + i] = BytecodeAnnotation(annotation.filename,
+                        annotation.source)
+
+        for ptr in range(header, numinsts):
+            newpos[ptr] = len(code)
+            if ptr in removed:
+                continue
+            code.append(bytecode[ptr])
+            annotation = self.bytecode_info[ptr]
+            annotation = annotation.prefixed(label)
+            label = None
+            info.append(annotation)
+            if ptr in added:
+                for instruction, annotation in added[ptr]:
+                    code.append(instruction)
+                    info.append(annotation)
+        newpos[numinsts] = len(code)
+
+        # branches into the loop from outside go through the preheader, the branch
+        # back to the top of the loop skips it
+        for ptr in range(numinsts):
+            if ptr in removed:
+                continue
+            idx = peephole.branch_operand(bytecode[ptr][0])
+            if idx == -1:
+                continue
+            inst, a, b, c = bytecode[ptr]
+            operands = [a, b, c]
+            target = operands[idx]
+            if target == header and (ptr < header or ptr > latch):
+                newtarget = preheader
+            else:
+                newtarget = newpos[target]
+            code[newpos[ptr]] = peephole._set_operand(code[newpos[ptr]], idx, newtarget)
+
+        for ptr in range(header, latch + 1):
+            if ptr in removed:
+                self._count_defs(self.defs, bytecode[ptr], -1)
+        for instruction in preinsts:
+            self._count_defs(self.defs, instruction, 1)
+        for ptr in added:
+            for instruction, annotation in added[ptr]:
+                self._count_defs(self.defs, instruction, 1)
+
+        self.bytecode = code
+        self.bytecode_info = info
+
+
+def optimize_loops(bytecode, bytecode_info, data, argcount):
+    """
+    Runs the loop optimizations over a function's bytecode. argcount is the number
+    of argument registers at the start of data. Returns the new (bytecode,
+    bytecode_info, data).
+    """
+    return LoopOptimizer(bytecode, bytecode_info, [ val for val in data ], argcount).run()
@@ -1,9 +1,17 @@
 from collections import OrderedDict
+import time
 from rpython.rlib.objectmodel import we_are_translated
 
 import typesystem as types
 import errors
 import compiler
+from bytecode import INST
+from constpool import ConstPool
+from inline import inline_functions, INLINE_BUDGET
+from passes import CompileStats, DEFAULT_OPT_LEVEL
+
+# lowest optimization level calls get inlined at
+INLINE_LEVEL = 2
 
 
 class Namespace(object):
@@ -23,6 +31,9 @@ class Namespace(object):
         self.funcs = OrderedDict()
         self.namespaces = OrderedDict()
 
+        # literal values used by the compiled functions, shared between all of them
+        self.constpool = ConstPool()
+
     def set_const(self, name, val):
         if not we_are_translated():
             assert type(name) is str
@@ -67,6 +78,13 @@ class Namespace(object):
             assert type(name) is str
         return self.namespaces[name]
 
+    def compile_func(self, name):
+        """
+        Compiles a function that was only registered as a prototype and returns the
+        complete function object.
+        """
+        raise ValueError("Function '%s' has no code" % name)
+
     def get_type(self, name):
         """
         Returns the type of the specified name
@@ -122,22 +140,239 @@ class Namespace(object):
         return "\n".join(ns)
 
 
+def _compile_func(filename, module, node, stats=None):
+    try:
+        ctx = compiler.FrameCompiler(filename, node, namespace=module,
+            opt_level=module.opt_level, stats=stats)
+        return ctx.mkfunc()
+    except Exception as e:
+        print errors.error_from_exception(filename, node.source, e)
+        raise
+
+
+# per-process state of the parallel compile workers, set by _init_compile_worker
+_compile_worker_state = {}
+
+
+def _init_compile_worker(filename, module):
+    _compile_worker_state["filename"] = filename
+    _compile_worker_state["module"] = module
+
+
+def _compile_worker(node):
+    # each worker has its own copy of the module, so the stats for the function go
+    # back along with it
+    module = _compile_worker_state["module"]
+    stats = None
+    if module.stats is not None:
+        stats = CompileStats()
+    func = _compile_func(_compile_worker_state["filename"], module, node, stats)
+    return func, stats
+
+
+def _compile_parallel(filename, module, nodes, jobs):
+    """
+    Compiles function nodes across a pool of worker processes. Each worker gets its
+    own copy of the module with all of the prototypes from the first pass, which is
+    all that compiling a single function needs. Not available when translated.
+    """
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, _init_compile_worker, (filename, module))
+    try:
+        results = pool.map(_compile_worker, nodes)
+    finally:
+        pool.close()
+        pool.join()
+
+    funcs = []
+    for func, stats in results:
+        funcs.append(func)
+        if stats is not None:
+            for funcstats in stats.funcs:
+                module.stats.add(funcstats)
+
+    # the compiled functions come back with their own unpickled copies of any
+    # struct definitions and of the constant pool, so point them back at the ones
+    # in this module
+    for func in funcs:
+        for val in func.data:
+            if isinstance(val, types.DStructInstance):
+                val.structdef = module.get_struct(val.structdef.name)
+        module.constpool.adopt(func)
+    return funcs
+
+
+def called_names(func):
+    """
+    Returns the names of the functions and structs a compiled function calls
+    """
+    names = []
+    for inst, a, b, c in func.bytecode:
+        if inst == INST['CALL'] or inst == INST['TAILCALL']:
+            name = func.getoperand(a).str_py()
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def prototype_signature(module, name):
+    """
+    Returns a string describing everything about a module-level name that the code
+    calling it gets compiled against.
+    """
+    if module.contains_func(name):
+        func = module.get_func(name)
+        args = [ "%s:%s" % (argname, ".".join(fulltype)) for argname, fulltype in func.args ]
+        return "fn(%s)->%s" % (", ".join(args), ".".join(func.rettype))
+    elif module.contains_struct(name):
+        # reused structs keep their StructDef object, so any change to a struct
+        # means a new StructDef that dependent code has to be recompiled against
+        return "struct@%s" % module.get_struct(name).srchash
+    return ""
+
+
+class IncrementalFunc(object):
+    def __init__(self, srchash, srcline, func, deps):
+        self.srchash = srchash
+        self.srcline = srcline
+        self.func = func
+        # list of (name, prototype signature) pairs this function was compiled against
+        self.deps = deps
+
+
+class IncrementalState(object):
+    """
+    Remembers the structs and compiled functions from the previous build of a
+    module, keyed by a hash of each top-level node's source text. Passing the same
+    state to Module.from_ast again reuses everything whose source (and the
+    prototypes it was compiled against) didn't change.
+    """
+    def __init__(self):
+        self.structs = {}
+        self.funcs = {}
+
+        # stats from the last build
+        self.reused = 0
+        self.compiled = 0
+
+    def reuse_struct(self, node):
+        if node.srchash == "" or node.name not in self.structs:
+            return None
+        struct = self.structs[node.name]
+        if struct.srchash != node.srchash:
+            return None
+        return struct
+
+    def reuse_func(self, module, node):
+        if node.srchash == "" or node.name not in self.funcs:
+            return None
+        entry = self.funcs[node.name]
+        if entry.srchash != node.srchash:
+            return None
+        for name, signature in entry.deps:
+            if prototype_signature(module, name) != signature:
+                return None
+
+        # the source is the same, but it may have moved up or down in the file
+        func = entry.func
+        delta = node.srcline - entry.srcline
+        if delta != 0:
+            func.lines = func.lines.shifted(delta)
+            entry.srcline = node.srcline
+
+        # the constants it uses live in the previous build's pool
+        module.constpool.adopt(func)
+        return func
+
+    def update(self, module, structnodes, funcnodes):
+        """
+        Records the result of a build
+        """
+        self.structs = {}
+        for node in structnodes:
+            self.structs[node.name] = module.get_struct(node.name)
+
+        self.funcs = {}
+        for node in funcnodes:
+            func = module.get_func(node.name)
+            if not func.is_complete:
+                # not compiled yet in lazy mode, so there's nothing to keep
+                continue
+            deps = []
+            for name in called_names(func):
+                deps.append((name, prototype_signature(module, name)))
+            self.funcs[node.name] = IncrementalFunc(node.srchash, node.srcline, func, deps)
+
+
 class Module(Namespace):
+    def __init__(self, name):
+        Namespace.__init__(self, name)
+        self.filename = ""
+        # function nodes that haven't been compiled yet (lazy mode)
+        self.pending = {}
+        # how the functions get compiled, see passes.py
+        self.opt_level = DEFAULT_OPT_LEVEL
+        self.stats = None
+
+    def compile_func(self, name):
+        if name not in self.pending:
+            return Namespace.compile_func(self, name)
+        node = self.pending[name]
+        del self.pending[name]
+        func = _compile_func(self.filename, self, node, self.stats)
+        self.set_func(name, func)
+        return func
+
+    def count_instructions(self):
+        """ Returns the number of instructions in all of the compiled functions """
+        count = 0
+        for func in self.funcs.values():
+            if func.is_complete:
+                count += len(func.bytecode)
+        return count
+
     @staticmethod
-    def from_ast(filename, name, tree):
+    def from_ast(filename, name, tree, jobs=1, incremental=None, lazy=False,
+            inline_budget=INLINE_BUDGET, opt_level=DEFAULT_OPT_LEVEL, stats=None):
+        """
+        Builds a module from a parsed file. If jobs is more than 1, the function
+        bodies are compiled in parallel using that many worker processes. If an
+        IncrementalState is passed in, anything unchanged since the last build
+        with that state is reused instead of being recompiled. If lazy is set,
+        functions are only compiled when they're first called (see compile_func).
+        Calls to functions of up to inline_budget instructions are inlined once
+        everything is compiled (0 turns inlining off, and lazy modules are never
+        inlined).
+
+        opt_level picks which optimization passes run (see passes.py). If a
+        CompileStats is passed in, it gets filled in with what each pass did.
+        """
         module = Module(name)
+        module.filename = filename
+        module.opt_level = opt_level
+        module.stats = stats
 
         # Populate the namespace with all of the top-level objects as a first pass
         # before compiling any code. This way once we do the compilation step,
         # we'll have references to the right types and functions.
 
         # first pass for prototypes
+        structnodes = []
+        funcnodes = []
         for node in tree:
             try:
                 if node.type == "Function":
                     module.set_func(node.name, node.mkprototype())
+                    funcnodes.append(node)
                 elif node.type == "Struct":
-                    module.set_struct(node.name, node.mkstruct())
+                    struct = None
+                    if incremental is not None:
+                        struct = incremental.reuse_struct(node)
+                    if struct is None:
+                        struct = node.mkstruct()
+                        struct.srchash = node.srchash
+                    module.set_struct(node.name, struct)
+                    structnodes.append(node)
                 else:
                     raise ValueError("Unhandled top-level node type '%s'" % node.type)
             except Exception as e:
@@ -145,14 +380,46 @@ class Module(Namespace):
                 raise
 
         # second pass for function bytecode compilation
-        for node in tree:
-            try:
-                if node.type == "Function":
-                    ctx = compiler.FrameCompiler(filename, node, namespace=module)
-                    module.set_func(node.name, ctx.mkfunc())
-            except Exception as e:
-                print errors.error_from_exception(filename, node.source, e)
-                raise
+        tocompile = []
+        for node in funcnodes:
+            func = None
+            if incremental is not None:
+                func = incremental.reuse_func(module, node)
+            if func is not None:
+                module.set_func(node.name, func)
+            else:
+                tocompile.append(node)
+
+        if lazy:
+            for node in tocompile:
+                module.pending[node.name] = node
+        elif jobs > 1 and len(tocompile) > 1 and not we_are_translated():
+            for func in _compile_parallel(filename, module, tocompile, jobs):
+                module.set_func(func.name, func)
+        else:
+            for node in tocompile:
+                module.set_func(node.name, _compile_func(filename, module, node, stats))
+
+        if incremental is not None:
+            incremental.reused = len(funcnodes) - len(tocompile)
+            incremental.compiled = len(tocompile)
+            incremental.update(module, structnodes, funcnodes)
+
+        # the incremental state keeps the functions as they were compiled, since
+        # inlining depends on the current code of everything that gets called
+        if not lazy and inline_budget > 0 and opt_level >= INLINE_LEVEL:
+            before = module.count_instructions()
+            start = time.time()
+            inline_functions(module, inline_budget)
+            if stats is not None:
+                stats.module.add_pass("inline", time.time() - start, before,
+                    module.count_instructions())
+                # inlining replaces functions, so the counts have to be updated
+                for funcstats in stats.funcs:
+                    if module.contains_func(funcstats.name):
+                        func = module.get_func(funcstats.name)
+                        funcstats.instructions = len(func.bytecode)
+                        funcstats.registers = len(func.data)
 
         return module
 
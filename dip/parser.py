@@ -2,46 +2,157 @@
 Dipper parser-generator 
 """
 import os
+import hashlib
 import py
-from rpython.rlib.objectmodel import we_are_translated
-from rpython.rlib.parsing.ebnfparse import parse_ebnf, make_parse_function, EBNFToAST
+from rpython.rlib.objectmodel import we_are_translated, compute_hash
+from rpython.rlib.parsing.ebnfparse import parse_ebnf, check_for_missing_names
+from rpython.rlib.parsing.lexer import Lexer
 from rpython.rlib.parsing.parsing import ParseError
+from rpython.rlib.parsing.deterministic import LexerError
 import rpython.rlib.parsing.tree as parsetree
 
 from dip import ast
-from dip.errors import error_message, error_from_exception
+from dip.errors import error_message, error_from_exception, register_source
 
 #grammar = py.path.local("./dip").join("grammar.txt").read("rt")
 #regexs, rules, astGenerator = parse_ebnf(grammar)
 #parseFunc = make_parse_function(regexs, rules, eof=True)
 
 GRAMMAR_FILE = os.path.join(os.path.dirname(__file__), "grammar.txt")
-TRANSFORMER_FILE = os.path.join(os.path.dirname(__file__), "transformer.py")
-
-with open(GRAMMAR_FILE) as fp:
+PARSETABLES_FILE = os.path.join(os.path.dirname(__file__), "parsetables.py")
+
+# bump this whenever the layout of the generated parsetables module changes so
+# that stale caches get thrown away
+PARSETABLES_VERSION = 1
+
+PARSETABLES_HEADER = "# grammar-hash: "
+
+
+def grammar_hash(grammar):
+    """
+    Returns the cache key for the parse tables generated from the given grammar text
+    """
+    return "%s-%s" % (PARSETABLES_VERSION, hashlib.sha1(grammar).hexdigest())
+
+
+def cached_grammar_hash():
+    """
+    Returns the grammar hash that the parsetables module on disk was generated from,
+    or an empty string if there is no usable cache.
+    """
+    if not os.path.exists(PARSETABLES_FILE):
+        return ""
+    with open(PARSETABLES_FILE) as fp:
+        header = fp.readline().rstrip()
+    if not header.startswith(PARSETABLES_HEADER):
+        return ""
+    return header[len(PARSETABLES_HEADER):]
+
+
+def build_parsetables(grammar, key):
+    """
+    Runs the EBNF parser-generator over the grammar and writes out the lexer DFA,
+    the packrat parser rules and the AST transformer as a plain Python module.
+    """
+    try:
+        regexs, rules, astGenerator = parse_ebnf(grammar)
+    except ParseError as e:
+        pos = e.source_pos
+        print "ParseError on line %s, column %s" % (pos.lineno, pos.columnno)
+        print e.nice_error_message()
+        print ""
+        raise
+
+    names, regexs = zip(*regexs)
+    check_for_missing_names(names, regexs, rules)
+    ignore = ["IGNORE"] if "IGNORE" in names else []
+    lexer = Lexer(list(regexs), list(names), ignore=ignore)
+
+    # RPython can't handle dymanically-generated code, so everything the parser needs
+    # is written out as source and imported, so that it gets compiled to C. It's
+    # written to a file of its own first and moved into place once it's complete, so
+    # an interrupted build (or another process building at the same time) can never
+    # leave a truncated module with a valid grammar hash behind.
+    tmpfile = "%s.%d.tmp" % (PARSETABLES_FILE, os.getpid())
+    try:
+        with open(tmpfile, 'w') as fp:
+            fp.write("%s%s\n" % (PARSETABLES_HEADER, key))
+            fp.write("# auto-generated from grammar.txt by dip/parser.py, don't edit\n")
+            fp.write("import py\n")
+            fp.write("from rpython.rlib.parsing.tree import Nonterminal, RPythonVisitor\n")
+            fp.write("from rpython.rlib.parsing.lexer import DummyLexer\n")
+            fp.write("from rpython.rlib.parsing.deterministic import DFA\n")
+            fp.write("from rpython.rlib.parsing.parsing import PackratParser, Rule\n")
+            fp.write("from rpython.rlib.objectmodel import we_are_translated\n")
+            fp.write("\n\n")
+            fp.write(lexer.get_dummy_repr())
+            fp.write("\n\n")
+            fp.write("rules = %r\n" % (rules,))
+            fp.write("packrat = PackratParser(rules, %r)\n" % rules[0].nonterminal)
+            fp.write("\n\n")
+            fp.write(astGenerator.source)
+        if os.name == "nt" and os.path.exists(PARSETABLES_FILE):
+            # rename doesn't replace an existing file on Windows
+            os.remove(PARSETABLES_FILE)
+        os.rename(tmpfile, PARSETABLES_FILE)
+    except:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+    # don't let an old .pyc with a matching timestamp shadow the new tables
+    if os.path.exists(PARSETABLES_FILE + "c"):
+        os.remove(PARSETABLES_FILE + "c")
+
+
+# Only regenerate the parse tables when the grammar has changed since the last time
+# they were written out. The grammar is read with universal newlines so the hash is
+# the same no matter which line endings the checkout uses.
+with open(GRAMMAR_FILE, "rU") as fp:
     grammar = fp.read()
-try:
-    regexs, rules, astGenerator = parse_ebnf(grammar)
-except ParseError as e:
-    pos = e.source_pos
-    print "ParseError on line %s, column %s" % (pos.lineno, pos.columnno)
-    print e.nice_error_message()
-    print ""
-    raise
-parseFunc = make_parse_function(regexs, rules, eof=True)
-
-# At RPython compile-time, use the AST code-generator to write out the transformer
-# module to a file, then import it, so that it gets compiled to C, since RPython
-# can't handle dymanically-generated code otherwise
-with open(TRANSFORMER_FILE, 'w') as fp:
-    fp.write("import py\n")
-    fp.write("from rpython.rlib.parsing.tree import Nonterminal, RPythonVisitor\n")
-    fp.write("from rpython.rlib.objectmodel import we_are_translated\n")
-    fp.write("\n\n")
-    fp.write(astGenerator.source)
-
-# import the newly-generated class
-from dip.transformer import ToAST
+GRAMMAR_HASH = grammar_hash(grammar)
+if cached_grammar_hash() != GRAMMAR_HASH:
+    build_parsetables(grammar, GRAMMAR_HASH)
+
+# import the generated lexer, parser and transformer class
+from dip.parsetables import lexer, packrat, ToAST
+
+
+def tokenize(source):
+    """
+    Produces the token stream for the parser in a single pass over the raw source.
+
+    Comments are part of IGNORE in the grammar, so the lexer drops them as it goes,
+    and the NEWLINE tokens left behind by blank or comment-only lines are collapsed
+    here. Since the source is never rewritten, every token keeps its real line and
+    column.
+    """
+    runner = lexer.get_runner(source, eof=True)
+    tokens = []
+    while True:
+        try:
+            tok = runner.find_next_token()
+        except StopIteration:
+            break
+        if tok.name == "NEWLINE" and (len(tokens) == 0 or tokens[-1].name == "NEWLINE"):
+            continue
+        tokens.append(tok)
+    return tokens
+
+
+def parseFunc(source):
+    return packrat.parse(tokenize(source))
+
+
+class TraverseFrame(object):
+    """
+    A parse tree nonterminal whose AST node is still waiting on its children
+    """
+    def __init__(self, item, node):
+        self.item = item
+        self.node = node
+        self.childNodes = []
+        self.nextChild = 0
 
 
 class DipperParser(object):
@@ -140,52 +251,26 @@ class DipperParser(object):
         self.debug = debug
         self.filename = ""
 
-    def _printErrorInfo(self, e):
-        pos = e.source_pos
+    def _printErrorInfo(self, message, pos):
         print "ParseError on line %s, column %s" % (pos.lineno, pos.columnno)
-        print e.nice_error_message()
+        print message
         print ""
 
+    def _reportError(self, message, pos):
+        # ParseError and LexerError have to be caught separately for RPython, which
+        # sends both of them here
+        if self.filename != "":
+            err = message.split("\n")
+            msg = err[len(err) - 1]
+            print error_message(self.filename, (pos.lineno, pos.columnno), msg)
+        else:
+            self._printErrorInfo(message, pos)
+
     def readDipFile(self, filename):
         self.filename = filename
         with open (filename) as fp:
             return fp.read()
 
-    def _prepSource(self, code):
-        """
-        Cleans up source to make it easier on the tokenizer.
-        Strips comments, removes blank lines, etc.
-        """
-        lines = []
-        for line in code.split("\n"):
-            stripped_line = line.strip()
-            if stripped_line.startswith("#"):
-                continue
-            elif len(stripped_line) == 0:
-                continue
-
-            # check for comments in the middle of the line,
-            # but be careful to ignore comment chars inside a string
-            i = 0
-            found_comment = False
-            in_str = False
-            for ch in line:
-                if ch == '"' and in_str == False:
-                    in_str = True
-                elif ch == '"' and in_str == True:
-                    in_str = False
-                elif ch == '#' and in_str == False:
-                    found_comment = True
-                    break
-                i += 1
-
-            if found_comment:
-                line = line[:i]
-
-            lines.append(line)
-
-        return "\n".join(lines)
-
     def parseFile(self, filename):
         return self.parse(self.readDipFile(filename))
 
@@ -193,16 +278,16 @@ class DipperParser(object):
         if filename is not None:
             self.filename = filename
 
-        source = self._prepSource(source)
+        if self.filename != "":
+            register_source(self.filename, source)
+
         try:
             result = parseFunc(source)
         except ParseError as e:
-            if self.filename != "":
-                err = e.nice_error_message().split("\n")
-                msg = err[len(err) - 1]
-                print error_message(self.filename, (e.source_pos.lineno, e.source_pos.columnno), msg)
-            else:
-                self._printErrorInfo(e)
+            self._reportError(e.nice_error_message(), e.source_pos)
+            return None
+        except LexerError as e:
+            self._reportError(e.nice_error_message(), e.source_pos)
             return None
 
         newtree = ToAST().transform(result)
@@ -215,10 +300,35 @@ class DipperParser(object):
         childNodes = []
         assert newtree.symbol == "program"
         for item in newtree.children:
-            childNodes.append(self._traverse(item))
+            node = self._traverse(item)
+            if isinstance(node, ast.Function) or isinstance(node, ast.Struct):
+                self._setSourceHash(node, item, source)
+            childNodes.append(node)
         tree.set(childNodes)
         return tree
 
+    def _setSourceHash(self, node, item, source):
+        """
+        Tags a top-level node with the line it starts on and a hash of its source text
+        (from its first token to its last one), for incremental recompilation.
+        """
+        first = item
+        while type(first) is parsetree.Nonterminal and len(first.children) > 0:
+            first = first.children[0]
+        last = item
+        while type(last) is parsetree.Nonterminal and len(last.children) > 0:
+            last = last.children[len(last.children) - 1]
+        if type(first) is not parsetree.Symbol or type(last) is not parsetree.Symbol:
+            return
+
+        startpos = first.getsourcepos()
+        start = startpos.i
+        end = last.getsourcepos().i + len(last.additional_info)
+        assert start >= 0 and end >= start
+        text = source[start:end]
+        node.srcline = startpos.lineno
+        node.srchash = "%x-%x" % (compute_hash(text), len(text))
+
     def _parseSymbol(self, sym):
         val = sym
         if sym.startswith("__"):
@@ -237,12 +347,13 @@ class DipperParser(object):
             #node = nodeType(item.additional_info if hasattr(item, ADDITIONAL_INFO) else "")
 
             try:
-                source = (item.getsourcepos().lineno, item.getsourcepos().columnno)
+                sourcepos = item.getsourcepos()
+                pos = ast.packpos(sourcepos.lineno, sourcepos.columnno)
             except IndexError:
-                source = (-1, -1)
+                pos = ast.NOPOS
 
             try:
-                node = nodeType(item.additional_info, source=source)
+                node = nodeType(item.additional_info, pos=pos)
             except AttributeError:
                 node = nodeType("")
 
@@ -262,21 +373,46 @@ class DipperParser(object):
             for child in node.children:
                 self._printTree(child, level + 1)
 
-    def _traverse(self, item, level=0):
+    def _startNode(self, item):
+        """
+        Makes the AST node for a parse tree item. Returns the frame that still needs
+        its children built, or None if the node is already complete.
+        """
         if item.symbol == "dotted_name" and len(item.children) == 1:
             item, node = self._mknode(item.children[0])
-            return node
+            return None, node
 
         item, node = self._mknode(item)
-
         if type(item) is parsetree.Nonterminal:
-            childNodes = []
-            for n in item.children:
-                #print "    " * (level + 1), n.symbol
-                newNode = self._traverse(n, level + 1)
-                #print "    " * (level + 1), newNode, "  ---  ", n.symbol
-                childNodes.append(newNode)
-            node.set(childNodes)
-
-        return node
+            return TraverseFrame(item, node), node
+        return None, node
+
+    def _traverse(self, item):
+        """
+        Builds the AST for a parse tree item. Children are built depth-first and
+        handed to their parent's set() once they're all done, same as a recursive
+        walk would, but using an explicit stack so that deeply nested code can't
+        run into the recursion limit.
+        """
+        frame, node = self._startNode(item)
+        if frame is None:
+            return node
+
+        stack = [frame]
+        while True:
+            frame = stack[len(stack) - 1]
+            if frame.nextChild < len(frame.item.children):
+                child = frame.item.children[frame.nextChild]
+                frame.nextChild += 1
+                childFrame, childNode = self._startNode(child)
+                if childFrame is None:
+                    frame.childNodes.append(childNode)
+                else:
+                    stack.append(childFrame)
+            else:
+                stack.pop()
+                frame.node.set(frame.childNodes)
+                if len(stack) == 0:
+                    return frame.node
+                stack[len(stack) - 1].childNodes.append(frame.node)
 
@@ -0,0 +1,120 @@
+"""
+Optimization levels and the pass manager
+
+The compiler's optimization passes are registered with a PassManager along with
+the lowest optimization level they run at. -O0 runs none of them, so the bytecode
+is exactly what the AST compiled to; -O1 runs the ones that don't cost much; -O2
+(the default) runs everything, including the loop optimizations and inlining.
+
+If it's given a CompileStats to fill in, the pass manager also records how long
+each pass took and how many instructions the function had before and after it.
+"""
+import time
+
+# optimization level used when none is asked for
+DEFAULT_OPT_LEVEL = 2
+MAX_OPT_LEVEL = 2
+
+
+def _pad(text, width):
+    if len(text) >= width:
+        return text
+    return text + " " * (width - len(text))
+
+
+def _usecs(seconds):
+    return "%d us" % int(seconds * 1000000.0)
+
+
+class PassStats(object):
+    def __init__(self, name, seconds, before, after):
+        self.name = name
+        self.seconds = seconds
+        # number of instructions before and after the pass ran
+        self.before = before
+        self.after = after
+
+
+class FunctionStats(object):
+    """
+    What happened to one function (or the whole module) on its way through the
+    passes
+    """
+    def __init__(self, name):
+        self.name = name
+        self.passes = []
+        self.instructions = 0
+        self.registers = 0
+
+    def add_pass(self, name, seconds, before, after):
+        self.passes.append(PassStats(name, seconds, before, after))
+
+
+class CompileStats(object):
+    def __init__(self):
+        self.funcs = []
+        # passes that run over the whole module at once, like inlining
+        self.module = FunctionStats("<module>")
+
+    def add(self, funcstats):
+        self.funcs.append(funcstats)
+
+    def report(self):
+        """
+        Returns the stats as text, one block per function followed by the total time
+        spent in each pass
+        """
+        lines = []
+        totals = {}
+        order = []
+        funcs = [ funcstats for funcstats in self.funcs ]
+        if len(self.module.passes) > 0:
+            funcs.append(self.module)
+        for funcstats in funcs:
+            if funcstats is self.module:
+                lines.append("module:")
+            else:
+                lines.append("%s: %s instructions, %s registers" % (funcstats.name,
+                    funcstats.instructions, funcstats.registers))
+            for stat in funcstats.passes:
+                lines.append("    %s %s %d -> %d instructions" % (_pad(stat.name, 20),
+                    _pad(_usecs(stat.seconds), 10), stat.before, stat.after))
+                if stat.name not in totals:
+                    totals[stat.name] = 0.0
+                    order.append(stat.name)
+                totals[stat.name] += stat.seconds
+
+        lines.append("total:")
+        for name in order:
+            lines.append("    %s %s" % (_pad(name, 20), _usecs(totals[name])))
+        return "\n".join(lines)
+
+
+class PassManager(object):
+    """
+    Runs registered passes over a compiler object. A pass is a function that takes
+    the compiler and updates its bytecode; count is a function that returns the
+    number of instructions the compiler has.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.passes = []
+
+    def register(self, name, level, func):
+        """
+        Adds a pass that runs at the given optimization level and above. Passes run
+        in the order they're registered.
+        """
+        self.passes.append((name, level, func))
+
+    def run(self, ctx, level, stats=None):
+        for name, minlevel, func in self.passes:
+            if level < minlevel:
+                continue
+            if stats is None:
+                func(ctx)
+                continue
+            before = self.count(ctx)
+            start = time.time()
+            func(ctx)
+            stats.add_pass(name, time.time() - start, before, self.count(ctx))
@@ -0,0 +1,179 @@
+"""
+Peephole optimizations on compiled bytecode
+
+The compiler emits LABEL instructions to mark the start of blocks and doesn't pay
+much attention to where its jumps end up. This cleans up after it: branches to
+jumps (or labels) go straight to the final destination, jumps to the next
+instruction, unreachable code and copies of a register onto itself are dropped,
+and the no-op PASS/LABEL instructions are removed. The text of a removed label is kept as a comment on the
+instruction it was labeling.
+"""
+from bytecode import INST, INST_OPERANDS
+from regalloc import successors
+
+
+def branch_operand(inst):
+    """
+    Returns which operand (0, 1 or 2) of the instruction is a branch target, or -1
+    if it doesn't branch
+    """
+    kinds = INST_OPERANDS[inst]
+    for i in range(3):
+        if kinds[i] == "j":
+            return i
+    return -1
+
+
+def is_noop(inst):
+    return inst == INST['PASS'] or inst == INST['LABEL']
+
+
+def is_self_copy(instruction):
+    inst, a, b, c = instruction
+    return inst == INST['SET'] and a == b and a >= 0
+
+
+def resolve_target(bytecode, target):
+    """
+    Follows no-ops and unconditional jumps from target to the first instruction
+    that actually does something
+    """
+    seen = {}
+    while target >= 0 and target < len(bytecode) and target not in seen:
+        seen[target] = True
+        inst, a, b, c = bytecode[target]
+        if is_noop(inst):
+            target += 1
+        elif inst == INST['JMP']:
+            target = a
+        else:
+            break
+    return target
+
+
+def _set_operand(instruction, idx, val):
+    inst, a, b, c = instruction
+    operands = [a, b, c]
+    operands[idx] = val
+    return (inst, operands[0], operands[1], operands[2])
+
+
+def _next_kept(keep):
+    """
+    Returns a list with, for each instruction, the first kept instruction at or
+    after it (or len(keep) if there isn't one)
+    """
+    nextkept = [len(keep)] * (len(keep) + 1)
+    for ptr in range(len(keep) - 1, -1, -1):
+        if keep[ptr]:
+            nextkept[ptr] = ptr
+        else:
+            nextkept[ptr] = nextkept[ptr + 1]
+    return nextkept
+
+
+def reachable_insts(bytecode):
+    """
+    Returns a list of flags that are True for every instruction that can be reached
+    from the start of the function
+    """
+    reachable = [False] * len(bytecode)
+    reachable[0] = True
+    todo = [0]
+    while len(todo) > 0:
+        ptr = todo.pop()
+        for succ in successors(bytecode, ptr):
+            if succ >= 0 and succ < len(bytecode) and not reachable[succ]:
+                reachable[succ] = True
+                todo.append(succ)
+    return reachable
+
+
+def optimize(bytecode, bytecode_info):
+    """
+    Runs the peephole optimizations. Returns the new (bytecode, bytecode_info).
+    """
+    numinsts = len(bytecode)
+    if numinsts == 0:
+        return bytecode, bytecode_info
+
+    # labels that were in use keep their text, even if every jump to them ends up
+    # going somewhere else
+    labeled = reachable_insts(bytecode)
+
+    # thread jumps so that every branch goes straight to its final destination
+    code = []
+    for inst, a, b, c in bytecode:
+        code.append((inst, a, b, c))
+    for ptr in range(numinsts):
+        idx = branch_operand(code[ptr][0])
+        if idx != -1:
+            inst, a, b, c = code[ptr]
+            operands = [a, b, c]
+            code[ptr] = _set_operand(code[ptr], idx, resolve_target(code, operands[idx]))
+
+    # anything that can't be reached from the start of the function is dead
+    reachable = reachable_insts(code)
+
+    keep = [ reachable[ptr] and not is_noop(code[ptr][0]) and not is_self_copy(code[ptr])
+        for ptr in range(numinsts) ]
+
+    # branches that end up at the same place as not branching at all do nothing.
+    # removing one can make another one pointless, so keep going until nothing changes.
+    changed = True
+    while changed:
+        changed = False
+        nextkept = _next_kept(keep)
+        for ptr in range(numinsts):
+            if not keep[ptr]:
+                continue
+            inst, a, b, c = code[ptr]
+            idx = branch_operand(inst)
+            if idx == -1:
+                continue
+            operands = [a, b, c]
+            target = operands[idx]
+            if target >= 0 and target <= numinsts and nextkept[target] == nextkept[ptr + 1]:
+                keep[ptr] = False
+                changed = True
+
+    # work out where everything ends up
+    nextkept = _next_kept(keep)
+    newpos = [0] * (numinsts + 1)
+    count = 0
+    for ptr in range(numinsts):
+        newpos[ptr] = count
+        if keep[ptr]:
+            count += 1
+    newpos[numinsts] = count
+
+    # label text moves onto the instruction the label was in front of
+    labels = [ [] for _ in range(numinsts) ]
+    for ptr in range(numinsts):
+        inst = code[ptr][0]
+        if inst == INST['LABEL'] and labeled[ptr] and nextkept[ptr] < numinsts:
+            if len(bytecode_info[ptr].comment) > 0:
+                labels[nextkept[ptr]].append(bytecode_info[ptr])
+
+    newcode = []
+    newinfo = []
+    for ptr in range(numinsts):
+        if not keep[ptr]:
+            continue
+        instruction = code[ptr]
+        idx = branch_operand(instruction[0])
+        if idx != -1:
+            inst, a, b, c = instruction
+            operands = [a, b, c]
+            target = operands[idx]
+            if target >= 0 and target <= numinsts:
+                instruction = _set_operand(instruction, idx, newpos[nextkept[target]])
+        newcode.append(instruction)
+
+        info = bytecode_info[ptr]
+        label = labels[ptr]
+        for i in range(len(label) - 1, -1, -1):
+            info = info.prefixed(label[i])
+        newinfo.append(info)
+
+    return newcode, newinfo
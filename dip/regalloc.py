@@ -0,0 +1,202 @@
+"""
+Register allocation for compiled functions
+
+The compiler hands out a new data register for every temporary value, so long
+functions end up with lots of registers that are each only needed for a couple of
+instructions. This works out which of those temporaries are never alive at the
+same time and packs them into shared registers.
+"""
+from bytecode import INST, INST_OPERANDS
+
+
+def successors(bytecode, ptr):
+    """
+    Returns the instruction pointers that can run right after the one at ptr
+    """
+    inst, a, b, c = bytecode[ptr]
+    kinds = INST_OPERANDS[inst]
+    succ = []
+    if inst != INST['JMP'] and inst != INST['RET'] and inst != INST['TAILCALL'] and \
+            inst != INST['EXIT']:
+        if ptr + 1 < len(bytecode):
+            succ.append(ptr + 1)
+    if kinds[0] == "j":
+        succ.append(a)
+    elif kinds[1] == "j":
+        succ.append(b)
+    elif kinds[2] == "j":
+        succ.append(c)
+    return succ
+
+
+def reg_operands(bytecode, ptr):
+    """
+    Returns (uses, defs, pinned) lists of the data registers the instruction at ptr
+    reads, (re)defines, and hands out references to
+    """
+    inst, a, b, c = bytecode[ptr]
+    kinds = INST_OPERANDS[inst]
+    uses = []
+    defs = []
+    pinned = []
+    operands = [a, b, c]
+    for i in range(3):
+        kind = kinds[i]
+        reg = operands[i]
+        if reg < 0:
+            continue
+        if kind == "r" or kind == "m":
+            uses.append(reg)
+        elif kind == "w":
+            defs.append(reg)
+        elif kind == "e":
+            uses.append(reg)
+            pinned.append(reg)
+        elif kind == "x":
+            # the register ends up holding an object that may be shared with
+            # someone else, so it has to stay out of the way of other values
+            defs.append(reg)
+            pinned.append(reg)
+    return uses, defs, pinned
+
+
+class Liveness(object):
+    """
+    Works out which data registers are alive (hold a value that may still be read)
+    going into and coming out of each bytecode instruction
+    """
+    def __init__(self, bytecode):
+        self.bytecode = bytecode
+        self.live_in = [ {} for _ in range(len(bytecode)) ]
+        self.live_out = [ {} for _ in range(len(bytecode)) ]
+        self._compute()
+
+    def _compute(self):
+        # standard backwards dataflow, repeated until nothing changes
+        changed = True
+        while changed:
+            changed = False
+            for ptr in range(len(self.bytecode) - 1, -1, -1):
+                live_out = self.live_out[ptr]
+                for succ in successors(self.bytecode, ptr):
+                    for reg in self.live_in[succ]:
+                        live_out[reg] = True
+
+                live_in = {}
+                for reg in live_out:
+                    live_in[reg] = True
+                uses, defs, pinned = reg_operands(self.bytecode, ptr)
+                for reg in defs:
+                    if reg in live_in:
+                        del live_in[reg]
+                for reg in uses:
+                    live_in[reg] = True
+
+                if len(live_in) != len(self.live_in[ptr]):
+                    changed = True
+                self.live_in[ptr] = live_in
+
+
+def allocate_registers(bytecode, data, pinned):
+    """
+    Packs temporary data registers whose lifetimes don't overlap into shared
+    registers. Only registers that are always overwritten before they're read, hold
+    the same type of value, and never get handed out to anything else are shared;
+    everything in pinned (arguments and registers bound to variable names) keeps a
+    register of its own.
+
+    Returns (bytecode, data, regmap), where regmap maps old register indices to new
+    ones.
+    """
+    numregs = len(data)
+    if numregs == 0 or len(bytecode) == 0:
+        return bytecode, data, [ i for i in range(numregs) ]
+
+    liveness = Liveness(bytecode)
+
+    # figure out which registers are candidates for sharing
+    is_pinned = [False] * numregs
+    for reg in pinned:
+        is_pinned[reg] = True
+    # registers in the order they're first written
+    written = []
+    is_written = [False] * numregs
+    for ptr in range(len(bytecode)):
+        uses, defs, escaped = reg_operands(bytecode, ptr)
+        for reg in escaped:
+            is_pinned[reg] = True
+        for reg in defs:
+            if not is_written[reg]:
+                is_written[reg] = True
+                written.append(reg)
+    # anything alive on entry needs its initial value from the template
+    for reg in liveness.live_in[0]:
+        is_pinned[reg] = True
+
+    candidates = []
+    is_candidate = [False] * numregs
+    for reg in written:
+        if not is_pinned[reg]:
+            candidates.append(reg)
+            is_candidate[reg] = True
+
+    # build the interference graph: two registers can't share if one is written
+    # while the other one is still alive
+    interferes = {}
+    for reg in candidates:
+        interferes[reg] = {}
+    for ptr in range(len(bytecode)):
+        uses, defs, escaped = reg_operands(bytecode, ptr)
+        for reg in defs:
+            if not is_candidate[reg]:
+                continue
+            for other in liveness.live_out[ptr]:
+                if other != reg and is_candidate[other]:
+                    interferes[reg][other] = True
+                    interferes[other][reg] = True
+
+    # greedy coloring, in the order the registers are first written
+    rep = [ i for i in range(numregs) ]
+    shared = [] # list of (typename, [member registers])
+    for reg in candidates:
+        typename = data[reg].typename
+        for slottype, members in shared:
+            if slottype != typename:
+                continue
+            for member in members:
+                if member in interferes[reg]:
+                    break
+            else:
+                rep[reg] = members[0]
+                members.append(reg)
+                break
+        else:
+            shared.append((typename, [reg]))
+
+    # renumber the registers that are left, keeping their original order
+    regmap = [-1] * numregs
+    newdata = []
+    for reg in range(numregs):
+        if rep[reg] == reg:
+            regmap[reg] = len(newdata)
+            newdata.append(data[reg])
+    for reg in range(numregs):
+        regmap[reg] = regmap[rep[reg]]
+
+    return remap_registers(bytecode, regmap), newdata, regmap
+
+
+def remap_registers(bytecode, regmap):
+    """
+    Returns a copy of the bytecode with every data register operand replaced by its
+    entry in regmap
+    """
+    newbytecode = []
+    for inst, a, b, c in bytecode:
+        kinds = INST_OPERANDS[inst]
+        operands = [a, b, c]
+        for i in range(3):
+            if kinds[i] in "rwmex" and operands[i] >= 0:
+                operands[i] = regmap[operands[i]]
+        newbytecode.append((inst, operands[0], operands[1], operands[2]))
+    return newbytecode
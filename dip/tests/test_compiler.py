@@ -4,7 +4,11 @@ sys.path.insert(0, "../")
 import unittest
 from dip.typesystem import DNull, DBool, DInteger, DString, DList
 from dip.parser import DipperParser
-from dip.compiler import FrameCompiler
+from dip.compiler import FrameCompiler, BytecodeCompiler
+from dip.bytecode import INST, BytecodeAnnotation, LineTable
+from dip import peephole
+from dip.loops import optimize_loops
+from dip.cfg import ControlFlowGraph, dominates, ENTRY_DEF
 from dip.interpreter import VirtualMachine
 from dip.namespace import Namespace
 
@@ -31,6 +35,136 @@ class TestCompiler(unittest.TestCase):
     def test_simple(self):
         pass
 
+    def test_peephole(self):
+        bc = BytecodeCompiler("main", """
+            LABEL :start
+            JMP 3
+            RET 0
+            JMP 5
+            PASS
+            BF 0 7
+            RET 0
+            LABEL :end
+            JMP 9
+            RET 1
+        """, [DBool()]).bytecode
+        info = [ BytecodeAnnotation("<test>", (i, 0)) for i in range(len(bc)) ]
+        info[0].comment = "start"
+        info[7].comment = "end"
+
+        code, newinfo = peephole.optimize(bc, info)
+        # the jump chain goes straight to BF, and BF skips the label and jump
+        self.assertEqual(code, [
+            (INST['BF'], 0, 2, -1),
+            (INST['RET'], 0, -1, -1),
+            (INST['RET'], 1, -1, -1),
+        ])
+        self.assertEqual([ item.source for item in newinfo ], [(5, 0), (6, 0), (9, 0)])
+        self.assertEqual(newinfo[0].comment, "start")
+        self.assertEqual(newinfo[2].comment, "end")
+
+    def test_line_table(self):
+        sources = [(-1, -1), (2, 4), (2, 4), (2, 4), (3, 0), (-1, -1), (5, 8), (5, 8)]
+        info = [ BytecodeAnnotation("<test>", source) for source in sources ]
+        info[2].comment = "middle"
+        lines = LineTable.encode("<test>", info)
+
+        # each run of instructions from the same place gets one entry
+        self.assertEqual(len(lines.runs), 5 * 3)
+        self.assertEqual([ lines.getsource(i) for i in range(len(sources)) ], sources)
+        self.assertEqual(lines.getsource(100), (5, 8))
+        self.assertEqual([ lines.describe(i) for i in range(4) ], ["", "", "middle", ""])
+        self.assertEqual(lines.annotation(3).source, (2, 4))
+        self.assertEqual(lines.annotation(2).comment, "middle")
+
+        moved = lines.shifted(10)
+        self.assertEqual([ moved.getsource(i)[0] for i in range(len(sources)) ],
+            [-1, 12, 12, 12, 13, -1, 15, 15])
+        self.assertEqual(moved.annotation(2).source, (12, 4))
+        self.assertEqual(lines.getsource(1), (2, 4))
+        self.assertEqual(LineTable.encode("<test>", []).getsource(0), (-1, -1))
+
+    def test_cfg(self):
+        bc = BytecodeCompiler("main", """
+            SET 2 1
+            BT 0 4
+            ADDI 1 1
+            RET 1
+            SUB_II 1 2 1
+            BNE 1 2 4
+            RET 2
+        """, [DBool(), DInteger(), DInteger()]).bytecode
+        info = [ BytecodeAnnotation("<test>", (i, 0)) for i in range(len(bc)) ]
+        cfg = ControlFlowGraph(bc, info)
+
+        self.assertEqual([ block.start for block in cfg.blocks ], [0, 2, 4, 6])
+        self.assertEqual([ block.succs() for block in cfg.blocks ], [[1, 2], [], [3, 2], []])
+        self.assertEqual(cfg.blocks[2].preds, [0, 2])
+        # the branch operand holds a block index
+        self.assertEqual(cfg.blocks[2].last(), (INST['BNE'], 1, 2, 2))
+
+        idom = cfg.dominators()
+        self.assertEqual(idom, [0, 0, 0, 2])
+        self.assertTrue(dominates(idom, 0, 3))
+        self.assertFalse(dominates(idom, 1, 3))
+        self.assertEqual([ (header, [ i for i in range(4) if inloop[i] ])
+            for header, inloop in cfg.natural_loops() ], [(2, [2])])
+
+        chains = cfg.def_use()
+        # the SUB_II reads 1 as set by the SET before the loop, or by itself
+        self.assertEqual([ chains.defs[id] for id in chains.reaching[(2, 0, 1)] ],
+            [(0, 0, 1), (2, 0, 1)])
+        self.assertEqual(chains.uses[0], [(1, 0, 1), (2, 0, 1)])
+        self.assertEqual(sorted(chains.uses[ENTRY_DEF]),
+            [(0, 0, 2), (0, 1, 0), (2, 0, 2), (2, 1, 2), (3, 0, 2)])
+        # the same, by instruction pointer
+        self.assertEqual([ chains.position(id) for id in chains.reaching_at(4, 1) ], [0, 4])
+        self.assertEqual(chains.reaching_at(4, 0), None)
+
+        # the early return moves out of the way, so the loop is what comes next
+        code, newinfo = cfg.linearize()
+        self.assertEqual(code, [
+            (INST['SET'], 2, 1, -1),
+            (INST['BF'], 0, 5, -1),
+            (INST['SUB_II'], 1, 2, 1),
+            (INST['BNE'], 1, 2, 2),
+            (INST['RET'], 2, -1, -1),
+            (INST['ADDI'], 1, 1, -1),
+            (INST['RET'], 1, -1, -1),
+        ])
+        self.assertEqual([ item.source for item in newinfo ],
+            [(0, 0), (1, 0), (4, 0), (5, 0), (6, 0), (2, 0), (3, 0)])
+
+    def test_loop_invariance(self):
+        data = [DInteger.new_int(5), DInteger.new_int(3), DInteger.new_int(10), DInteger(),
+            DInteger(), DInteger(), DInteger()]
+        bc = BytecodeCompiler("f", """
+            SET 6 3
+            BNE_IM 3 100 4
+            ADDI 2 1
+            RET 2
+            MUL_II 2 1 4
+            ADD_II 5 4 5
+            ADDI 3 1
+            BNE 3 0 1
+            RET 5
+        """, data).bytecode
+        info = [ BytecodeAnnotation("<test>", (i, 0)) for i in range(len(bc)) ]
+        # 2 is written in the loop, but only on the way out of it, so the
+        # multiplication always reads the value from before the loop
+        code, newinfo, newdata = optimize_loops(bc, info, data, 2)
+        self.assertEqual(code, [
+            (INST['SET'], 6, 3, -1),
+            (INST['MUL_II'], 2, 1, 4),
+            (INST['BNE_IM'], 3, 100, 5),
+            (INST['ADDI'], 2, 1, -1),
+            (INST['RET'], 2, -1, -1),
+            (INST['ADD_II'], 5, 4, 5),
+            (INST['ADDI'], 3, 1, -1),
+            (INST['BNE'], 3, 0, 2),
+            (INST['RET'], 5, -1, -1),
+        ])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
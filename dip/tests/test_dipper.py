@@ -6,13 +6,18 @@ from dip.typesystem import DNull, DBool, DInteger, DString, DList
 from dip.parser import DipperParser
 from dip.compiler import FrameCompiler
 from dip.interpreter import VirtualMachine
-from dip.namespace import Module
+from dip.namespace import Module, IncrementalState
+from dip.bytecode import INST, INST_STRS, BytecodeAnnotation, SOURCE_MARKER, const_index
+from dip import cache
+from dip.passes import CompileStats
 
 
 class TestDipper(unittest.TestCase):
     def _execute_simple(self, caller, code):
         mainmodule = Module.from_ast("<%s>" % caller, "main", DipperParser().parse(code))
+        return self._run_module(mainmodule)
 
+    def _run_module(self, mainmodule):
         # set up a hacky way to extract data from the VM via a callback
         result = [None] # we need a mutable object we can put data in
         def getresult(val):
@@ -298,6 +303,585 @@ class TestDipper(unittest.TestCase):
         self.assertEqual(result.int_py(), 4)
 
 
+    def test_dipc_roundtrip(self):
+        code = """
+        fn fib(n : int) -> int {
+            if n < 2 { return n }
+            return fib(n - 2) + fib(n - 1)
+        }
+        fn main() {
+            x = fib(10)
+            y = 1.5
+            return x + y
+        }
+        """
+        mainmodule = Module.from_ast("<test_dipc_roundtrip>", "main", DipperParser().parse(code))
+        key = cache.source_key(code)
+        data = cache.dump_module(mainmodule, "<test_dipc_roundtrip>", key)
+
+        # a different source hash or compiler version means the cache is stale
+        self.assertEqual(cache.load_module(data, cache.source_key(code + " ")), None)
+        self.assertEqual(cache.load_module(data, cache.source_key(code, 0)), None)
+
+        loaded = cache.load_module(data, key)
+        self.assertEqual(loaded.funcs.keys(), mainmodule.funcs.keys())
+        for name, func in loaded.funcs.items():
+            self.assertEqual(func.bytecode, mainmodule.funcs[name].bytecode)
+            self.assertEqual(func.vars, mainmodule.funcs[name].vars)
+        self.assertEqual(self._run_module(loaded).float_py(), 56.5)
+
+
+    def test_parallel_compile(self):
+        code = """
+        fn add(x : int, y : int) -> int {
+            return x + y
+        }
+        fn fib(n : int) -> int {
+            if n < 2 { return n }
+            return fib(n - 2) + fib(n - 1)
+        }
+        fn main() {
+            return add(fib(10), 1)
+        }
+        """
+        serial = Module.from_ast("<test_parallel_compile>", "main", DipperParser().parse(code))
+        parallel = Module.from_ast("<test_parallel_compile>", "main", DipperParser().parse(code), jobs=2)
+        self.assertEqual(parallel.funcs.keys(), serial.funcs.keys())
+        for name, func in parallel.funcs.items():
+            self.assertEqual(func.bytecode, serial.funcs[name].bytecode)
+        self.assertEqual(self._run_module(parallel).int_py(), 56)
+
+
+    def test_incremental(self):
+        code = """
+        fn add(x : int, y : int) -> int {
+            return x + y
+        }
+        fn double(x : int) -> int {
+            return x * 2
+        }
+        fn main() {
+            return add(double(5), 1)
+        }
+        """
+        state = IncrementalState()
+        first = Module.from_ast("<test_incremental>", "main", DipperParser().parse(code),
+            incremental=state)
+        self.assertEqual((state.compiled, state.reused), (3, 0))
+        self.assertEqual(self._run_module(first).int_py(), 11)
+        func = first.get_func("add")
+        lines = [ func.lines.getsource(i)[0] for i in range(len(func.bytecode)) ]
+        self.assertTrue(max(lines) > -1)
+
+        # only the changed function gets recompiled, even if others move around
+        code = "\n\n" + code.replace("x * 2", "x * 3")
+        second = Module.from_ast("<test_incremental>", "main", DipperParser().parse(code),
+            incremental=state)
+        self.assertEqual((state.compiled, state.reused), (1, 2))
+        self.assertTrue(second.get_func("add") is first.get_func("add"))
+        func = second.get_func("add")
+        for i in range(len(func.bytecode)):
+            self.assertEqual(func.lines.getsource(i)[0], lines[i] + 2 if lines[i] > -1 else -1)
+        self.assertEqual(self._run_module(second).int_py(), 16)
+
+        # a prototype change recompiles the function and everything that calls it
+        code = code.replace("fn add(x : int, y : int) -> int", "fn add(x : int, y : int) -> float")
+        third = Module.from_ast("<test_incremental>", "main", DipperParser().parse(code),
+            incremental=state)
+        self.assertEqual((state.compiled, state.reused), (2, 1))
+        self.assertTrue(third.get_func("double") is second.get_func("double"))
+
+
+    def test_lazy(self):
+        code = """
+        fn fib(n : int) -> int {
+            if n < 2 { return n }
+            return fib(n - 2) + fib(n - 1)
+        }
+        fn unused() {
+            return undefined_var
+        }
+        fn main() {
+            return fib(10)
+        }
+        """
+        mainmodule = Module.from_ast("<test_lazy>", "main", DipperParser().parse(code), lazy=True)
+        for func in mainmodule.funcs.values():
+            self.assertFalse(func.is_complete)
+
+        # functions are compiled as they're called, and broken code that never
+        # runs never gets compiled
+        self.assertEqual(self._run_module(mainmodule).int_py(), 55)
+        self.assertTrue(mainmodule.get_func("main").is_complete)
+        self.assertTrue(mainmodule.get_func("fib").is_complete)
+        self.assertFalse(mainmodule.get_func("unused").is_complete)
+
+
+    def test_register_allocation(self):
+        mainmodule = Module.from_ast("<test_register_allocation>", "main", DipperParser().parse("""
+        fn three() -> int {
+            return 3
+        }
+
+        fn main() {
+            x = 0
+            a = 2
+            b = three()
+            x += a * b
+            x += a * b
+            x += a * b
+            x += a * b
+            x += a * b
+            return x
+        }
+        """), inline_budget=0)
+        # argv, x, a, b and the argument list for three() each keep their own register,
+        # all five temporaries share one
+        self.assertEqual(len(mainmodule.get_func("main").data), 6)
+        self.assertEqual(self._run_module(mainmodule).int_py(), 30)
+
+
+    def test_constant_pool(self):
+        mainmodule = Module.from_ast("<test_constant_pool>", "main", DipperParser().parse("""
+        fn one() -> int {
+            return 1
+        }
+
+        fn main() {
+            x = one()
+            x += 5
+            y = one()
+            z = x + y
+            return z + 1
+        }
+        """))
+        # both 1s end up in one shared pool entry instead of a register each
+        pooled = [ val.repr_py() for val in mainmodule.constpool.values ]
+        self.assertEqual(pooled.count("<DInteger: 1>"), 1)
+        self.assertEqual(len(mainmodule.get_func("one").data), 0)
+        # returned constants are copies, so changing x doesn't change the pool
+        self.assertEqual(self._run_module(mainmodule).int_py(), 8)
+
+
+    def test_shared_template_registers(self):
+        mainmodule = Module.from_ast("<test_shared_template_registers>", "main",
+            DipperParser().parse("""
+        fn bump(n : int) -> int {
+            n += 1
+            return n
+        }
+
+        fn f() -> int {
+            a = 5
+            b = bump(a)
+            return a
+        }
+
+        fn g() -> int {
+            k = 3
+            z = k + k
+            z += k
+            return z
+        }
+
+        fn main() {
+            x = f()
+            y = f()
+            w = x + y
+            return w
+        }
+        """), inline_budget=0)
+        # k is only ever read so it's shared with the template, z gets copied
+        g = mainmodule.get_func("g")
+        self.assertEqual(g.owned, [g.vars["z"]])
+        # a gets passed to bump, which changes it, so each call of f needs a copy
+        f = mainmodule.get_func("f")
+        self.assertTrue(f.vars["a"] in f.owned)
+        self.assertEqual(self._run_module(mainmodule).int_py(), 12)
+
+
+    def test_fused_branches(self):
+        mainmodule = Module.from_ast("<test_fused_branches>", "main", DipperParser().parse("""
+        fn check(a : int, b : int) -> int {
+            r = 0
+            if a < b { r += 1 }
+            if a > b { r += 2 }
+            if a <= b { r += 4 }
+            if a >= b { r += 8 }
+            if a == b { r += 16 }
+            if a != b { r += 32 }
+            return r
+        }
+
+        fn main() {
+            x = check(1, 2)
+            y = check(2, 1)
+            z = check(2, 2)
+            s = x + y
+            t = s + z
+            return t
+        }
+        """))
+        insts = [ INST_STRS[inst] for inst, a, b, c in mainmodule.get_func("check").bytecode ]
+        self.assertEqual(insts.count("BF"), 0)
+        for name in ("BGE", "BLE", "BGT", "BLT", "BNE", "BEQ"):
+            self.assertEqual(insts.count(name), 1)
+        self.assertEqual(self._run_module(mainmodule).int_py(), 37 + 42 + 28)
+
+    def test_nan_comparisons(self):
+        # a NaN is neither less than nor greater than or equal to anything, so
+        # float comparisons can't be turned into the opposite branch
+        code = """
+        fn check(a : float) -> int {
+            b = a * a
+            c = b - b
+            if c < 1.0 {
+                return 1
+            }
+            elif c >= 1.0 {
+                return 2
+            }
+            return 3
+        }
+
+        fn main() {
+            return check(1%s.0)
+        }
+        """ % ("0" * 200)
+        for level in range(3):
+            module = Module.from_ast("<test_nan_comparisons>", "main", DipperParser().parse(code),
+                opt_level=level)
+            self.assertEqual(self._run_module(module).int_py(), 3)
+        insts = [ INST_STRS[inst] for inst, a, b, c in module.get_func("check").bytecode ]
+        self.assertFalse("BGE" in insts or "BLT" in insts)
+
+
+    def test_specialized_arith(self):
+        mainmodule = Module.from_ast("<test_specialized_arith>", "main", DipperParser().parse("""
+        fn ints(a : int, b : int) -> int {
+            c = a * b
+            c -= a
+            d = c / b
+            return d
+        }
+
+        fn floats(a : float, b : int) -> float {
+            c = a * b
+            c += 1.5
+            return c
+        }
+
+        fn strs(a : str, b : str) -> str {
+            c = a + b
+            return c
+        }
+
+        fn main() {
+            return ints(7, 2)
+        }
+        """))
+        def insts(name):
+            return [ INST_STRS[inst] for inst, a, b, c in mainmodule.get_func(name).bytecode ]
+        self.assertEqual(insts("ints"), ["MUL_II", "SUB_II", "DIV_II", "RET"])
+        self.assertEqual(insts("floats"), ["MUL_FF", "ADD_FF", "RET"])
+        self.assertEqual(insts("strs"), ["CONCAT_SS", "RET"])
+        self.assertEqual(self._run_module(mainmodule).int_py(), 3)
+
+
+    def test_constant_folding(self):
+        mainmodule = Module.from_ast("<test_constant_folding>", "main", DipperParser().parse("""
+        fn f(n : int) -> int {
+            x = 5
+            y = x * 2
+            z = y + 1
+            if z > 10 {
+                return n + z
+            }
+            return 0
+        }
+
+        fn main() {
+            return f(100)
+        }
+        """))
+        f = mainmodule.get_func("f")
+        # z is known to be 11, so the branch goes away and n + z reads it from the pool
+        self.assertEqual([ INST_STRS[inst] for inst, a, b, c in f.bytecode ], ["ADD_II", "RET"])
+        self.assertEqual(f.consts[const_index(f.bytecode[0][2])].int_py(), 11)
+        self.assertEqual(self._run_module(mainmodule).int_py(), 111)
+
+
+    def test_inlining(self):
+        mainmodule = Module.from_ast("<test_inlining>", "main", DipperParser().parse("""
+        fn bump(n : int) {
+            n += 1
+        }
+
+        fn absdiff(a : int, b : int) -> int {
+            if a > b {
+                c = a - b
+                return c
+            }
+            c = b - a
+            return c
+        }
+
+        fn fact(n : int) -> int {
+            if n <= 1 {
+                return 1
+            }
+            m = n - 1
+            r = fact(m)
+            r *= n
+            return r
+        }
+
+        fn ident(v : int) -> int {
+            return v
+        }
+
+        fn main() {
+            x = 0
+            for i in 0..4 {
+                bump(x)
+            }
+            y = absdiff(x, 10)
+            z = fact(y)
+            w = ident(z)
+            w += 1
+            return z
+        }
+        """))
+        def calls(name):
+            func = mainmodule.get_func(name)
+            return [ func.getoperand(a).str_py() for inst, a, b, c in func.bytecode
+                if INST_STRS[inst] == "CALL" ]
+        # bump and absdiff are spliced into main, fact calls itself so it stays a call,
+        # and ident hands back the object it was passed, which a copy can't do
+        self.assertEqual(calls("main"), ["fact", "ident"])
+        self.assertEqual(calls("fact"), ["fact"])
+        # bump still changes the x that was passed in, so absdiff(4, 10) is 6, and
+        # w is the same object as z, so z ends up as 6! + 1
+        self.assertEqual(self._run_module(mainmodule).int_py(), 721)
+
+
+    def test_tail_calls(self):
+        mainmodule = Module.from_ast("<test_tail_calls>", "main", DipperParser().parse("""
+        fn count(n : int, acc : int) -> int {
+            if n == 0 {
+                return acc
+            }
+            n -= 1
+            acc += 2
+            return count(n, acc)
+        }
+
+        fn main() {
+            x = count(1000, 0)
+            return x
+        }
+        """))
+        insts = [ INST_STRS[inst] for inst, a, b, c in mainmodule.get_func("count").bytecode ]
+        # the early return is laid out after the tail call, off the path the
+        # recursion takes
+        self.assertEqual(insts[0], "BEQ_IM")
+        self.assertEqual(insts[-2:], ["TAILCALL", "RET"])
+        self.assertFalse("CALL" in insts)
+
+        # the recursion runs in a single frame
+        depths = []
+        class DepthVM(VirtualMachine):
+            def callstack_push(self, funcname, args):
+                VirtualMachine.callstack_push(self, funcname, args)
+                depths.append(len(self.callstack))
+            def callstack_replace(self, funcname, args):
+                VirtualMachine.callstack_replace(self, funcname, args)
+                depths.append(len(self.callstack))
+        result = [None]
+        def getresult(val):
+            result[0] = val
+        vm = DepthVM([], cb=getresult)
+        vm.setglobals(mainmodule)
+        vm.run()
+        self.assertEqual(result[0].int_py(), 2000)
+        self.assertEqual(max(depths), 2)
+
+
+    def test_loop_optimizations(self):
+        mainmodule = Module.from_ast("<test_loop_optimizations>", "main", DipperParser().parse("""
+        fn f(n : int, xs : list) -> int {
+            total = 0
+            for i in 0..n {
+                k = len(xs)
+                m = k * 3
+                j = i * 4
+                total += j
+                total += m
+            }
+            return total
+        }
+
+        fn main(argv : list) {
+            x = f(5, argv)
+            return x
+        }
+        """))
+        f = mainmodule.get_func("f")
+        insts = [ INST_STRS[inst] for inst, a, b, c in f.bytecode ]
+        top = insts.index("ADD_II")
+        # len(xs) and k * 3 only get worked out once, before the loop starts, and
+        # i * 4 is kept up to date by adding 4 whenever i goes up by one
+        self.assertEqual(insts[:top], ["SET", "LEN", "MUL_IM", "MUL_IM"])
+        self.assertEqual(insts[top:], ["ADD_II", "ADD_II", "ADDI", "ADDI", "BNE", "RET"])
+        self.assertEqual(f.bytecode[top + 3], (INST["ADDI"], f.vars["j"], 4, -1))
+        self.assertEqual(self._run_module(mainmodule).int_py(), 40)
+
+
+    def test_immediate_operands(self):
+        mainmodule = Module.from_ast("<test_immediate_operands>", "main", DipperParser().parse("""
+        fn f(n : int) -> int {
+            a = n - 2
+            b = 3 * n
+            c = 10 - n
+            t = 1
+            t += a
+            lt = 4 < n
+            if n > 3 {
+                t *= b
+            }
+            return t + c
+        }
+
+        fn main() {
+            x = f(5)
+            return x
+        }
+        """))
+        f = mainmodule.get_func("f")
+        insts = [ INST_STRS[inst] for inst, a, b, c in f.bytecode ]
+        # integer literals are encoded in the instruction, with the operands swapped
+        # around where that works. 10 - n still needs a register for the 10.
+        self.assertEqual(f.bytecode[0], (INST["SUB_IM"], f.vars["n"], 2, f.vars["a"]))
+        self.assertEqual(f.bytecode[1], (INST["MUL_IM"], f.vars["n"], 3, f.vars["b"]))
+        self.assertEqual(insts[2], "SUB_II")
+        self.assertEqual(f.bytecode[4], (INST["GT_IM"], f.vars["n"], 4, f.vars["lt"]))
+        self.assertEqual(insts[5], "BLE_IM")
+        self.assertEqual(self._run_module(mainmodule).int_py(), 65)
+
+
+    def test_optimization_levels(self):
+        code = """
+        fn f(n : int) -> int {
+            total = 0
+            for i in 0..n {
+                total += i * 4
+            }
+            return total
+        }
+
+        fn main() {
+            x = f(5)
+            return x
+        }
+        """
+        modules = []
+        stats = []
+        for level in range(3):
+            stats.append(CompileStats())
+            modules.append(Module.from_ast("<test_optimization_levels>", "main",
+                DipperParser().parse(code), opt_level=level, stats=stats[level]))
+            self.assertEqual(self._run_module(modules[level]).int_py(), 40)
+
+        def insts(level):
+            return [ INST_STRS[inst] for inst, a, b, c in modules[level].get_func("f").bytecode ]
+        # -O0 leaves the labels in, -O1 doesn't touch the loop, -O2 inlines f into main
+        self.assertTrue("LABEL" in insts(0))
+        self.assertFalse("LABEL" in insts(1))
+        self.assertEqual(insts(1), ["SET", "MUL_IM", "ADD_II", "ADDI", "BNE", "RET"])
+        self.assertEqual(insts(2), ["SET", "MUL_IM", "ADD_II", "ADDI", "ADDI", "BNE", "RET"])
+        self.assertFalse("CALL" in [ INST_STRS[inst] for inst, a, b, c in
+            modules[2].get_func("main").bytecode ])
+
+        names = [ [ stat.name for stat in funcstats.passes ] for funcstats in stats[2].funcs ]
+        self.assertEqual(names[0], ["linearize", "fold_constants", "peephole",
+            "optimize_loops", "pool_constants", "allocate_registers"])
+        self.assertEqual([ funcstats.passes for funcstats in stats[0].funcs ], [[], []])
+        self.assertEqual([ stat.name for stat in stats[2].module.passes ], ["inline"])
+        for funcstats in stats[1].funcs:
+            func = modules[1].get_func(funcstats.name)
+            self.assertEqual(funcstats.instructions, len(func.bytecode))
+            self.assertEqual(funcstats.registers, len(func.data))
+            self.assertEqual(funcstats.passes[-1].after, len(func.bytecode))
+        self.assertTrue("allocate_registers" in stats[1].report())
+
+    def test_backward_jumps(self):
+        # the optimizer lays the blocks out so that this jumps backwards with a JMP
+        code = """
+        fn main() {
+            x = 0
+            for i in 0..3 {
+                if x == 4 {
+                    x += 1
+                }
+                elif x == 0 {
+                    for j in 0..2 {
+                        x += 2
+                    }
+                }
+                else {
+                    return 99
+                }
+            }
+            return x
+        }
+        """
+        for level in range(3):
+            module = Module.from_ast("<test_backward_jumps>", "main", DipperParser().parse(code),
+                opt_level=level)
+            self.assertEqual(self._run_module(module).int_py(), 99)
+
+    def test_lazy_labels(self):
+        code = """
+        fn main() {
+            x = 3
+            if x > 5 {
+                x = 1
+            }
+            elif x == 3 {
+                x = 2
+            }
+            return x
+        }
+        """
+        for level in range(3):
+            module = Module.from_ast("<test_lazy_labels>", "main",
+                DipperParser().parse(code, "<test_lazy_labels>"), opt_level=level)
+            self.assertEqual(self._run_module(module).int_py(), 2)
+            func = module.get_func("main")
+            info = [ func.lines.annotation(i) for i in range(len(func.bytecode)) ]
+            described = " ".join([ annotation.describe() for annotation in info ])
+            # the labels only keep where the conditions are, the text comes from the
+            # source when it's asked for
+            for annotation in info:
+                self.assertFalse("x > 5" in annotation.comment)
+            self.assertTrue("If x > 5" in described)
+            self.assertTrue("Elif x == 3" in described)
+            if level == 0:
+                labels = [ annotation for annotation in info if annotation.comment.startswith("If") ]
+                self.assertEqual(labels[0].comment, "If %s" % SOURCE_MARKER)
+                self.assertEqual(labels[0].refs, [(3, 15)])
+
+        # the cache keeps the references, so the text still shows after loading
+        data = cache.dump_module(module, "<test_lazy_labels>", "key")
+        loaded = cache.load_module(data, "key").get_func("main")
+        self.assertEqual([ loaded.lines.describe(i) for i in range(len(loaded.bytecode)) ],
+            [ func.lines.describe(i) for i in range(len(func.bytecode)) ])
+
+        # without the source there's nothing to fill in
+        self.assertEqual(BytecodeAnnotation("<no such file>", (-1, -1),
+            comment="If %s; end If" % SOURCE_MARKER, refs=[(3, 15)]).describe(), "If ; end If")
+
+
     # TODO: implement if expressions
     #def test_if_expressions(self):
     #    result = self._execute_simple("test_if_expressions", """
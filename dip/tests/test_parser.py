@@ -3,6 +3,9 @@ sys.path.insert(0, "../")
 
 import unittest
 from dip.typesystem import DNull, DBool, DInteger, DString, DList
+from rpython.rlib.parsing.tree import Nonterminal, Symbol
+from rpython.rlib.parsing.lexer import Token, SourcePos
+from dip import parser, ast, errors
 from dip.parser import DipperParser
 from dip.compiler import FrameCompiler
 from dip.interpreter import VirtualMachine
@@ -31,6 +34,109 @@ class TestParser(unittest.TestCase):
     def test_simple(self):
         pass
 
+    def test_parsetables_cache(self):
+        # importing the parser should leave behind parse tables keyed by the grammar
+        self.assertEqual(parser.cached_grammar_hash(), parser.GRAMMAR_HASH)
+        self.assertEqual(parser.grammar_hash(parser.grammar), parser.GRAMMAR_HASH)
+        self.assertNotEqual(parser.grammar_hash(parser.grammar + "\n"), parser.GRAMMAR_HASH)
+
+    def test_parsetables_interrupted(self):
+        # a build that fails part way leaves the tables that were there alone
+        def fail(src, dst):
+            raise OSError("interrupted")
+        rename = parser.os.rename
+        parser.os.rename = fail
+        try:
+            self.assertRaises(OSError, parser.build_parsetables, parser.grammar, "broken")
+        finally:
+            parser.os.rename = rename
+        self.assertEqual(parser.cached_grammar_hash(), parser.GRAMMAR_HASH)
+        tmpfile = "%s.%d.tmp" % (parser.PARSETABLES_FILE, parser.os.getpid())
+        self.assertFalse(parser.os.path.exists(tmpfile))
+
+    def test_tokenize_positions(self):
+        tokens = parser.tokenize(
+            "# leading comment\n"
+            "\n"
+            "fn main() {   # trailing comment\n"
+            "    \n"
+            "    # indented comment\n"
+            "    x = \"#not a comment\"\n"
+            "}\n")
+        names = [ tok.name for tok in tokens ]
+        self.assertEqual(names.count("NEWLINE"), 3)
+        self.assertNotEqual(names[0], "NEWLINE")
+
+        # the string keeps its '#' and every token keeps its real source position
+        strtok = [ tok for tok in tokens if tok.name == "STRING" ][0]
+        self.assertEqual(strtok.source, '"#not a comment"')
+        self.assertEqual((strtok.source_pos.lineno, strtok.source_pos.columnno), (5, 8))
+        endtok = [ tok for tok in tokens if tok.name == "BLOCK_END" ][0]
+        self.assertEqual((endtok.source_pos.lineno, endtok.source_pos.columnno), (6, 0))
+
+    def test_traverse_deep(self):
+        # much deeper than the recursion limit would allow
+        depth = sys.getrecursionlimit() * 4
+        item = Symbol("NAME", "x", Token("NAME", "x", SourcePos(0, 0, 0)))
+        for i in range(depth):
+            item = Nonterminal("nested", [item])
+
+        node = DipperParser()._traverse(item)
+        for i in range(depth):
+            self.assertEqual(node.label, "nested")
+            self.assertEqual(len(node.children), 1)
+            node = node.children[0]
+        self.assertEqual(node.type, "Name")
+        self.assertEqual(node.getName(), "x")
+
+    def test_ast_source_positions(self):
+        tree = DipperParser().parse(
+            "# comment\n"
+            "\n"
+            "fn main() {\n"
+            "    return 0\n"
+            "}\n")
+        func = tree.children[0]
+        self.assertEqual(func.type, "Function")
+        self.assertEqual(func.children[0].children[0].children[0].source, (3, 11))
+
+    def test_compact_nodes(self):
+        tree = DipperParser().parse(
+            "fn main() {\n"
+            "    x = 1\n"
+            "    return x\n"
+            "}\n")
+        for node, level in tree.walk():
+            self.assertFalse(hasattr(node, "__dict__"))
+            if len(node.children) == 0:
+                self.assertIs(node.children, ast.NO_CHILDREN)
+        self.assertEqual(ast.NO_CHILDREN, [])
+        self.assertEqual(ast.unpackpos(ast.packpos(70000, 12)), (70000, 12))
+        self.assertEqual(ast.unpackpos(ast.packpos(-1, -1)), (-1, -1))
+
+    def test_error_line_index(self):
+        # the file doesn't exist, so the source view has to come from the parser
+        filename = "<test_error_line_index>.dip"
+        DipperParser().parse(
+            "fn main() {\n"
+            "    x = 1\n"
+            "    return x\n"
+            "}\n", filename=filename)
+        msg = errors.error_message(filename, (2, 11), "NameError", "y")
+        self.assertEqual(msg.split("\n"), [
+            "Error in file %s line 3, col 12:" % filename,
+            "    2:     x = 1",
+            "    3:     return x",
+            "       -----------^",
+            "    4: }",
+            "NameError: y",
+        ])
+        index = errors.LineIndex("a\nbc\n")
+        self.assertEqual(index.numlines(), 3)
+        self.assertEqual(index.getline(1), "bc")
+        self.assertEqual(index.getline(2), "")
+        self.assertEqual(index.getline(5), "")
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
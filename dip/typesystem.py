@@ -6,7 +6,7 @@ from collections import OrderedDict
 from rpython.rlib.objectmodel import we_are_translated
 from rpython.rlib.debug import make_sure_not_resized
 
-from bytecode import INST_STRS
+from bytecode import INST_STRS, format_operands, is_const, const_index, owned_registers
 
 
 def AutoType(name, ns=None):
@@ -541,18 +541,35 @@ class DFunc(DBase):
         inst.is_complete = False # this function lacks code and can't be called
         return inst
 
-    def set_code(self, bytecode, bytecode_info, data, vars):
+    def set_code(self, bytecode, lines, data, vars, consts):
         # the bytecode instructions
         self.bytecode = bytecode
-        # bytecode annotations like source line number
-        self.bytecode_info = bytecode_info
+        # LineTable with the source position and comment of each instruction
+        self.lines = lines
         # data registers
         self.data = data
         # name to data register binding dict
         self.vars = vars
+        # the module's constant pool (shared, never modified)
+        self.consts = consts
+        # data registers that each frame needs its own copy of. arguments don't
+        # count since they get replaced by the passed in values anyway.
+        self.owned = []
+        flags = owned_registers(bytecode, len(data))
+        for i in range(len(self.args), len(data)):
+            if flags[i]:
+                self.owned.append(i)
         # this function is now a complete function object
         self.is_complete = True
 
+    def getoperand(self, idx):
+        """
+        Returns the template data register or pooled constant an operand refers to
+        """
+        if is_const(idx):
+            return self.consts[const_index(idx)]
+        return self.data[idx]
+
     def get_return_type_name(self):
         return self.rettype[len(self.rettype) - 1]
 
@@ -566,11 +583,12 @@ class DFunc(DBase):
 
         assert type(args) is DList
 
-        # make a copy of the function registers that will be the "register" stack during execution
-        framedata = [DNull()] * len(self.data)
+        # make the "register" stack used during execution. registers that never get
+        # modified can be shared with every other frame, the rest are copied.
+        framedata = self.data[:]
         make_sure_not_resized(framedata)
-        for i, val in enumerate(self.data):
-            framedata[i] = val.copy()
+        for i in self.owned:
+            framedata[i] = self.data[i].copy()
 
         # populate function argument values
         if args.len_py() != len(self.args):
@@ -597,14 +615,9 @@ class DFunc(DBase):
     def toString(self):
         bc = []
         for i, (inst, a, b, c) in enumerate(self.bytecode):
-            args = []
-            for val in [a, b, c]:
-                if val != -1:
-                    args.append(str(val))
-
             instname = INST_STRS[inst]
-            argnames = ", ".join(args)
-            comment = self.bytecode_info[i].comment
+            argnames = ", ".join(format_operands(inst, a, b, c, self.consts))
+            comment = self.lines.describe(i)
             if len(comment) > 0:
                 comment = " # %s" % comment
             bc.append("    %s : %s (%s)%s" % (i, instname, argnames, comment))
@@ -635,6 +648,8 @@ class StructDef(object):
         self.name = name
         self.numfields = numfields
         self.fielddefs = OrderedDict()
+        # hash of the struct's source, for incremental recompilation
+        self.srchash = ""
 
     def setfield(self, name, newtype):
         if not we_are_translated():
@@ -5,6 +5,7 @@ import sys
 sys.path.insert(0, "./pypy-source")
 
 import os
+import time
 
 try:
     from rpython.rlib.objectmodel import we_are_translated
@@ -12,9 +13,13 @@ except ImportError:
     def we_are_translated():
         return False
 
-from dip import parser, compiler, interpreter, basicio
-from dip.errors import error_message, error_from_exception
-from dip.namespace import Module
+from dip import parser, compiler, interpreter, basicio, cache
+from dip.errors import error_message, error_from_exception, register_source
+from dip.namespace import Module, IncrementalState
+from dip.passes import CompileStats, DEFAULT_OPT_LEVEL, MAX_OPT_LEVEL
+
+# how often watch mode checks the file for changes, in seconds
+WATCH_INTERVAL = 0.25
 
 
 def main(argv):
@@ -26,11 +31,27 @@ def main(argv):
     debug_compiler = False
     debug_interpreter = False
 
+    # other flags
+    use_cache = True
+    jobs = 1
+    watch = False
+    lazy = False
+    opt_level = DEFAULT_OPT_LEVEL
+    compile_stats = False
+
     if argc == 1:
-        print "Usage: %s [-pci] <filename>.dip\n" % argv[0]
+        print "Usage: %s [-pcinjwl] [-O0|-O1|-O2] [--compile-stats] <filename>.dip\n" % argv[0]
         print "    -p: Debug parser/ast"
         print "    -c: Debug compiler/bytecode"
         print "    -i: Debug interpreter/execution"
+        print "    -n: Don't read or write .dipc cache files"
+        print "    -j: Compile functions in parallel on all cores (untranslated only)"
+        print "    -w: Watch the file and re-run it whenever it changes, only"
+        print "        recompiling the functions that changed"
+        print "    -l: Only compile functions when they're first called"
+        print "    -O0, -O1, -O2: Optimization level. -O0 doesn't optimize at all, -O1"
+        print "        only runs the cheap passes, -O2 (the default) runs all of them"
+        print "    --compile-stats: Print how long each compiler pass took and what it did"
         return 1
     elif argc == 2:
         debug = 0
@@ -38,66 +59,99 @@ def main(argv):
         dip_args = []
     else:
         assert argc > 2
-        if argv[1].startswith("-"):
+        # flags come before the filename
+        argidx = 1
+        while argidx < argc - 1 and argv[argidx].startswith("-"):
+            arg = argv[argidx]
+            argidx += 1
+            if arg == "--compile-stats":
+                compile_stats = True
+                continue
+            if arg.startswith("-O"):
+                level = arg[2:]
+                if level not in ("0", "1", "2"):
+                    print "Unknown optimization level '%s' (0 to %s)" % (level, MAX_OPT_LEVEL)
+                    return 1
+                opt_level = int(level)
+                continue
             # figure out debug flags based on the first argument
-            for ch in argv[1]:
+            for ch in arg:
                 if ch == "p":
                     debug_parser = True
                 if ch == "c":
                     debug_compiler = True
                 elif ch == "i":
                     debug_interpreter = True
-            filename = argv[2]
-            dip_args = argv[2:]
-        else:
-            filename = argv[1]
-            dip_args = argv[1:]
+                elif ch == "n":
+                    use_cache = False
+                elif ch == "j":
+                    jobs = cpu_count()
+                elif ch == "w":
+                    watch = True
+                elif ch == "l":
+                    lazy = True
+        filename = argv[argidx]
+        dip_args = argv[argidx:]
 
     if not os.path.exists(filename):
         print "Specified file '%s' does not exist." % filename
         return 1
 
+    if watch:
+        return watch_file(filename, dip_args, debug_parser, debug_compiler,
+            debug_interpreter, jobs, lazy, opt_level, compile_stats)
+
     # read in the file contents
     data = basicio.readall(filename)
 
-    # create a parser
-    dip = parser.DipperParser(debug=debug_parser)
-
-    # just a debugging step so we can see the same input the parser sees
-    #print "=============== code ==================="
-    #print ">>> Source code (after small preprocessing step) <<<"
-    #print dip._prepSource(data)
-
-    if debug_parser > 0:
-        print "============== parsing ================="
-
-    try:
-        tree = dip.parse(data, filename=filename)
-    except Exception as e:
-        print "Error parsing file '%s': %s" % (filename, str(e))
-        return 1
+    # the parser debug output needs an AST, which the cache doesn't have, and
+    # lazily built modules can't be written out since they aren't fully compiled.
+    # there's nothing to report compile stats on if nothing gets compiled.
+    if debug_parser or lazy or compile_stats:
+        use_cache = False
+
+    # try to load a previously compiled version of this exact source
+    cachekey = cache.source_key(data, opt_level)
+    mainmodule = None
+    if use_cache:
+        mainmodule = cache.read_cache(filename, cachekey)
+
+    if mainmodule is None:
+        stats = None
+        if compile_stats:
+            stats = CompileStats()
+        mainmodule = compile_module(filename, data, debug_parser, debug_compiler, jobs,
+            lazy=lazy, opt_level=opt_level, stats=stats)
+        if mainmodule is None:
+            return 1
+        if stats is not None:
+            print_compile_stats(stats)
+        if use_cache:
+            cache.write_cache(filename, cachekey, mainmodule)
 
-    if tree is None:
-        print "Error parsing file '%s'" % filename
-        return 1
+    else:
+        # the parser didn't see the source, so index it here for error messages
+        register_source(filename, data)
+        if debug_compiler:
+            print "============= compiling ================"
+            print "(loaded from %s)" % cache.cache_path(filename)
 
-    if debug_parser:
-        print ">>> AST <<<"
-        print tree.show()
+    return run_module(filename, mainmodule, dip_args, debug_parser, debug_compiler,
+        debug_interpreter)
 
-    if debug_compiler:
-        print "============= compiling ================"
 
+def run_module(filename, mainmodule, dip_args, debug_parser, debug_compiler, debug_interpreter):
     vm = interpreter.VirtualMachine(dip_args, debug=debug_interpreter)
 
-    mainmodule = Module.from_ast(filename, "main", tree)
-
     if debug_compiler:
         print mainmodule.toString()
         for name, func in mainmodule.funcs.items():
             print
             print "___ Function '%s' ___" % name
-            print func.toString()
+            if func.is_complete:
+                print func.toString()
+            else:
+                print "(compiled on first call)"
 
     vm.setglobals(mainmodule)
 
@@ -118,6 +172,96 @@ def main(argv):
     return 0
 
 
+def print_compile_stats(stats):
+    print "============= compile stats ================"
+    print stats.report()
+
+
+def compile_module(filename, data, debug_parser, debug_compiler, jobs=1, incremental=None,
+        lazy=False, opt_level=DEFAULT_OPT_LEVEL, stats=None):
+    """
+    Parses and compiles the source of the main module. Returns None on parse errors.
+    """
+    # create a parser
+    dip = parser.DipperParser(debug=debug_parser)
+
+    if debug_parser > 0:
+        print "============== parsing ================="
+
+    try:
+        tree = dip.parse(data, filename=filename)
+    except Exception as e:
+        print "Error parsing file '%s': %s" % (filename, str(e))
+        return None
+
+    if tree is None:
+        print "Error parsing file '%s'" % filename
+        return None
+
+    if debug_parser:
+        print ">>> AST <<<"
+        print tree.show()
+
+    if debug_compiler:
+        print "============= compiling ================"
+
+    return Module.from_ast(filename, "main", tree, jobs=jobs, incremental=incremental,
+        lazy=lazy, opt_level=opt_level, stats=stats)
+
+
+def watch_file(filename, dip_args, debug_parser, debug_compiler, debug_interpreter, jobs, lazy,
+        opt_level, compile_stats):
+    """
+    Runs the file, then runs it again every time it changes. Functions whose source
+    and dependencies didn't change are reused from the previous run instead of being
+    recompiled. Runs until interrupted.
+    """
+    incremental = IncrementalState()
+    last_mtime = -1.0
+    while True:
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            mtime = last_mtime
+
+        if mtime != last_mtime:
+            last_mtime = mtime
+            data = basicio.readall(filename)
+
+            # errors have already been reported by the time they get here, and
+            # shouldn't stop us from watching for the fix
+            stats = None
+            if compile_stats:
+                stats = CompileStats()
+            try:
+                mainmodule = compile_module(filename, data, debug_parser, debug_compiler,
+                    jobs, incremental, lazy, opt_level, stats)
+            except Exception as e:
+                mainmodule = None
+
+            if mainmodule is not None:
+                if stats is not None:
+                    print_compile_stats(stats)
+                print "============= %s: compiled %s, reused %s ================" % (
+                    filename, incremental.compiled, incremental.reused)
+                try:
+                    run_module(filename, mainmodule, dip_args, debug_parser,
+                        debug_compiler, debug_interpreter)
+                except Exception as e:
+                    pass
+
+        time.sleep(WATCH_INTERVAL)
+
+    return 0
+
+
+def cpu_count():
+    if we_are_translated():
+        return 1
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
 def target(driver, args):
     return main, None
 